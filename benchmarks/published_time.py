@@ -0,0 +1,46 @@
+"""Micro-benchmark of the parsing of the publication times of feed items, in items per second
+
+Compares parsing each time twice with strptime and the time_format of the feed, like the scraper used to, with parsing
+it once with the PublishedTimeParser of the feed. Run it from the root of the repository:
+
+    python -m benchmarks.published_time
+"""
+import timeit
+from datetime import datetime
+
+import pytz
+
+from config import feeds
+from manager.celery_periodic.feed_parser import PublishedTimeParser
+
+ITEMS = 10000
+
+
+def strptime_twice(values: list, time_format: str):
+    for value in values:
+        for _ in range(2):
+            date = datetime.strptime(value.strip(), time_format)
+            datetime(year=date.year, month=date.month, day=date.day, hour=date.hour, minute=date.minute,
+                     second=date.second, tzinfo=pytz.utc if not date.tzinfo else date.tzinfo)
+
+
+def parser_once(values: list, time_format: str):
+    parser = PublishedTimeParser(time_format)
+    for value in values:
+        parser(value)
+
+
+def main():
+    for feed in feeds:
+        time_format = feed.get("time_format")
+        zone = "+0100" if time_format.endswith("%z") else "GMT"
+        values = [f"Tue, {day % 28 + 1:02d} Nov 2020 {day % 24:02d}:{day % 60:02d}:00 {zone}" for day in range(ITEMS)]
+
+        print(feed.get("url"))
+        for name, benchmark in (("before", strptime_twice), ("after", parser_once)):
+            seconds = min(timeit.repeat(lambda: benchmark(values, time_format), number=1, repeat=5))
+            print(f"  {name:>6}: {ITEMS / seconds:>10,.0f} items/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark of the write and read costs of the read state models
+
+For each model a feed followed by many users gets batches of new items, which are fanned out on write by the 'unreads'
+model only, then the first page of unread items of the followers is requested. It runs against a scratch database
+next to the one of the tests, dropped at the end. Run it from the root of the repository:
+
+    python -m benchmarks.read_state_models
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+from config import TestConfig
+from manager import create_app, sql_db
+from manager.celery_periodic.scraper import Scraper
+from manager.db_model import Feed, FeedItem, Follows, User
+from manager.read_state import get_read_state, read_state_models
+
+FOLLOWERS = 2000
+BATCHES = 10
+ITEMS_PER_BATCH = 20
+READERS = 200
+PAGE_SIZE = 100
+
+DATABASE_URI = TestConfig.SQLALCHEMY_DATABASE_URI + "_benchmark"
+
+
+def setup_followers(feed_url: str) -> Feed:
+    feed = Feed(url=feed_url, parser="lxml", time_format="%a, %d %b %Y %H:%M:%S %z")
+    sql_db.session.add(feed)
+    sql_db.session.flush()
+    usernames = [f"{feed_url}-{number:05d}" for number in range(FOLLOWERS)]
+    sql_db.session.bulk_insert_mappings(User, [{"username": username, "password": ""} for username in usernames])
+    sql_db.session.bulk_insert_mappings(Follows, [{"username": username, "feed_id": feed.id} for username in usernames])
+    for username in usernames:
+        get_read_state().follow(username, feed.id)
+    sql_db.session.commit()
+    return feed
+
+
+def write_cost(feed: Feed) -> float:
+    published = datetime(2020, 11, 10, tzinfo=pytz.utc)
+    start = time.perf_counter()
+    for batch in range(BATCHES):
+        items = [FeedItem(title=f"Item {batch}-{number}", url=f"{feed.url}/{batch}/{number}", feed_id=feed.id,
+                          published=published + timedelta(minutes=batch * ITEMS_PER_BATCH + number))
+                 for number in range(ITEMS_PER_BATCH)]
+        Scraper({"url": feed.url}).persist(items)
+    return time.perf_counter() - start
+
+
+def read_cost(feed: Feed) -> float:
+    readers = [username for username, in Follows.query.filter_by(feed_id=feed.id)
+               .with_entities(Follows.username).limit(READERS)]
+    start = time.perf_counter()
+    for username in readers:
+        items = get_read_state().unread_items(username).limit(PAGE_SIZE).all()
+        assert len(items) == min(PAGE_SIZE, BATCHES * ITEMS_PER_BATCH)
+        sql_db.session.rollback()
+    return time.perf_counter() - start
+
+
+def main():
+    app = create_app("testing")
+    app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+    if database_exists(DATABASE_URI):
+        drop_database(DATABASE_URI)
+    create_database(DATABASE_URI)
+    try:
+        with app.app_context():
+            sql_db.create_all()
+            print(f"{FOLLOWERS} followers, {BATCHES} batches of {ITEMS_PER_BATCH} items, {READERS} readers")
+            for model in read_state_models:
+                app.config["READ_STATE_MODEL"] = model
+                feed = setup_followers(f"https://{model}.example.com/rss")
+                write = write_cost(feed)
+                read = read_cost(feed)
+                print(f"  {model:>9}: write {BATCHES * ITEMS_PER_BATCH / write:>8,.0f} items/s, "
+                      f"read {READERS / read:>8,.0f} pages/s")
+            sql_db.session.remove()
+    finally:
+        sql_db.get_engine(app).dispose()
+        drop_database(DATABASE_URI)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Benchmark of the latency of the refreshes requested by the users while a full periodic scrape is running
+
+A scrape cycle of FEEDS feeds, served by a local server answering each request after DOCUMENT_DELAY seconds, is
+started, then a feed that is not part of the cycle is refreshed every REFRESH_INTERVAL seconds. It runs twice with
+workers started in this process on an in-memory broker, with the processes of WORKER_CONCURRENCY in threads: a single
+worker consuming both queues, like the single default queue of the tasks before they were routed, then a worker per
+queue like docker/app.sh. The in-memory broker ignores the priorities of the messages, the queues alone keep the
+refreshes apart from the scrape batches. It runs against a scratch database next to the one of the tests, dropped at
+the end. Run it from the root of the repository:
+
+    python -m benchmarks.refresh_latency
+"""
+import statistics
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytz
+from celery.contrib.testing.worker import start_worker
+from flask import current_app
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+from config import TestConfig
+from manager import celery_periodic, create_app, sql_db
+from manager.celery_periodic import scrape_runs
+from manager.db_model import Feed, ScrapeRun
+
+FEEDS = 200
+ITEMS_PER_FEED = 20
+DOCUMENT_DELAY = 0.5
+REFRESH_INTERVAL = 0.5
+TIMEOUT = 300
+
+DATABASE_URI = TestConfig.SQLALCHEMY_DATABASE_URI + "_benchmark"
+SETTINGS = {
+    "SQLALCHEMY_DATABASE_URI": DATABASE_URI,
+    "SCRAPE_DISPATCH_BATCH_SIZE": 10,
+}
+
+
+class FeedServer(ThreadingHTTPServer):
+    """Serves a feed document of ITEMS_PER_FEED items at any path, after DOCUMENT_DELAY seconds"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FeedRequestHandler)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(DOCUMENT_DELAY)
+        body = rss_document(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def rss_document(path: str) -> bytes:
+    items = "".join(f"<item><title>{path} {number}</title><link>https://example.com{path}/{number}</link>"
+                    f"<description>Desc</description><pubDate>Thu, 12 Nov 2020 10:00:00 +0000</pubDate></item>"
+                    for number in range(ITEMS_PER_FEED))
+    return f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>{items}</channel></rss>'.encode()
+
+
+def setup_feeds(server: FeedServer, layout: str) -> tuple:
+    """Creates the feeds of the scrape cycle of a layout, and the feeds it refreshes, none of them due before the cycle
+    starts
+    """
+    later = datetime.now(pytz.utc) + timedelta(days=1)
+    scraped = [Feed(url=server.url(f"/{layout}/scraped/{number}.xml"), parser="lxml", next_due=later)
+               for number in range(FEEDS)]
+    refreshed = [Feed(url=server.url(f"/{layout}/refreshed/{number}.xml"), parser="lxml", next_due=later)
+                 for number in range(FEEDS)]
+    sql_db.session.add_all(scraped + refreshed)
+    sql_db.session.commit()
+    return [feed.id for feed in scraped], [feed.id for feed in refreshed]
+
+
+def request_refresh(feed_id) -> int:
+    """Queues the refresh of a feed like the /api/my-feeds/update endpoints"""
+    from manager.celery_periodic.tasks import refresh_feed
+    run_id, _ = scrape_runs.open_run(feed_id, scrape_runs.PENDING, current_app.config)
+    sql_db.session.commit()
+    refresh_feed.delay(run_id)
+    return run_id
+
+
+def finished_runs(feed_ids: list) -> list:
+    runs = ScrapeRun.query.filter(ScrapeRun.feed_id.in_(feed_ids), ScrapeRun.finished_at.isnot(None)).all()
+    sql_db.session.rollback()
+    return runs
+
+
+def scrape_cycle(scraped: list, refreshed: list) -> tuple:
+    """Runs a scrape cycle, refreshing a feed every REFRESH_INTERVAL seconds meanwhile
+
+    :return The duration of the cycle and the latency of each refresh, from its request to the end of its run
+    """
+    from manager.celery_periodic.tasks import scrape
+    Feed.query.filter(Feed.id.in_(scraped)).update({Feed.next_due: None}, synchronize_session=False)
+    sql_db.session.commit()
+    start = time.perf_counter()
+    scrape.delay()
+    refresh_runs = list()
+    cycle_seconds = None
+    while cycle_seconds is None or len(finished_runs(refreshed)) < len(refresh_runs):
+        if time.perf_counter() - start > TIMEOUT:
+            raise TimeoutError(f"The scrape cycle did not end within {TIMEOUT}s")
+        if cycle_seconds is None and len(refresh_runs) < len(refreshed):
+            refresh_runs.append(request_refresh(refreshed[len(refresh_runs)]))
+        if cycle_seconds is None and len(finished_runs(scraped)) == FEEDS:
+            cycle_seconds = time.perf_counter() - start
+        time.sleep(REFRESH_INTERVAL)
+
+    latencies = [(run.finished_at - run.created_at).total_seconds() for run in finished_runs(refreshed)]
+    return cycle_seconds, latencies
+
+
+def main():
+    app = create_app("testing")
+    app.config.update(SETTINGS)
+    celery = celery_periodic.celery
+    celery.conf.broker_url = "memory://"
+    concurrency = app.config.get("WORKER_CONCURRENCY")
+    queues = [queue.name for queue in celery.conf.task_queues]
+    if database_exists(DATABASE_URI):
+        drop_database(DATABASE_URI)
+    create_database(DATABASE_URI)
+    try:
+        with app.app_context(), FeedServer() as server:
+            sql_db.create_all()
+            print(f"{FEEDS} feeds of {ITEMS_PER_FEED} items answered in {DOCUMENT_DELAY}s, a refresh every "
+                  f"{REFRESH_INTERVAL}s, worker concurrency {concurrency}")
+            layouts = {
+                "one worker for every queue": {"+".join(queues): sum(concurrency.values())},
+                "a worker per queue": concurrency,
+            }
+            feeds = {layout: setup_feeds(server, f"layout-{number}") for number, layout in enumerate(layouts)}
+            for layout, workers in layouts.items():
+                with ExitStack() as stack:
+                    for names, processes in workers.items():
+                        stack.enter_context(start_worker(celery, concurrency=processes, pool="threads",
+                                                         queues=names.split("+"), perform_ping_check=False))
+                    cycle_seconds, latencies = scrape_cycle(*feeds[layout])
+                print(f"  {layout:>26}: cycle {cycle_seconds:>5.1f}s, {len(latencies)} refreshes in "
+                      f"{statistics.median(latencies):>5.2f}s median, {max(latencies):>5.2f}s max")
+            sql_db.session.remove()
+    finally:
+        sql_db.get_engine(app).dispose()
+        drop_database(DATABASE_URI)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,21 @@
 import os
 
 from flask_swagger_ui import get_swaggerui_blueprint
+from kombu import Queue
 
 
 feeds = [
     {
         "url": "http://www.nu.nl/rss/Algemeen",
         "parser": "lxml",
-        "time_format": "%a, %d %b %Y %H:%M:%S %z"
+        "time_format": "%a, %d %b %Y %H:%M:%S %z",
+        "sorted_by_date": True
     },
     {
         "url": "https://feeds.feedburner.com/tweakers/mixed",
         "parser": "html5lib",
-        "time_format": "%a, %d %b %Y %H:%M:%S %Z"
+        "time_format": "%a, %d %b %Y %H:%M:%S %Z",
+        "sorted_by_date": True
     },
 ]
 
@@ -27,6 +30,30 @@ class Config(object):
         }
     }
     timezone = "UTC"
+    # The refreshes requested by the users go to the 'refresh' queue and the periodic scrape to the 'scrape' queue, each
+    # consumed by its own workers so that a refresh never waits behind the scrape batches. Within a queue the messages
+    # with the highest priority, out of task_queue_max_priority, are delivered first
+    task_queues = (
+        Queue("refresh", routing_key="refresh"),
+        Queue("scrape", routing_key="scrape"),
+    )
+    task_default_queue = "scrape"
+    task_queue_max_priority = 10
+    task_default_priority = 5
+    task_routes = {
+        "refresh_feed": {"queue": "refresh", "priority": 9},
+        "scrape": {"queue": "scrape", "priority": 8},
+        "dispatch_shard": {"queue": "scrape", "priority": 7},
+        "scrape_feeds": {"queue": "scrape", "priority": 3},
+    }
+    # Each worker process reserves a single task at a time: a task reserved behind a long scrape batch would wait for it
+    # while another process is idle, and the priorities only order the tasks not reserved yet
+    worker_prefetch_multiplier = 1
+    # Processes, or threads, of the worker started for each queue, see manager/celery_periodic/worker.py and worker_argv
+    WORKER_CONCURRENCY = {"refresh": 4, "scrape": 2}
+    # Execution pool of the worker of each queue. The scrape batches run in threads, since the children of a prefork
+    # pool are daemonic and cannot start the SCRAPE_PARSE_PROCESSES parser processes
+    WORKER_POOL = {"refresh": "prefork", "scrape": "threads"}
 
     # ------------------------------------------ Postgres -------------------------------------------------------------
 
@@ -47,6 +74,83 @@ class Config(object):
     # ------------------------------------------ Application ----------------------------------------------------------
     SECRET_KEY = "totally_secret"
 
+    # Lifetime in seconds of the tokens issued by /api/tokens
+    AUTH_TOKEN_TTL = 3600
+    # Verified basic credentials are cached to skip the password hashing, a size of 0 disables the cache
+    AUTH_CACHE_SIZE = 1024
+    AUTH_CACHE_TTL = 300
+
+    # Caps on the historical items marked as unread when a user starts following a feed, None means no cap
+    FOLLOW_BACKFILL_LIMIT = None
+    FOLLOW_BACKFILL_DAYS = None
+    # Whether the Read items of a feed are kept when a user unfollows it, unless the request says otherwise
+    UNFOLLOW_KEEP_HISTORY = False
+    # How the read state of the users is stored: 'unreads' (one row per unread item), 'watermark' (a read watermark
+    # per followed feed plus the items read out of order) or 'reads' (only the read items, the unread ones are computed
+    # when they are requested), see manager/read_state.py
+    READ_STATE_MODEL = "unreads"
+    # Page sizes of the item lists requested with the 'limit' / 'cursor' query parameters
+    PAGE_SIZE_DEFAULT = 100
+    PAGE_SIZE_MAX = 500
+
+    # ------------------------------------------ Scraper --------------------------------------------------------------
+    # The periodic scrape downloads the feeds concurrently, with at most SCRAPE_CONCURRENCY connections overall and
+    # SCRAPE_PER_HOST_CONCURRENCY connections to the same host. The other fetches share a pooled session per process
+    # keeping SCRAPE_PER_HOST_CONCURRENCY connections alive for each of the last SCRAPE_CONCURRENCY hosts
+    SCRAPE_CONCURRENCY = 20
+    SCRAPE_PER_HOST_CONCURRENCY = 4
+    # Timeouts in seconds to establish a connection to a feed's host and between two reads of its response
+    SCRAPE_CONNECT_TIMEOUT = 5
+    SCRAPE_READ_TIMEOUT = 30
+    # Items published up to this many hours before the newest stored item of their feed are still parsed, the ones
+    # already stored are skipped by their guid
+    SCRAPE_LOOKBACK_HOURS = 24
+    # Feed documents larger than this many bytes are not parsed
+    SCRAPE_MAX_DOCUMENT_SIZE = 10 * 1024 * 1024
+    # The new items of a feed are made unread for this many of its followers per transaction, None for all of them in
+    # the transaction storing the items
+    SCRAPE_FANOUT_CHUNK_SIZE = 1000
+    # The periodic task only scrapes the feeds that are due: each one is due again after about half the average time
+    # between its recent items, no sooner than the Cache-Control / Expires lifetime of its document and its RSS <ttl>,
+    # outside of its RSS <skipHours>, and within these bounds in seconds
+    SCRAPE_MIN_INTERVAL = 60
+    SCRAPE_MAX_INTERVAL = 6 * 3600
+    # A feed failing SCRAPE_BREAKER_THRESHOLD scrapes in a row is skipped for SCRAPE_BREAKER_BACKOFF seconds, doubled
+    # with each new failure up to SCRAPE_BREAKER_MAX_BACKOFF, then probed by a single scrape that gives up after
+    # SCRAPE_BREAKER_PROBE_TIMEOUT seconds
+    SCRAPE_BREAKER_THRESHOLD = 3
+    SCRAPE_BREAKER_BACKOFF = 60
+    SCRAPE_BREAKER_MAX_BACKOFF = 6 * 3600
+    SCRAPE_BREAKER_PROBE_TIMEOUT = 300
+    # A scrape run still pending or running after SCRAPE_RUN_TIMEOUT seconds, e.g. because its worker died, is failed
+    # and the next refresh request of its feed starts a new one
+    SCRAPE_RUN_TIMEOUT = 300
+    # Every scrape of a feed holds its lease for at most SCRAPE_LOCK_LEASE seconds, from the start of the download of
+    # the feed when it is part of a batch of the periodic scrape. The periodic task skips the feeds leased by another
+    # scrape, the other entry points wait up to SCRAPE_LOCK_WAIT_TIMEOUT seconds for them, checking every
+    # SCRAPE_LOCK_POLL_INTERVAL seconds
+    SCRAPE_LOCK_LEASE = 300
+    SCRAPE_LOCK_WAIT_TIMEOUT = 60
+    SCRAPE_LOCK_POLL_INTERVAL = 0.5
+    # The wait and hold times of the leases reported at /api/scraper/stats are the ones of the scrape runs of every
+    # worker that finished in the last SCRAPE_LOCK_STATS_WINDOW seconds
+    SCRAPE_LOCK_STATS_WINDOW = 3600
+    # The periodic scrape pages through the feeds table in SCRAPE_SHARDS shards, by feed id, and queues their due feeds
+    # in batches of SCRAPE_DISPATCH_BATCH_SIZE, dropped when no worker picked them up within SCRAPE_DISPATCH_EXPIRES
+    # seconds
+    SCRAPE_SHARDS = 4
+    SCRAPE_DISPATCH_BATCH_SIZE = 50
+    SCRAPE_DISPATCH_EXPIRES = 300
+    # The feeds of a batch go through a pipeline: downloaded by an event loop, parsed by SCRAPE_PARSE_PROCESSES
+    # processes (0 to parse in a thread of the worker) and stored SCRAPE_PERSIST_BATCH_SIZE items per transaction, or
+    # what arrived within SCRAPE_PERSIST_BATCH_INTERVAL seconds. At most SCRAPE_PIPELINE_QUEUE_SIZE documents wait for
+    # each stage. The parser processes are shared by the threads of the scrape worker, see WORKER_POOL, a daemonic
+    # process like a child of a prefork pool cannot start them and parses in a thread
+    SCRAPE_PARSE_PROCESSES = 2
+    SCRAPE_PERSIST_BATCH_SIZE = 500
+    SCRAPE_PERSIST_BATCH_INTERVAL = 2
+    SCRAPE_PIPELINE_QUEUE_SIZE = 20
+
 
 class TestConfig(Config):
     # ------------------------------------------ Celery ---------------------------------------------------------------
@@ -84,7 +188,7 @@ class ProdConfig(Config):
     beat_schedule = {
         "regular_scrape": {
             "task": "scrape",
-            "schedule": 600.0
+            "schedule": 60.0
         }
     }
 
@@ -93,4 +197,8 @@ class ProdConfig(Config):
     SQLALCHEMY_DATABASE_URI = f"postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DBNAME}"
 
     # ------------------------------------------ Server ---------------------------------------------------------------
-    SECRET_KEY = os.urandom(32)
+    # Shared by every process, the authentication tokens issued by one of them are verified by the others. It is only
+    # read from the environment, a production process refuses to start without it
+    SECRET_KEY = os.environ.get("SECRET_KEY")
+    if os.environ.get("FLASK_ENV") == "production" and not SECRET_KEY:
+        raise RuntimeError("SECRET_KEY must be set in the environment of a production process")
@@ -7,6 +7,7 @@ from flask_script import Manager, Command
 from config import feeds
 from manager import create_app, sql_db
 from manager.db_model import Feed
+from manager.read_state import get_read_state
 
 app = create_app()
 manager = Manager(app)
@@ -20,6 +21,14 @@ class InitDbCommand(Command):
         print('Database has been initialized.')
 
 
+class ReconcileCountersCommand(Command):
+    """ Recompute the unread counters from the read state."""
+
+    def run(self):
+        reconcile_counters()
+        print('Unread counters have been reconciled.')
+
+
 def init_db():
     """ Initialize the database."""
     sql_db.drop_all()
@@ -28,19 +37,27 @@ def init_db():
 
 
 def create_feeds(db):
-    counter = 1
+    """Seeds the feeds table with the feeds of config.py, the ids come from the sequence so that the feeds registered
+    later through the API do not collide with them"""
     for rss_feed in feeds:
         now = datetime.utcnow()
         dt = datetime(now.year - 1, now.month, now.day, now.hour, now.minute, now.second, tzinfo=pytz.utc)
         db.session.add(
-            Feed(id=counter, url=rss_feed.get("url"), parser=rss_feed.get("parser"),
-                 time_format=rss_feed.get("time_format"), last_updated=dt))
-        counter += 1
+            Feed(url=rss_feed.get("url"), parser=rss_feed.get("parser"),
+                 time_format=rss_feed.get("time_format"), sorted_by_date=rss_feed.get("sorted_by_date", False),
+                 last_updated=dt))
     db.session.commit()
 
 
+def reconcile_counters():
+    """ Recompute the unread counters of every user from the tables of the configured read state model."""
+    get_read_state().reconcile_counters()
+    sql_db.session.commit()
+
+
 manager.add_command('db', MigrateCommand)
 manager.add_command('init_db', InitDbCommand)
+manager.add_command('reconcile_counters', ReconcileCountersCommand)
 
 
 if __name__ == "__main__":
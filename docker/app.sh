@@ -2,5 +2,7 @@
 
 sleep 20
 celery -A manager.celery_periodic.worker.celery beat -l info &
-celery -A manager.celery_periodic.worker.celery worker -l info &
-gunicorn --bind 0.0.0.0:5000 application:app
\ No newline at end of file
+# A worker per queue, the refreshes requested by the users are not queued behind the periodic scrape
+python -m manager.celery_periodic.worker refresh -l info &
+python -m manager.celery_periodic.worker scrape -l info &
+gunicorn --bind 0.0.0.0:5000 application:app
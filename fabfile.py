@@ -16,3 +16,8 @@ def initdb(context):
 def migratedb(context):
     run("python db_initializer.py db migrate")
     run("python db_initializer.py db upgrade")
+
+
+@task
+def reconcilecounters(context):
+    run("python db_initializer.py reconcile_counters")
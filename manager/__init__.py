@@ -1,7 +1,9 @@
+import os
+
 from flask import Flask
 
 from flask_sqlalchemy import SQLAlchemy
-from flask_httpauth import HTTPBasicAuth
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from flask_migrate import Migrate
 
 from manager import celery_periodic
@@ -9,7 +11,9 @@ from manager import celery_periodic
 
 # ------------------------------------------Instantiation of the environment-------------------------------------------
 migrate_flask = Migrate()
-auth = HTTPBasicAuth()
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme="Bearer")
+auth = MultiAuth(basic_auth, token_auth)
 sql_db = SQLAlchemy()
 
 environment_phase_dict = {
@@ -20,11 +24,13 @@ environment_phase_dict = {
 
 
 # ------------------------------------------Builder of the application-------------------------------------------------
-def create_app():
-    """Builder of the Flask application with every submodules and dependencies"""
+def create_app(environment: str = None):
+    """Builder of the Flask application with every submodules and dependencies, configured for the given environment
+    phase or for the FLASK_ENV one by default
+    """
     app = Flask(__name__, instance_relative_config=False)
 
-    app.config.from_object(environment_phase_dict.get("testing", "config.DevConfig"))
+    app.config.from_object(environment_phase_dict.get(environment or os.environ.get("FLASK_ENV"), "config.DevConfig"))
 
     sql_db.init_app(app)
     migrate_flask.init_app(app, sql_db)
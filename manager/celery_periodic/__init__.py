@@ -28,3 +28,14 @@ def make_celery(main_flask_app):
     celery.Task = ContextTask
 
     return celery
+
+
+def worker_argv(queue: str, config, extra_args=()) -> list:
+    """The command line of celery.worker_main for a worker consuming a single queue with its WORKER_POOL pool of
+    WORKER_CONCURRENCY processes or threads, the first argument being the name of the program
+    """
+    concurrency = config.get("WORKER_CONCURRENCY").get(queue)
+    if concurrency is None:
+        raise ValueError(f"Unknown queue '{queue}', expected one of {sorted(config.get('WORKER_CONCURRENCY'))}")
+    return ["worker", "--queues", queue, "--pool", config.get("WORKER_POOL").get(queue, "prefork"),
+            "--concurrency", str(concurrency), "--hostname", f"{queue}@%h", *extra_args]
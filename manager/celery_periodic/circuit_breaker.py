@@ -0,0 +1,77 @@
+import random
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import and_, or_
+
+from manager import sql_db
+from manager.db_model import Feed
+
+# States of the circuit breaker of a feed: scraped as usual, skipped until its retry_at, or probed by a single scrape
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def backoff(failure_count: int, config) -> timedelta:
+    """The time a feed is skipped after failing failure_count times in a row, doubling with each failure past the
+    threshold of the breaker, capped, and spread over its upper half to keep the probes of many feeds apart
+    """
+    exponent = max(failure_count - config.get("SCRAPE_BREAKER_THRESHOLD"), 0)
+    delay = min(config.get("SCRAPE_BREAKER_BACKOFF") * 2 ** min(exponent, 32), config.get("SCRAPE_BREAKER_MAX_BACKOFF"))
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def is_closed(feed: Feed) -> bool:
+    return feed.breaker_state == CLOSED
+
+
+def acquire_probe(feed_id, config, now=None) -> bool:
+    """Turns the breaker of a feed whose backoff is over to half open, so that a single scrape probes the feed
+
+    A probe that never reports back, e.g. because its worker died, is given up after SCRAPE_BREAKER_PROBE_TIMEOUT and
+    the feed can be probed again.
+
+    :return Whether the caller got the probe and has to scrape the feed
+    """
+    now = now or datetime.now(pytz.utc)
+    backoff_over = or_(Feed.retry_at.is_(None), Feed.retry_at <= now)
+    probe = sql_db.session.execute(
+        Feed.__table__.update()
+        .where(and_(Feed.id == feed_id, Feed.breaker_state != CLOSED, backoff_over))
+        .values(breaker_state=HALF_OPEN,
+                retry_at=now + timedelta(seconds=config.get("SCRAPE_BREAKER_PROBE_TIMEOUT")))
+        .returning(Feed.id))
+    acquired = probe.first() is not None
+    sql_db.session.commit()
+    return acquired
+
+
+def record_success(feed_id):
+    """Closes the breaker of a feed that was scraped successfully, in the current transaction"""
+    Feed.query.filter(Feed.id == feed_id, or_(Feed.breaker_state != CLOSED, Feed.failure_count != 0)) \
+        .update({Feed.breaker_state: CLOSED, Feed.failure_count: 0, Feed.retry_at: None, Feed.last_error: None},
+                synchronize_session=False)
+
+
+def record_failure(feed_id, error, config, now=None):
+    """Counts a failed scrape of a feed, in the current transaction, and opens its breaker when it failed
+    SCRAPE_BREAKER_THRESHOLD times in a row or when it was a probe
+
+    :param feed_id: The feed that failed
+    :param error: The error of the scrape
+    :param config: The configuration of the application, with the SCRAPE_BREAKER_* settings
+    """
+    now = now or datetime.now(pytz.utc)
+    failed = sql_db.session.execute(
+        Feed.__table__.update()
+        .where(Feed.id == feed_id)
+        .values(failure_count=Feed.failure_count + 1, last_error=repr(error)[:1000])
+        .returning(Feed.failure_count, Feed.breaker_state)).first()
+    if failed is None:
+        return
+    failure_count, state = failed
+    if state == HALF_OPEN or failure_count >= config.get("SCRAPE_BREAKER_THRESHOLD"):
+        Feed.query.filter(Feed.id == feed_id) \
+            .update({Feed.breaker_state: OPEN, Feed.retry_at: now + backoff(failure_count, config)},
+                    synchronize_session=False)
@@ -0,0 +1,218 @@
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytz
+from lxml import etree
+
+# Size of the chunks of the feed documents streamed into the parsers while they are downloaded
+CHUNK_SIZE = 64 * 1024
+
+
+class DocumentTooLarge(ValueError):
+    """Raised when a downloaded feed document grows past the maximum size allowed"""
+
+
+def item_key(guid, link, title) -> str:
+    """The stable key of a feed item: its RSS guid, or a hash of its link and title when it has none"""
+    if guid and guid.strip():
+        return guid.strip()
+    return hashlib.md5(f"{link or ''}\n{title or ''}".encode("utf-8")).hexdigest()
+
+
+def parse_published_time(value: str, time_format: str) -> datetime:
+    """Parses the publication time of a feed item, times without a timezone are in UTC"""
+    date = datetime.strptime(value.strip(), time_format)
+    return date.replace(microsecond=0, tzinfo=date.tzinfo or pytz.utc)
+
+
+RFC_822_TIME = re.compile(r"(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{2}|\d{4})"
+                          r"\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([+-]\d{4}|[A-Za-z]+)?\s*$")
+MONTHS = {month: number for number, month in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), start=1)}
+# Offsets in minutes of the zone names allowed by RFC 822, the unknown ones are in UTC like times without a zone
+ZONES = {"UT": 0, "UTC": 0, "GMT": 0, "Z": 0, "EST": -300, "EDT": -240, "CST": -360, "CDT": -300, "MST": -420,
+         "MDT": -360, "PST": -480, "PDT": -420}
+
+
+def parse_rfc_822_time(value: str) -> datetime:
+    """Parses an RFC 822 publication time, e.g. 'Tue, 10 Nov 2020 10:00:00 +0100', the format of RSS pubDate"""
+    match = RFC_822_TIME.match(value)
+    if match is None or match.group(2).lower() not in MONTHS:
+        raise ValueError(f"'{value}' is not an RFC 822 time")
+    day, month, year, hour, minute, second, zone = match.groups()
+    year = int(year)
+    if year < 100:
+        year += 2000 if year < 50 else 1900
+    if zone is None or zone.isalpha():
+        offset = ZONES.get(zone.upper(), 0) if zone else 0
+    else:
+        offset = (-1 if zone[0] == "-" else 1) * (int(zone[1:3]) * 60 + int(zone[3:5]))
+    return datetime(year, MONTHS[month.lower()], int(day), int(hour), int(minute), int(second or 0),
+                    tzinfo=pytz.utc if offset == 0 else timezone(timedelta(minutes=offset)))
+
+
+def parse_iso_8601_time(value: str) -> datetime:
+    """Parses an ISO 8601 publication time, e.g. '2020-11-10T10:00:00+01:00', the format of Atom and RDF dates"""
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    date = datetime.fromisoformat(value)
+    return date.replace(microsecond=0, tzinfo=date.tzinfo or pytz.utc)
+
+
+class PublishedTimeParser:
+    """Parses the publication times of the items of a single feed, picking the fastest way to do it once per feed
+
+    The first time parsed picks the RFC 822 or ISO 8601 fast path that reads it like the time_format of the feed, or
+    that time_format when none does. When the feed has no time_format, or a time does not match the way picked, the
+    format is detected again and the new way is kept for the next times.
+    """
+
+    def __init__(self, time_format=None):
+        self.time_format = time_format
+        self.parse = None
+
+    def __call__(self, value: str) -> datetime:
+        value = value.strip()
+        if self.parse is not None:
+            try:
+                return self.parse(value)
+            except ValueError:
+                pass
+        self.parse, date = self.detect(value)
+        return date
+
+    def parse_with_format(self, value: str) -> datetime:
+        return parse_published_time(value, self.time_format)
+
+    def detect(self, value: str) -> tuple:
+        """Finds the way to parse a publication time
+
+        :return The function parsing the time and the time parsed
+        :raises ValueError: When the time is neither RFC 822, ISO 8601 nor in the time_format of the feed
+        """
+        expected = None
+        if self.time_format:
+            try:
+                expected = self.parse_with_format(value)
+            except ValueError:
+                pass
+        for parse in (parse_rfc_822_time, parse_iso_8601_time):
+            try:
+                date = parse(value)
+            except ValueError:
+                continue
+            if expected is None or date == expected:
+                return parse, date
+        if expected is None:
+            raise ValueError(f"Unknown format of the publication time '{value}'")
+        return self.parse_with_format, expected
+
+
+class DocumentBuffer:
+    """Receives a feed document chunk by chunk while it is downloaded and keeps it in memory, up to a maximum size"""
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = list()
+
+    def feed(self, chunk: bytes) -> bool:
+        """Receives the next chunk of the document
+
+        :return Whether the rest of the document is needed
+        :raises DocumentTooLarge: When the document is larger than the maximum size
+        """
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise DocumentTooLarge(f"Feed document larger than {self.max_size} bytes")
+        self.chunks.append(chunk)
+        return True
+
+    @property
+    def content(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+class StreamingFeedParser(DocumentBuffer):
+    """Incremental RSS parser extracting the new items of a feed document while it is downloaded
+
+    Each <item> is turned into a dict of its key, title, link, description and published time as soon as it is complete,
+    and then dropped from the XML tree. Items not newer than newer_than are skipped, and on feeds sorted by date the
+    first one of them ends the parsing: the rest of the document is not even downloaded. The elements are matched
+    whatever their namespace, like the ones of RSS 1.0 (RDF) documents, whose items are dated by their <dc:date>.
+
+    The <ttl> and <skipHours> scheduling hints of the channel are kept as well, when they come before the end of the
+    parsing. The document is also buffered, so that a malformed one can be parsed again by a forgiving parser.
+    """
+
+    def __init__(self, time_format=None, newer_than=None, sorted_by_date=False, max_size=None):
+        super().__init__(max_size)
+        self.published_time = PublishedTimeParser(time_format)
+        self.newer_than = newer_than
+        self.sorted_by_date = sorted_by_date
+        self.items = list()
+        self.ttl = None
+        self.skip_hours = None
+        self.malformed = False
+        self.complete = False
+        self.parser = etree.XMLPullParser(events=("end",), tag=("{*}item", "{*}ttl", "{*}skipHours"),
+                                          resolve_entities=False, no_network=True)
+
+    def feed(self, chunk: bytes) -> bool:
+        super().feed(chunk)
+        if self.malformed:
+            return True
+        try:
+            self.parser.feed(chunk)
+        except etree.XMLSyntaxError:
+            self.malformed = True
+            return True
+        for _, element in self.parser.read_events():
+            if etree.QName(element).localname != "item":
+                self.extract_hint(element)
+                continue
+            item = self.extract_item(element)
+            # Keeping the tree as small as a single item
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+            if self.newer_than is None or self.newer_than < item["published"]:
+                self.items.append(item)
+            elif self.sorted_by_date:
+                self.complete = True
+                return False
+        return True
+
+    def close(self) -> list:
+        """Ends the parsing once the document is fully received, or once the parser asked to stop
+
+        :return The new items found, check malformed before using them
+        """
+        if not self.complete and not self.malformed:
+            try:
+                self.parser.close()
+            except etree.XMLSyntaxError:
+                self.malformed = True
+        return self.items
+
+    def extract_hint(self, element):
+        try:
+            if etree.QName(element).localname == "ttl":
+                self.ttl = int(element.text.strip())
+            else:
+                self.skip_hours = sorted({int(hour.text.strip()) % 24 for hour in element.iter("{*}hour")})
+        except (AttributeError, ValueError):
+            pass
+
+    def extract_item(self, element) -> dict:
+        title = element.findtext("{*}title")
+        link = element.findtext("{*}link")
+        return {
+            "guid": item_key(element.findtext("{*}guid"), link, title),
+            "title": title,
+            "link": link,
+            "description": element.findtext("{*}description"),
+            "published": self.published_time(element.findtext("{*}pubDate") or element.findtext("{*}date")),
+        }
@@ -0,0 +1,87 @@
+import asyncio
+from collections import namedtuple
+
+import aiohttp
+
+from manager.celery_periodic.feed_parser import CHUNK_SIZE, DocumentBuffer, DocumentTooLarge
+
+# Outcome of the download of a feed document: the body was streamed into the sink, error is set when the download
+# failed, along with the status of the response when the origin answered with an error status
+FetchedDocument = namedtuple("FetchedDocument", ["url", "status_code", "sink", "headers", "error"])
+
+
+def is_success(status_code: int) -> bool:
+    """Whether the origin of a feed answered with its document, or with 304 Not Modified"""
+    return 200 <= status_code < 300 or status_code == 304
+
+
+class FeedFetcher:
+    """Downloads many feed documents at once on an asyncio event loop
+
+    The connections are pooled and capped globally and per host, and each download is bounded by a connect and a read
+    timeout. A feed that cannot be downloaded is reported in its own FetchedDocument without affecting the others.
+
+    The bodies are streamed chunk by chunk into sinks, objects whose feed(chunk) method returns whether the rest of
+    the document is needed, like the StreamingFeedParser of a Scraper. By default a DocumentBuffer collects them.
+    """
+
+    def __init__(self, concurrency=20, per_host_concurrency=4, connect_timeout=5, read_timeout=30, max_size=None):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a FeedFetcher with the SCRAPE_* settings of the application"""
+        return cls(concurrency=config.get("SCRAPE_CONCURRENCY"),
+                   per_host_concurrency=config.get("SCRAPE_PER_HOST_CONCURRENCY"),
+                   connect_timeout=config.get("SCRAPE_CONNECT_TIMEOUT"),
+                   read_timeout=config.get("SCRAPE_READ_TIMEOUT"),
+                   max_size=config.get("SCRAPE_MAX_DOCUMENT_SIZE"))
+
+    async def fetch_as_completed(self, requests: dict, sinks=None, before_fetch=None):
+        """Downloads every feed, yielding each FetchedDocument as soon as it is done or failed
+
+        :param requests: The headers to send to each feed url, e.g. the conditional headers of its Scraper
+        :param sinks: The sink each feed url is streamed into, a DocumentBuffer for the urls without one
+        :param before_fetch: A coroutine function awaited with the url of each feed right before its download starts,
+            at most concurrency downloads being started at once. The error it raises fails the download.
+        """
+        sinks = sinks or dict()
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(session, url, headers):
+            sink = sinks.get(url) or DocumentBuffer(self.max_size)
+            async with slots:
+                if before_fetch is not None:
+                    try:
+                        await before_fetch(url)
+                    except Exception as err:
+                        return FetchedDocument(url, None, sink, dict(), err)
+                return await self.fetch(session, url, headers, sink)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host_concurrency)
+        # Waiting for a free connection of the pool does not count in the timeouts
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            for fetched in asyncio.as_completed([fetch(session, url, headers) for url, headers in requests.items()]):
+                yield await fetched
+
+    async def fetch(self, session, url, headers, sink) -> FetchedDocument:
+        try:
+            async with session.get(url, headers=headers) as response:
+                if not is_success(response.status):
+                    # The body of an error page is not a feed document, it is left undownloaded
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status, message=response.reason)
+                    return FetchedDocument(url, response.status, sink, response.headers.copy(), error)
+                if response.status != 304:
+                    # Leaving the response before its end closes the connection instead of downloading the rest
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if not sink.feed(chunk):
+                            break
+                return FetchedDocument(url, response.status, sink, response.headers.copy(), None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, DocumentTooLarge) as err:
+            return FetchedDocument(url, None, sink, dict(), err)
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# The Session of the current process, by process id: a child forked by the Celery worker builds its own instead of
+# sharing the connections of its parent
+sessions = dict()
+sessions_lock = threading.Lock()
+
+
+def build_session(pool_connections: int, pool_maxsize: int) -> requests.Session:
+    """Builds a Session keeping connections alive, at most pool_maxsize per host for pool_connections hosts
+
+    Requests to a host whose connections are all busy wait for one of them instead of opening a new one.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def get_session(config) -> requests.Session:
+    """Returns the pooled Session shared by every scraper fetch of the current process, built on first use
+
+    :param config: The configuration of the application, with the SCRAPE_* pool settings
+    """
+    pid = os.getpid()
+    session = sessions.get(pid)
+    if session is None:
+        with sessions_lock:
+            session = sessions.get(pid)
+            if session is None:
+                sessions.clear()
+                session = sessions[pid] = build_session(config.get("SCRAPE_CONCURRENCY"),
+                                                        config.get("SCRAPE_PER_HOST_CONCURRENCY"))
+    return session
+
+
+def pool_stats() -> dict:
+    """Statistics of the connection pool of each host the Session of the current process connected to
+
+    :return For each host, the connections opened, the requests sent and the connections idle in the pool
+    """
+    session = sessions.get(os.getpid())
+    if session is None:
+        return dict()
+
+    stats = dict()
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': sum(1 for connection in list(pool.pool.queue) if connection) if pool.pool else 0,
+            }
+    return stats
@@ -0,0 +1,341 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from celery.utils.log import get_task_logger
+from sqlalchemy.exc import SQLAlchemyError
+
+from manager import sql_db
+from manager.celery_periodic import circuit_breaker, scrape_lock, scrape_runs
+from manager.celery_periodic.feed_parser import CHUNK_SIZE, StreamingFeedParser
+from manager.celery_periodic.fetcher import FeedFetcher
+from manager.celery_periodic.scraper import remember_items
+
+logger = get_task_logger(__name__)
+
+# A feed scraped by the pipeline, along with the scrape run and the lease its scrape holds
+FeedJob = namedtuple("FeedJob", ["scraper", "feed_id", "url", "run_id", "lease"])
+# What a parser process sends back: the items extracted from a document and its scheduling hints, no items when the
+# document is not well formed XML, and the time spent parsing it
+ParsedDocument = namedtuple("ParsedDocument", ["items", "ttl", "skip_hours", "malformed", "seconds"])
+
+# Ends the stream of documents of a stage
+DONE = object()
+
+# The attributes of a Feed that Scraper.accept sets out of its last document, saved along with its items
+ACCEPTED_ATTRIBUTES = ("etag", "last_modified", "ttl", "skip_hours", "next_due")
+
+# The parser processes of the current process, by process id, like the sessions of http_session
+pools = dict()
+pools_lock = threading.Lock()
+
+
+def get_pool(processes: int):
+    """Returns the parser processes of the current process, started on first use
+
+    A daemonic process, like the children of the prefork pool of the Celery workers, is not allowed to start any: it
+    parses in a thread as well.
+
+    :param processes: The number of parser processes, 0 to parse in a thread of the current process
+    :return The ProcessPoolExecutor, None without parser processes
+    """
+    if not processes:
+        return None
+    if multiprocessing.current_process().daemon:
+        logger.warning(f"Daemonic process {os.getpid()} cannot start parser processes, parsing in a thread")
+        return None
+    pid = os.getpid()
+    pool = pools.get(pid)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(pid)
+            if pool is None:
+                pools.clear()
+                # Started from a fork server, the parser processes do not inherit the threads of the worker and the
+                # locks they hold
+                pool = pools[pid] = ProcessPoolExecutor(max_workers=processes,
+                                                        mp_context=multiprocessing.get_context("forkserver"))
+                pool.submit(int).result()
+    return pool
+
+
+def parse_content(content: bytes, time_format=None, newer_than=None, sorted_by_date=False) -> ParsedDocument:
+    """Parses a whole feed document, in a parser process: the parsing stops at the first old item of a feed sorted
+    by date, like when the document is streamed into a StreamingFeedParser
+    """
+    start = time.perf_counter()
+    parser = StreamingFeedParser(time_format, newer_than=newer_than, sorted_by_date=sorted_by_date)
+    for offset in range(0, len(content), CHUNK_SIZE):
+        if not parser.feed(content[offset:offset + CHUNK_SIZE]):
+            break
+    items = parser.close()
+    if parser.malformed:
+        return ParsedDocument(None, None, None, True, time.perf_counter() - start)
+    return ParsedDocument(items, parser.ttl, parser.skip_hours, False, time.perf_counter() - start)
+
+
+class StageStats:
+    """Counts the documents and items a stage of the pipeline got through, and the size of the queue it reads"""
+
+    def __init__(self, backlog=None):
+        self.backlog = backlog
+        self.documents = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_backlog = 0
+
+    def record(self, documents=1, items=0, seconds=0.0):
+        self.documents += documents
+        self.items += items
+        self.busy_seconds += seconds
+        if self.backlog is not None:
+            self.max_backlog = max(self.max_backlog, self.backlog.qsize())
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            'documents': self.documents,
+            'items': self.items,
+            'documents_per_second': round(self.documents / elapsed, 1) if elapsed else 0.0,
+            'items_per_second': round(self.items / elapsed, 1) if elapsed else 0.0,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'backlog': self.backlog.qsize() if self.backlog is not None else 0,
+            'max_backlog': self.max_backlog
+        }
+
+
+class ScrapePipeline:
+    """Scrapes a batch of feeds in three stages connected by bounded queues, so that none of them waits for the others
+
+    - fetch: a thread downloads every feed on an asyncio event loop, see FeedFetcher, and queues each document as soon
+      as it is downloaded. The lease of each feed is renewed when its download starts, a feed whose lease was taken
+      over by another scrape meanwhile is not downloaded.
+    - parse: a thread hands the documents over to SCRAPE_PARSE_PROCESSES parser processes, or parses them itself
+      without any
+    - persist: the calling thread stores the items of the parsed documents of many feeds at once, in a transaction
+      committed every SCRAPE_PERSIST_BATCH_SIZE items or SCRAPE_PERSIST_BATCH_INTERVAL seconds, along with the outcome
+      of their scrape runs and circuit breakers
+
+    A full queue makes the stage feeding it wait, so that at most SCRAPE_PIPELINE_QUEUE_SIZE documents wait for each
+    stage. Only the persist stage uses the database session, the leases are renewed on connections of their own.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.engine = sql_db.engine
+        self.fetcher = FeedFetcher.from_config(config)
+        self.parse_queue = queue.Queue(maxsize=config.get("SCRAPE_PIPELINE_QUEUE_SIZE"))
+        self.persist_queue = queue.Queue(maxsize=config.get("SCRAPE_PIPELINE_QUEUE_SIZE"))
+        self.stats = {"fetch": StageStats(), "parse": StageStats(self.parse_queue),
+                      "persist": StageStats(self.persist_queue)}
+        self.transactions = 0
+        self.stopped = threading.Event()
+
+    def run(self, jobs: list) -> dict:
+        """Scrapes the feeds, reporting the outcome of each one to its run and its circuit breaker and releasing its
+        lease
+
+        :param jobs: The FeedJob of each feed
+        :return The throughput and the backlog of each stage
+        """
+        start = time.perf_counter()
+        if jobs:
+            pool = get_pool(self.config.get("SCRAPE_PARSE_PROCESSES"))
+            requests = {job.url: job.scraper.conditional_headers() for job in jobs}
+            parse_args = {job.url: (job.scraper.feed.time_format, job.scraper.newer_than(),
+                                    job.scraper.feed.sorted_by_date) for job in jobs}
+            leases = {job.url: job.lease for job in jobs}
+            threads = [threading.Thread(target=self.fetch_stage, args=(requests, leases), daemon=True),
+                       threading.Thread(target=self.parse_stage, args=(parse_args, pool), daemon=True)]
+            for thread in threads:
+                thread.start()
+            try:
+                self.persist_stage({job.url: job for job in jobs})
+            finally:
+                self.stopped.set()
+                for thread in threads:
+                    thread.join()
+
+        elapsed = time.perf_counter() - start
+        report = {
+            'feeds': len(jobs),
+            'seconds': round(elapsed, 3),
+            'transactions': self.transactions,
+            'stages': {name: stats.report(elapsed) for name, stats in self.stats.items()}
+        }
+        logger.info(f"Scraped {len(jobs)} feeds in {elapsed:.3f}s: {report['stages']}")
+        return report
+
+    def put(self, stage_queue: queue.Queue, entry):
+        """Queues an entry for the next stage, waiting for room unless the pipeline was stopped"""
+        while not self.stopped.is_set():
+            try:
+                stage_queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch_stage(self, requests: dict, leases: dict):
+        stats = self.stats["fetch"]
+
+        async def fetch_all():
+            loop = asyncio.get_running_loop()
+
+            async def renew_lease(url):
+                # The lease taken when the batch was picked up lasts from the download of the feed on
+                if not await loop.run_in_executor(None, leases[url].renew, self.config, None, self.engine):
+                    raise scrape_lock.LeaseLost(f"The lease of feed '{url}' was taken over by another scrape")
+
+            async for document in self.fetcher.fetch_as_completed(requests, before_fetch=renew_lease):
+                stats.record()
+                # Waiting for room in the queue off the event loop, the other downloads go on meanwhile
+                await loop.run_in_executor(None, self.put, self.parse_queue, document)
+                if self.stopped.is_set():
+                    break
+
+        start = time.perf_counter()
+        try:
+            asyncio.run(fetch_all())
+        except Exception as err:
+            logger.error(f"Fetching the feeds failed: {err!r}")
+        finally:
+            stats.busy_seconds = time.perf_counter() - start
+            self.put(self.parse_queue, DONE)
+
+    def parse_stage(self, parse_args: dict, pool):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    document = self.parse_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if document is DONE:
+                    break
+                parsed = None
+                if document.error is None and document.status_code != 304:
+                    content = document.sink.content
+                    if pool is not None:
+                        parsed = pool.submit(parse_content, content, *parse_args[document.url])
+                    else:
+                        parsed = Future()
+                        try:
+                            parsed.set_result(parse_content(content, *parse_args[document.url]))
+                        except Exception as err:
+                            parsed.set_exception(err)
+                self.put(self.persist_queue, (document, parsed))
+        finally:
+            self.put(self.persist_queue, DONE)
+
+    def persist_stage(self, jobs: dict):
+        batch = list()
+        batch_items = 0
+        batch_deadline = None
+        while True:
+            timeout = None if batch_deadline is None else max(batch_deadline - time.perf_counter(), 0)
+            try:
+                entry = self.persist_queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+            if entry is DONE:
+                break
+            if entry is not None:
+                document, parsed = entry
+                job = jobs.pop(document.url)
+                outcome = self.take_in(job, document, parsed)
+                batch.append((job, outcome))
+                batch_items += 0 if isinstance(outcome, Exception) else len(outcome)
+                if batch_deadline is None:
+                    batch_deadline = time.perf_counter() + self.config.get("SCRAPE_PERSIST_BATCH_INTERVAL")
+            if entry is None or batch_items >= self.config.get("SCRAPE_PERSIST_BATCH_SIZE"):
+                self.flush(batch)
+                batch, batch_items, batch_deadline = list(), 0, None
+
+        # The feeds whose download never came back, e.g. because the fetch stage failed
+        for job in jobs.values():
+            batch.append((job, RuntimeError(f"Feed '{job.url}' was not fetched")))
+        self.flush(batch)
+
+    def take_in(self, job: FeedJob, document, parsed):
+        """Builds the new FeedItem objects of a fetched and parsed document
+
+        :return The FeedItem objects, or the error of the scrape of the feed
+        """
+        try:
+            if isinstance(document.error, scrape_lock.LeaseLost):
+                raise document.error
+            if document.status_code is None:
+                raise ConnectionError(f"Connection for url '{document.url}' not available: {document.error!r}")
+            if parsed is None:
+                return job.scraper.parse_document(document.status_code, None, document.headers)
+            result = parsed.result()
+            self.stats["parse"].record(items=len(result.items or ()), seconds=result.seconds)
+            if result.malformed:
+                items = job.scraper.parse_with_beautiful_soup(document.sink.content)
+            else:
+                items = job.scraper.build_items(result.items)
+            return job.scraper.accept(items, document.headers, result.ttl, result.skip_hours)
+        except Exception as err:
+            logger.error(f"Scraping feed {job.url} failed: {err!r}")
+            return err
+
+    def flush(self, batch: list):
+        """Stores the items of several feeds in a single transaction, or feed by feed when it fails"""
+        if not batch:
+            return
+        start = time.perf_counter()
+        # A rollback expires the Feed objects, dropping what accept set on them, which is set again feed by feed
+        accepted = {job.feed_id: {name: getattr(job.scraper.feed, name) for name in ACCEPTED_ATTRIBUTES}
+                    for job, outcome in batch if not isinstance(outcome, Exception)}
+        try:
+            stored = [(job, job.scraper.persist(outcome, commit=False)) for job, outcome in batch
+                      if not isinstance(outcome, Exception)]
+            self.report_outcomes(batch)
+            sql_db.session.commit()
+            self.transactions += 1
+        except SQLAlchemyError as err:
+            logger.error(f"Storing the items of {len(batch)} feeds at once failed, storing them one by one: {err!r}")
+            sql_db.session.rollback()
+            stored = self.flush_one_by_one(batch, accepted)
+
+        for job, keys in stored:
+            remember_items(job.feed_id, keys)
+        scrape_lock.release_all([job.lease for job, _ in batch])
+        self.stats["persist"].record(documents=len(batch), items=sum(len(keys) for _, keys in stored),
+                                     seconds=time.perf_counter() - start)
+
+    def flush_one_by_one(self, batch: list, accepted: dict) -> list:
+        """Stores the items of each feed of a batch in a transaction of its own, along with the attributes accept set
+        on its Feed before the rollback of the batch
+        """
+        stored = list()
+        for job, outcome in batch:
+            try:
+                if not isinstance(outcome, Exception):
+                    for name, value in accepted[job.feed_id].items():
+                        setattr(job.scraper.feed, name, value)
+                    stored.append((job, job.scraper.persist(outcome, commit=False)))
+                self.report_outcomes([(job, outcome)])
+                sql_db.session.commit()
+            except SQLAlchemyError as err:
+                sql_db.session.rollback()
+                stored = [(stored_job, keys) for stored_job, keys in stored if stored_job is not job]
+                self.report_outcomes([(job, err)])
+                sql_db.session.commit()
+            self.transactions += 1
+        return stored
+
+    def report_outcomes(self, batch: list):
+        for job, outcome in batch:
+            if isinstance(outcome, scrape_lock.LeaseLost):
+                # The feed itself did not fail, the scrape holding its lease now reports to its breaker
+                scrape_runs.finish_run(job.run_id, outcome, lease=job.lease)
+            elif isinstance(outcome, Exception):
+                circuit_breaker.record_failure(job.feed_id, outcome, self.config)
+                scrape_runs.finish_run(job.run_id, outcome, lease=job.lease)
+            else:
+                circuit_breaker.record_success(job.feed_id)
+                scrape_runs.finish_run(job.run_id, lease=job.lease)
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import pytz
+
+# Number of the most recent items of a feed its publish rate is estimated from
+RECENT_ITEMS = 20
+
+
+def cache_lifetime(headers, now: datetime):
+    """The number of seconds a feed document stays fresh according to its Cache-Control or Expires header
+
+    :param headers: The headers of the response
+    :param now: The current time
+    :return The lifetime in seconds, None when the response does not tell
+    """
+    directives = dict()
+    for directive in (headers.get("Cache-Control") or "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+    if "no-cache" in directives or "no-store" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return max(int(directives["max-age"]), 0)
+        except ValueError:
+            return 0
+
+    expires = headers.get("Expires")
+    if expires is None:
+        return None
+    try:
+        expires = parsedate_to_datetime(expires)
+    except (TypeError, ValueError):
+        # An invalid Expires means already expired
+        return 0
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=pytz.utc)
+    return max((expires - now).total_seconds(), 0)
+
+
+def publish_interval(published_times: list, now: datetime):
+    """Half the average time between the recent items of a feed, counting the time since the newest one
+
+    Polling twice per expected item keeps the delay of the new items low without fetching in between, and a feed that
+    went quiet is polled less and less often.
+
+    :param published_times: The publication times of the most recent items of the feed
+    :param now: The current time
+    :return The interval in seconds, None for a feed without items
+    """
+    if not published_times:
+        return None
+    oldest = min(published_times)
+    return max((now - oldest).total_seconds(), 0) / len(published_times) / 2
+
+
+def next_due(now: datetime, interval, min_interval: int, max_interval: int, lifetime=None, ttl=None,
+             skip_hours=()) -> datetime:
+    """The time a feed is due to be scraped again
+
+    The interval is never shorter than the lifetime of the last document nor than the RSS <ttl> of the feed, and it is
+    bounded by min_interval and max_interval. The result is then moved out of the RSS <skipHours> of the feed.
+
+    :param now: The time of the scrape
+    :param interval: The interval estimated from the publish rate of the feed, None for min_interval
+    :param min_interval: The shortest interval in seconds
+    :param max_interval: The longest interval in seconds, even when the hints of the feed ask for more
+    :param lifetime: The Cache-Control / Expires lifetime in seconds of the last document, None when unknown
+    :param ttl: The RSS <ttl> of the feed in minutes, None when unknown
+    :param skip_hours: The hours of the day, in GMT, the feed asks not to be scraped at
+    """
+    seconds = max(interval or 0, lifetime or 0, (ttl or 0) * 60, min_interval)
+    due = now + timedelta(seconds=min(seconds, max_interval))
+
+    skip_hours = set(skip_hours or ())
+    if len(skip_hours & set(range(24))) < 24:
+        while due.astimezone(pytz.utc).hour in skip_hours:
+            due = due.astimezone(pytz.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return due
@@ -0,0 +1,146 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+from celery.utils.log import get_task_logger
+from sqlalchemy import and_, func, or_
+
+from manager import sql_db
+from manager.db_model import Feed, ScrapeRun
+
+logger = get_task_logger(__name__)
+
+
+class LeaseLost(Exception):
+    """The lease of a feed expired and was taken over by another scrape before this one got to fetch the feed"""
+
+
+def update_lease(feed_id, owner: str, config, renew=False, now=None, engine=None) -> bool:
+    """Leases a feed to an owner for SCRAPE_LOCK_LEASE seconds from now, in a transaction of its own on a connection
+    apart from the session, so that the unit of work of the caller is neither committed nor rolled back
+
+    :param renew: Whether the owner extends the lease it holds, instead of taking a free or expired one
+    :param engine: The engine to connect with, the one of the application by default
+    :return Whether the owner holds the lease
+    """
+    now = now or datetime.now(pytz.utc)
+    if renew:
+        condition = Feed.lease_owner == owner
+    else:
+        condition = or_(Feed.lease_owner.is_(None), Feed.lease_expires_at <= now)
+    with (engine or sql_db.engine).begin() as connection:
+        leased = connection.execute(
+            Feed.__table__.update()
+            .where(and_(Feed.id == feed_id, condition))
+            .values(lease_owner=owner, lease_expires_at=now + timedelta(seconds=config.get("SCRAPE_LOCK_LEASE")))
+            .returning(Feed.id))
+        return leased.first() is not None
+
+
+def try_acquire(feed_id, owner: str, config, now=None) -> bool:
+    """Takes the lease of a feed when nobody holds it or when its holder let it expire, e.g. because its worker died
+
+    :param feed_id: The feed to scrape
+    :param owner: The token of the caller, only the holder of the lease can release it
+    :param config: The configuration of the application, with the SCRAPE_LOCK_LEASE setting
+    :return Whether the caller got the lease
+    """
+    return update_lease(feed_id, owner, config, now=now)
+
+
+def acquire(feed_id, config, wait=False):
+    """Takes the lease every scrape of a feed holds while it fetches and persists the feed
+
+    :param feed_id: The feed to scrape
+    :param config: The configuration of the application, with the SCRAPE_LOCK_* settings
+    :param wait: Whether to wait up to SCRAPE_LOCK_WAIT_TIMEOUT for the current holder to release the lease, instead
+        of giving up right away
+    :return The Lease to release once the scrape is over, None when another scrape holds it
+    """
+    owner = uuid.uuid4().hex
+    start = time.perf_counter()
+    deadline = start + (config.get("SCRAPE_LOCK_WAIT_TIMEOUT") if wait else 0)
+    while not try_acquire(feed_id, owner, config):
+        if time.perf_counter() >= deadline:
+            logger.info(f"Feed '{feed_id}' is being scraped by another task, skipping it")
+            return None
+        time.sleep(config.get("SCRAPE_LOCK_POLL_INTERVAL"))
+
+    waited = time.perf_counter() - start
+    logger.debug(f"Lease of feed '{feed_id}' acquired after {waited:.3f}s")
+    return Lease(feed_id, owner, waited)
+
+
+class Lease:
+    """The lease of a feed held by the current process, whose wait and hold times are stored on the scrape run it is
+    taken for, see scrape_runs.finish_run
+    """
+
+    def __init__(self, feed_id, owner: str, wait_seconds=0.0):
+        self.feed_id = feed_id
+        self.owner = owner
+        self.wait_seconds = wait_seconds
+        self.acquired_at = time.perf_counter()
+
+    def hold_seconds(self) -> float:
+        return time.perf_counter() - self.acquired_at
+
+    def renew(self, config, now=None, engine=None) -> bool:
+        """Extends the lease to SCRAPE_LOCK_LEASE seconds from now, unless it expired and was taken over meanwhile
+
+        :param engine: The engine to connect with, needed outside of the application context, e.g. in the fetch stage
+            of a ScrapePipeline
+        :return Whether the lease is still held
+        """
+        return update_lease(self.feed_id, self.owner, config, renew=True, now=now, engine=engine)
+
+    def release(self):
+        """Gives the lease back, unless it expired and was taken over meanwhile, and commits"""
+        Feed.query.filter(Feed.id == self.feed_id, Feed.lease_owner == self.owner) \
+            .update({Feed.lease_owner: None, Feed.lease_expires_at: None}, synchronize_session=False)
+        sql_db.session.commit()
+        self.released()
+
+    def released(self):
+        logger.debug(f"Lease of feed '{self.feed_id}' released after {self.hold_seconds():.3f}s")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            sql_db.session.rollback()
+        self.release()
+
+
+def release_all(leases: list):
+    """Gives several leases back at once, in a single statement, and commits"""
+    if not leases:
+        return
+    Feed.query.filter(Feed.lease_owner.in_([lease.owner for lease in leases])) \
+        .update({Feed.lease_owner: None, Feed.lease_expires_at: None}, synchronize_session=False)
+    sql_db.session.commit()
+    for lease in leases:
+        lease.released()
+
+
+def lock_stats(config, now=None) -> dict:
+    """Reports the number of leases held by the scrape runs of every worker that finished in the last
+    SCRAPE_LOCK_STATS_WINDOW seconds, with their average and max wait and hold times in seconds
+    """
+    since = (now or datetime.now(pytz.utc)) - timedelta(seconds=config.get("SCRAPE_LOCK_STATS_WINDOW"))
+    stats = sql_db.session.query(
+        func.count(ScrapeRun.lease_hold_seconds).label("acquired"),
+        func.coalesce(func.avg(ScrapeRun.lease_wait_seconds), 0.0).label("avg_wait_seconds"),
+        func.coalesce(func.max(ScrapeRun.lease_wait_seconds), 0.0).label("max_wait_seconds"),
+        func.coalesce(func.avg(ScrapeRun.lease_hold_seconds), 0.0).label("avg_hold_seconds"),
+        func.coalesce(func.max(ScrapeRun.lease_hold_seconds), 0.0).label("max_hold_seconds")) \
+        .filter(ScrapeRun.finished_at >= since, ScrapeRun.lease_hold_seconds.isnot(None)).one()
+    return {
+        'acquired': stats.acquired,
+        'avg_wait_seconds': round(float(stats.avg_wait_seconds), 3),
+        'max_wait_seconds': round(float(stats.max_wait_seconds), 3),
+        'avg_hold_seconds': round(float(stats.avg_hold_seconds), 3),
+        'max_hold_seconds': round(float(stats.max_hold_seconds), 3)
+    }
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import insert
+
+from manager import sql_db
+from manager.db_model import ScrapeRun
+
+# States of a scrape run, a feed has at most one run in flight, see ScrapeRun
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+SUCCESSFUL = "SUCCESSFUL"
+FAILED = "FAILED"
+IN_FLIGHT = (PENDING, RUNNING)
+
+# Attempts to join the run in flight of a feed when it keeps finishing between the insert and the select of open_run
+OPEN_ATTEMPTS = 3
+
+
+def open_run(feed_id, status, config, now=None) -> tuple:
+    """Opens a run of a feed in the current transaction, or joins the one already in flight
+
+    The partial unique index on the runs in flight makes concurrent requests for the same feed, from users or from the
+    periodic task, coalesce into a single run. A run in flight for longer than SCRAPE_RUN_TIMEOUT is failed first, so
+    that a run lost with its worker does not block the feed forever.
+
+    :param feed_id: The feed to scrape
+    :param status: PENDING when the run is queued for a worker, RUNNING when the caller scrapes the feed itself
+    :param config: The configuration of the application, with the SCRAPE_RUN_TIMEOUT setting
+    :return The id of the run and whether it was created, i.e. whether the caller has to carry it out
+    """
+    now = now or datetime.now(pytz.utc)
+    timeout = now - timedelta(seconds=config.get("SCRAPE_RUN_TIMEOUT"))
+    ScrapeRun.query.filter(ScrapeRun.feed_id == feed_id, ScrapeRun.status.in_(IN_FLIGHT),
+                           func.coalesce(ScrapeRun.started_at, ScrapeRun.created_at) < timeout) \
+        .update({ScrapeRun.status: FAILED, ScrapeRun.finished_at: now, ScrapeRun.error: "Timed out"},
+                synchronize_session=False)
+
+    for _ in range(OPEN_ATTEMPTS):
+        created = sql_db.session.execute(
+            insert(ScrapeRun.__table__)
+            .values(feed_id=feed_id, status=status, created_at=now, started_at=now if status == RUNNING else None)
+            .on_conflict_do_nothing(index_elements=["feed_id"], index_where=ScrapeRun.status.in_(IN_FLIGHT))
+            .returning(ScrapeRun.id)).first()
+        if created is not None:
+            return created.id, True
+        in_flight = sql_db.session.query(ScrapeRun.id) \
+            .filter(ScrapeRun.feed_id == feed_id, ScrapeRun.status.in_(IN_FLIGHT)).first()
+        if in_flight is not None:
+            return in_flight.id, False
+    raise RuntimeError(f"Could not open a scrape run of feed '{feed_id}'")
+
+
+def start_run(run_id, now=None):
+    """Marks a pending run as running, in the current transaction
+
+    :return The feed of the run, None when the run is no longer pending, e.g. because it timed out
+    """
+    started = sql_db.session.execute(
+        ScrapeRun.__table__.update()
+        .where(and_(ScrapeRun.id == run_id, ScrapeRun.status == PENDING))
+        .values(status=RUNNING, started_at=now or datetime.now(pytz.utc))
+        .returning(ScrapeRun.feed_id)).first()
+    return started.feed_id if started is not None else None
+
+
+def finish_run(run_id, error=None, now=None, lease=None):
+    """Marks a run in flight as successful, or as failed with its error, in the current transaction
+
+    :param lease: The lease held by the run, released along with the transaction, whose wait and hold times are stored
+        on the run for scrape_lock.lock_stats
+    """
+    values = {ScrapeRun.status: FAILED if error is not None else SUCCESSFUL,
+              ScrapeRun.finished_at: now or datetime.now(pytz.utc),
+              ScrapeRun.error: repr(error)[:1000] if error is not None else None}
+    if lease is not None:
+        values.update({ScrapeRun.lease_wait_seconds: lease.wait_seconds,
+                       ScrapeRun.lease_hold_seconds: lease.hold_seconds()})
+    ScrapeRun.query.filter(ScrapeRun.id == run_id, ScrapeRun.status.in_(IN_FLIGHT)) \
+        .update(values, synchronize_session=False)
@@ -1,12 +1,28 @@
 import pytz
-import requests
 from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 
-from manager.db_model import FeedItem, Feed, Follows, Unread
+from flask import current_app
+
+from manager.celery_periodic.feed_parser import CHUNK_SIZE, PublishedTimeParser, StreamingFeedParser, item_key
+from manager.celery_periodic.fetcher import is_success
+from manager.celery_periodic.http_session import get_session
+from manager.celery_periodic.schedule import RECENT_ITEMS, cache_lifetime, next_due, publish_interval
+from manager.db_model import FeedItem, Feed
 from manager import sql_db
+from manager.read_state import get_read_state, touch_feed_items
+from manager.helper.ttl_cache import TTLCache
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
+from requests import HTTPError
+
+# Keys of the items this process recently stored, or found already stored, by (feed id, guid)
+recently_stored_items = TTLCache(maxsize=100000, ttl=24 * 3600)
+
+# The BeautifulSoup parsers a feed can be declared with, used for the documents that are not well formed XML
+FEED_PARSERS = {"lxml", "lxml-xml", "xml", "html.parser", "html5lib"}
 
 
 class Scraper:
@@ -20,8 +36,9 @@ class Scraper:
     logger = logging.getLogger(__name__)
 
     def __init__(self, feed):
-        url = feed.get("url")
-        self.feed = Feed.query.filter_by(url=url).first()
+        # Either a Feed already loaded, or a feed as declared in config.py
+        self.feed = feed if isinstance(feed, Feed) else Feed.query.filter_by(url=feed.get("url")).first()
+        self.published_time = PublishedTimeParser(self.feed.time_format if self.feed else None)
 
     @staticmethod
     def get_title(feed_item) -> str:
@@ -38,77 +55,201 @@ class Scraper:
         """Gets the URL of a single parsed feed item in string format"""
         return feed_item.link.next
 
+    @staticmethod
+    def get_guid(feed_item):
+        """Gets the guid of a single parsed feed item in string format, None when it has none"""
+        return feed_item.guid.string if feed_item.guid else None
+
     def get_published_time(self, feed_item) -> datetime:
         """Calculates the time of publication of a single parsed feed item in datetime object format"""
 
-        date = datetime.strptime(feed_item.pubdate.string, self.feed.time_format)
-        publication_time = datetime(
-            year=date.year, month=date.month, day=date.day, hour=date.hour,
-            minute=date.minute, second=date.second, tzinfo=pytz.utc if not date.tzinfo else date.tzinfo
-        )
-
-        return publication_time
+        return self.published_time(feed_item.pubdate.string)
 
-    def build_sql_db_object(self, not_parsed_feed_item) -> FeedItem:
+    def build_sql_db_object(self, not_parsed_feed_item, published=None) -> FeedItem:
         """Prepares a FeedItem object ready to be stored in the database
 
         :param not_parsed_feed_item: feed that has not been parsed yet
+        :param published: The time of publication of the feed item when it is already parsed
         :return FeedItem object successfully built
         """
 
+        url = self.get_url(not_parsed_feed_item)
+        title = self.get_title(not_parsed_feed_item)
         return FeedItem(
-            url=self.get_url(not_parsed_feed_item),
-            title=self.get_title(not_parsed_feed_item),
+            guid=item_key(self.get_guid(not_parsed_feed_item), url, title),
+            url=url,
+            title=title,
             description=self.get_description(not_parsed_feed_item),
             feed_id=self.feed.id,
-            published=self.get_published_time(not_parsed_feed_item)
+            published=published or self.get_published_time(not_parsed_feed_item)
         )
 
+    def conditional_headers(self) -> dict:
+        """Builds the headers asking the origin to only send the feed document when it changed since the last scrape"""
+        headers = dict()
+        if self.feed.etag:
+            headers["If-None-Match"] = self.feed.etag
+        if self.feed.last_modified:
+            headers["If-Modified-Since"] = self.feed.last_modified
+        return headers
+
+    def newer_than(self):
+        """The publication time items must be newer than to be parsed, None to parse every item
+
+        Items published up to SCRAPE_LOOKBACK_HOURS before the newest stored one are still parsed, so that the ones
+        added late to the feed are not lost. Those already stored are skipped by their key.
+        """
+        newest = sql_db.session.query(func.max(FeedItem.published)).filter(FeedItem.feed_id == self.feed.id).scalar()
+        if newest is None:
+            return None
+        return newest - timedelta(hours=current_app.config.get("SCRAPE_LOOKBACK_HOURS"))
+
+    def stream_parser(self) -> StreamingFeedParser:
+        """Builds the parser the feed document is streamed into while it is downloaded"""
+        return StreamingFeedParser(self.feed.time_format, newer_than=self.newer_than(),
+                                   sorted_by_date=self.feed.sorted_by_date,
+                                   max_size=current_app.config.get("SCRAPE_MAX_DOCUMENT_SIZE"))
+
     def parse(self) -> list:
         """Downloads the content of the specified feed url and prepares the storage of FeedItem objects
 
-        :return None
+        The request is conditional: when the origin answers 304 Not Modified nothing is parsed and no item is returned.
+        Any other status but 2xx fails the scrape.
+        The response is streamed into the parser, which can stop the download once it found all the new items.
+
+        :return The list of new FeedItem objects
         """
 
+        parser = self.stream_parser()
         try:
-            response = requests.get(self.feed.url)
-            if response.content:
-                soup = BeautifulSoup(response.content, self.feed.parser)
-                items = list()
-
-                for feed_item in soup.find_all("item"):
-                    if self.feed.last_updated < self.get_published_time(feed_item):
-                        sql_db_feed_item = self.build_sql_db_object(feed_item)
-                        items.append(sql_db_feed_item)
-                return items
-            return list()
+            session = get_session(current_app.config)
+            with session.get(self.feed.url, headers=self.conditional_headers(), stream=True,
+                             timeout=(current_app.config.get("SCRAPE_CONNECT_TIMEOUT"),
+                                      current_app.config.get("SCRAPE_READ_TIMEOUT"))) as response:
+                if response.status_code != 304 and is_success(response.status_code):
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if not parser.feed(chunk):
+                            break
         except ConnectionError as err:
             self.logger.error(f"Connection for url '{self.feed.url}' not available. Aborting...", err)
             raise err
+        return self.parse_document(response.status_code, parser, response.headers)
+
+    def parse_document(self, status_code, parser: StreamingFeedParser, headers) -> list:
+        """Builds the new FeedItem objects out of a feed document streamed into a parser
+
+        Malformed documents are parsed again with BeautifulSoup. The validators of the document are stored on the
+        Feed, and saved by persist, only once it is parsed.
+
+        :param status_code: The HTTP status of the response, nothing is parsed on a 304 Not Modified and an HTTPError is
+            raised on any other status but 2xx
+        :param parser: The parser built by stream_parser, that received the body of the response
+        :param headers: The headers of the response
+        :return The list of new FeedItem objects
+        """
+
+        if not is_success(status_code):
+            raise HTTPError(f"Feed '{self.feed.url}' answered with HTTP status {status_code}")
+        try:
+            if status_code == 304:
+                self.logger.info(f"Feed '{self.feed.url}' not modified since the last scrape")
+                self.schedule(headers)
+                return list()
+
+            parsed_items = parser.close()
+            if parser.malformed:
+                items = self.parse_with_beautiful_soup(parser.content)
+            else:
+                items = self.build_items(parsed_items)
+            return self.accept(items, headers, parser.ttl, parser.skip_hours)
         except (AttributeError, KeyError) as err:
             self.logger.error(f"Problem parsing data for feed '{self.feed.url}'", err)
             raise err
         except Exception as err:
             raise err
 
-    def persist(self, feed_items: list):
+    def build_items(self, parsed_items: list) -> list:
+        """Builds the FeedItem objects out of the items extracted by a StreamingFeedParser"""
+        return [FeedItem(guid=item["guid"], url=item["link"], title=item["title"], description=item["description"],
+                         feed_id=self.feed.id, published=item["published"])
+                for item in parsed_items]
+
+    def accept(self, items: list, headers, ttl=None, skip_hours=None) -> list:
+        """Takes in the items of a parsed document: stores its validators and scheduling hints on the Feed, to be saved
+        by persist, and drops the items this process already stored
+
+        :return The FeedItem objects still to persist
+        """
+        self.feed.etag = headers.get("ETag")
+        self.feed.last_modified = headers.get("Last-Modified")
+        self.feed.ttl = ttl
+        self.feed.skip_hours = skip_hours
+        self.schedule(headers)
+        # Skipping the items this process already stored, without asking the database
+        return [item for item in items if not recently_stored_items.get((self.feed.id, item.guid))]
+
+    def schedule(self, headers):
+        """Sets when the feed is due to be scraped again, out of its publish rate and the hints of its last document
+
+        :param headers: The headers of the response, with the Cache-Control / Expires lifetime of the document
+        """
+        now = datetime.now(pytz.utc)
+        recent = [published for published, in sql_db.session.query(FeedItem.published)
+                  .filter(FeedItem.feed_id == self.feed.id)
+                  .order_by(FeedItem.published.desc()).limit(RECENT_ITEMS)]
+        self.feed.next_due = next_due(now, publish_interval(recent, now),
+                                      min_interval=current_app.config.get("SCRAPE_MIN_INTERVAL"),
+                                      max_interval=current_app.config.get("SCRAPE_MAX_INTERVAL"),
+                                      lifetime=cache_lifetime(headers, now), ttl=self.feed.ttl,
+                                      skip_hours=self.feed.skip_hours)
+
+    def parse_with_beautiful_soup(self, content: bytes) -> list:
+        """Fallback parsing of a whole document with BeautifulSoup, for feeds that are not well formed XML"""
+        self.logger.warning(f"Feed '{self.feed.url}' is not well formed XML, parsing it with BeautifulSoup")
+        if not content:
+            return list()
+        soup = BeautifulSoup(content, self.feed.parser)
+        items = list()
+        newer_than = self.newer_than()
+
+        for feed_item in soup.find_all("item"):
+            published = self.get_published_time(feed_item)
+            if newer_than is None or newer_than < published:
+                sql_db_feed_item = self.build_sql_db_object(feed_item, published)
+                items.append(sql_db_feed_item)
+        return items
+
+    def persist(self, feed_items: list, commit=True) -> list:
         """Stores a list of FeedItem objects in the database
 
+        The items are inserted with a single INSERT ... ON CONFLICT DO NOTHING statement: the ones whose key is already
+        stored, by a retry of the same scrape or by an overlapping refresh, are skipped by the (feed_id, guid) index.
+
         :param feed_items: The collection of FeedItem objects to be stored
-        :return None
+        :param commit: Whether to commit, or to leave it to the caller storing the items of several feeds at once, who
+            remembers the keys returned once committed, see remember_items
+        :return The keys of the items
         """
         try:
-            if feed_items:
-                sql_db.session.add_all(feed_items)
+            rows = [{"guid": item.guid or item_key(None, item.url, item.title), "url": item.url, "title": item.title,
+                     "description": item.description, "feed_id": self.feed.id, "published": item.published}
+                    for item in feed_items]
+            item_ids = list()
+            if rows:
+                inserted = sql_db.session.execute(
+                    insert(FeedItem.__table__).values(rows)
+                    .on_conflict_do_nothing(index_elements=["feed_id", "guid"])
+                    .returning(FeedItem.id))
+                item_ids = [row.id for row in inserted]
 
-                # Adding an Unread relationship between each new item and each user that follows the current feed
-                users_that_follow_current_feed = Follows.query.filter_by(feed_id=self.feed.id).all()
-                for item in feed_items:
-                    if users_that_follow_current_feed:
-                        for user in users_that_follow_current_feed:
-                            unread = Unread(username=user.username, item_id=item.id)
-                            sql_db.session.add(unread)
+            # Making the new items unread for each user that follows the current feed, in chunks of followers
+            # committed on their own unless the caller commits, along with the rest of a fan out that failed
+            get_read_state().add_items(self.feed.id, item_ids,
+                                       chunk_size=current_app.config.get("SCRAPE_FANOUT_CHUNK_SIZE") if commit
+                                       else None)
 
+            if item_ids:
+                touch_feed_items(self.feed.id)
                 # Updating the last_updated timestamp of the specific Feed
                 date = datetime.now()
                 last_updated = datetime(year=date.year, month=date.month, day=date.day, hour=date.hour,
@@ -116,12 +257,26 @@ class Scraper:
                                         tzinfo=pytz.utc if not date.tzinfo else date.tzinfo)
                 self.feed.last_updated = last_updated
 
-                # Adding a Feed record inside the db
+            # Adding a Feed record inside the db, along with the validators of the document the items come from
+            keys = [row["guid"] for row in rows]
+            if not commit:
+                sql_db.session.add(self.feed)
+                return keys
+            feed_id = self.feed.id
+            if rows or sql_db.session.is_modified(self.feed):
                 sql_db.session.add(self.feed)
                 sql_db.session.commit()
+            remember_items(feed_id, keys)
+            return keys
         except SQLAlchemyError as err:
             sql_db.session.rollback()
-            self.logger.error(f"Impossible to store the generated FeedItem the database", err)
+            self.logger.error(f"Impossible to store the generated FeedItem in the database: {err!r}")
             raise err
         except Exception as err:
             raise err
+
+
+def remember_items(feed_id, keys: list):
+    """Remembers the keys of items stored in the database, so that the next scrapes of this process skip them"""
+    for key in keys:
+        recently_stored_items.set((feed_id, key), True)
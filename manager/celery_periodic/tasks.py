@@ -1,51 +1,152 @@
+from datetime import datetime
+
+import pytz
 from celery.utils.log import get_task_logger
-from sqlalchemy.exc import SQLAlchemyError
+from flask import current_app
+from sqlalchemy import and_, or_
 
-from config import feeds
-from manager import celery_periodic
+from manager import celery_periodic, sql_db
+from manager.celery_periodic import circuit_breaker, scrape_lock, scrape_runs
+from manager.celery_periodic.pipeline import FeedJob, ScrapePipeline
 from manager.celery_periodic.scraper import Scraper
+from manager.db_model import Feed
 
 celery = celery_periodic.celery
 logger = get_task_logger(__name__)
 
 
-FORBIDDEN = set()
-
-
 @celery.task(bind=True, name="scrape")
 def scrape(self):
-    for rss_feed in feeds:
-        if rss_feed['url'] not in FORBIDDEN:
-            logger.info(f"Scraping feed {rss_feed['url']} for new items")
-            scrape_single.s(rss_feed).delay()
-        else:
-            logger.info(f"Feed {rss_feed['url']} is not auto-updating")
-
-
-@celery.task(bind=True, name="scrape_single", retry_kwargs={'max_retries': 5}, retry_backoff=5.0, retry_jitter=True)
-def scrape_single(self, feed, from_app=False, no_op=False):
-    if from_app:
-        logger.info("Execution triggered from Flask App")
-    if no_op:
-        if feed.get('url') in FORBIDDEN:
-            FORBIDDEN.remove(feed.get('url'))
-        return
-    try:
+    """Starts the periodic scrape of the feeds registered in the database, one dispatch_shard task per shard"""
+    for shard in range(current_app.config.get("SCRAPE_SHARDS")):
+        dispatch_shard.delay(shard)
+
+
+@celery.task(bind=True, name="dispatch_shard")
+def dispatch_shard(self, shard):
+    """Pages through the feeds of a shard, the feeds whose id modulo SCRAPE_SHARDS is shard, and queues a scrape_feeds
+    task per batch of SCRAPE_DISPATCH_BATCH_SIZE feeds that are due
+
+    A batch not picked up by a worker within SCRAPE_DISPATCH_EXPIRES seconds is dropped, its feeds are dispatched again
+    by the next periodic scrape.
+    """
+    config = current_app.config
+    now = datetime.now(pytz.utc)
+    due_feeds = Feed.query.filter(Feed.id % config.get("SCRAPE_SHARDS") == shard, is_due(now)).with_entities(Feed.id)
+    last_id = 0
+    while True:
+        batch = due_feeds.filter(Feed.id > last_id).order_by(Feed.id).limit(config.get("SCRAPE_DISPATCH_BATCH_SIZE"))
+        feed_ids = [feed_id for feed_id, in batch]
+        if not feed_ids:
+            break
+        scrape_feeds.apply_async((feed_ids,), expires=config.get("SCRAPE_DISPATCH_EXPIRES"))
+        last_id = feed_ids[-1]
+
+
+def is_due(now):
+    """Whether a feed is to be scraped: once it is due if its circuit breaker is closed, once its backoff is over
+    otherwise, and only when no other scrape holds its lease
+    """
+    return and_(
+        or_(and_(Feed.breaker_state == circuit_breaker.CLOSED, or_(Feed.next_due.is_(None), Feed.next_due <= now)),
+            and_(Feed.breaker_state != circuit_breaker.CLOSED, or_(Feed.retry_at.is_(None), Feed.retry_at <= now))),
+        or_(Feed.lease_owner.is_(None), Feed.lease_expires_at <= now))
+
+
+@celery.task(bind=True, name="scrape_feeds")
+def scrape_feeds(self, feed_ids):
+    """Scrapes a batch of feeds dispatched by dispatch_shard, skipping the ones that are no longer due
+
+    :param feed_ids: The feeds of the batch
+    """
+    jobs = list()
+    now = datetime.now(pytz.utc)
+    for feed in Feed.query.filter(Feed.id.in_(feed_ids)).order_by(Feed.id).all():
+        url = feed.url
         scraper = Scraper(feed)
-        feed_items = scraper.parse()
-        scraper.persist(feed_items)
-        url = feed.get('url')
-        if url in FORBIDDEN:
-            FORBIDDEN.remove(url)
-    except ConnectionError as err:
-        FORBIDDEN.add(feed.get('url'))
-        raise err
-    except (AttributeError, KeyError) as err:
-        FORBIDDEN.add(feed.get('url'))
-        raise err
-    except SQLAlchemyError as err:
-        FORBIDDEN.add(feed.get('url'))
-        raise err
-    except Exception:
-        FORBIDDEN.add(feed.get('url'))
+        # Each feed is only scraped once it is due, see Scraper.schedule
+        if circuit_breaker.is_closed(scraper.feed) and scraper.feed.next_due is not None \
+                and now < scraper.feed.next_due:
+            logger.debug(f"Feed {url} is not due before {scraper.feed.next_due}")
+            continue
+        # A feed leased by another scrape is skipped, it is due again once that scrape is over
+        lease = scrape_lock.acquire(scraper.feed.id, current_app.config)
+        if lease is None:
+            continue
+        if not circuit_breaker.is_closed(scraper.feed) \
+                and not circuit_breaker.acquire_probe(scraper.feed.id, current_app.config, now):
+            # A failing feed is skipped until its backoff is over, then probed by a single scrape
+            logger.info(f"Feed {url} is failing, it is not retried before {scraper.feed.retry_at}")
+            lease.release()
+            continue
+        # A feed already refreshed on request is left to that run, and requests made meanwhile join this one
+        run_id, created = scrape_runs.open_run(scraper.feed.id, scrape_runs.RUNNING, current_app.config, now)
+        sql_db.session.commit()
+        if not created:
+            logger.info(f"Feed {url} is already being scraped")
+            lease.release()
+            continue
+        logger.info(f"Scraping feed {url} for new items")
+        jobs.append(FeedJob(scraper, scraper.feed.id, url, run_id, lease))
+
+    try:
+        # The feeds are downloaded, parsed and persisted by the stages of the pipeline at the same time
+        return ScrapePipeline(current_app.config).run(jobs)
+    except Exception as err:
+        # The runs and the leases of the feeds left over by an error are not kept in flight until they time out
+        sql_db.session.rollback()
+        for job in jobs:
+            scrape_runs.finish_run(job.run_id, err, lease=job.lease)
+        scrape_lock.release_all([job.lease for job in jobs])
         raise
+
+
+@celery.task(bind=True, name="refresh_feed")
+def refresh_feed(self, run_id):
+    """Carries out a scrape run requested through the API, whatever the schedule and the circuit breaker of its feed
+
+    :param run_id: The pending run, shared by every refresh job of its feed opened while it is in flight
+    """
+    feed_id = scrape_runs.start_run(run_id)
+    sql_db.session.commit()
+    if feed_id is None:
+        logger.info(f"Scrape run '{run_id}' is no longer pending")
+        return
+    # A refresh waits for the scrape of the feed in progress, then fetches what it missed if anything
+    lease = scrape_lock.acquire(feed_id, current_app.config, wait=True)
+    if lease is None:
+        scrape_runs.finish_run(run_id, TimeoutError(f"Feed '{feed_id}' is still being scraped by another task"))
+        sql_db.session.commit()
+        return
+    with lease:
+        error = scrape_feed(feed_id)
+        scrape_runs.finish_run(run_id, error, lease=lease)
+        sql_db.session.commit()
+
+
+def scrape_feed(feed_id):
+    """Downloads, parses and persists a feed, reporting the outcome to its circuit breaker
+
+    :return The error of the scrape, None when it succeeded
+    """
+    feed = Feed.query.get(feed_id)
+    if feed is None:
+        logger.error(f"Feed '{feed_id}' to scrape no longer exists")
+        return LookupError(f"Feed '{feed_id}' no longer exists")
+    scraper = Scraper(feed)
+    return report_scrape(feed.id, feed.url, lambda: scraper.persist(scraper.parse()))
+
+
+def report_scrape(feed_id, url, parse_and_persist):
+    """Runs a scrape and commits its outcome along with the state of the circuit breaker of the feed"""
+    error = None
+    try:
+        parse_and_persist()
+        circuit_breaker.record_success(feed_id)
+    except Exception as err:
+        logger.error(f"Scraping feed {url} failed: {err!r}")
+        sql_db.session.rollback()
+        circuit_breaker.record_failure(feed_id, err, current_app.config)
+        error = err
+    sql_db.session.commit()
+    return error
@@ -1,6 +1,13 @@
+import sys
+
 from manager import celery_periodic, create_app
 
 
 app = create_app()
 celery = celery_periodic.make_celery(app)
 celery_periodic.celery = celery
+
+
+if __name__ == "__main__":
+    # Starts the worker of a queue, e.g. python -m manager.celery_periodic.worker refresh -l info
+    celery.worker_main(celery_periodic.worker_argv(sys.argv[1], app.config, sys.argv[2:]))
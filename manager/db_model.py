@@ -1,6 +1,7 @@
 from manager import sql_db
 
 from passlib.hash import pbkdf2_sha256
+from sqlalchemy.dialects.postgresql import ARRAY
 
 
 class User(sql_db.Model):
@@ -9,6 +10,8 @@ class User(sql_db.Model):
 
     username = sql_db.Column(sql_db.String(256), primary_key=True)
     password = sql_db.Column(sql_db.String(128))
+    # Bumped on every change to the follows and the read state of the user, the ETags of their lists derive from it
+    read_state_version = sql_db.Column(sql_db.Integer, nullable=False, default=0)
 
     def hash_password(self, password):
         self.password = pbkdf2_sha256.hash(password)
@@ -23,12 +26,39 @@ class User(sql_db.Model):
 class Feed(sql_db.Model):
     """Representation of a Feed in the database that is being scraped, ready for any new posts"""
     __tablename__ = "feeds"
+    __table_args__ = (
+        sql_db.UniqueConstraint("url", name="uq_feeds_url"),
+    )
 
     id = sql_db.Column(sql_db.Integer, primary_key=True)
     url = sql_db.Column(sql_db.String(2000))
     parser = sql_db.Column(sql_db.String(20))
     time_format = sql_db.Column(sql_db.String(50))
+    # Whether the items of the feed document are sorted newest first, so that parsing stops at the first old item
+    sorted_by_date = sql_db.Column(sql_db.Boolean, nullable=False, default=False)
     last_updated = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    # Bumped whenever items of the feed are stored or fanned out to its followers, invalidating the ETags of the item
+    # lists the feed is part of
+    items_version = sql_db.Column(sql_db.Integer, nullable=False, default=0)
+    # Validators of the last document downloaded from the feed, sent back to only download it again once it changed
+    etag = sql_db.Column(sql_db.String(1024))
+    last_modified = sql_db.Column(sql_db.String(64))
+    # When the feed is scraped again by the periodic task, None for as soon as possible, and the RSS <ttl> (minutes)
+    # and <skipHours> (GMT hours) hints of its last document it is computed from along with its publish rate
+    next_due = sql_db.Column(sql_db.TIMESTAMP(timezone=True), index=True)
+    ttl = sql_db.Column(sql_db.Integer)
+    skip_hours = sql_db.Column(ARRAY(sql_db.Integer))
+    # Circuit breaker shared by every scraper process: 'closed', 'open' (skipped until retry_at) or 'half_open' (probed
+    # by a single scrape), along with the number of scrapes failed in a row and the last error
+    breaker_state = sql_db.Column(sql_db.String(16), nullable=False, default="closed")
+    failure_count = sql_db.Column(sql_db.Integer, nullable=False, default=0)
+    retry_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    last_error = sql_db.Column(sql_db.String(1000))
+    # Lease held by the single scrape of the feed in progress, taken over by another one once it expired
+    lease_owner = sql_db.Column(sql_db.String(32))
+    lease_expires_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    # Oldest item of a fan out of Unread rows in chunks that is not over yet, resumed by the next one, see add_items
+    fanout_item_id = sql_db.Column(sql_db.Integer)
 
     def serialize(self):
         return {
@@ -36,6 +66,16 @@ class Feed(sql_db.Model):
             'url': self.url
         }
 
+    def serialize_breaker(self):
+        return {
+            'feed_id': self.id,
+            'url': self.url,
+            'state': self.breaker_state,
+            'failure_count': self.failure_count,
+            'retry_at': self.retry_at.isoformat() if self.retry_at else None,
+            'last_error': self.last_error
+        }
+
     def __str__(self):
         return f"'id': '{self.id}', 'url': '{self.url}', 'parser': '{self.parser}', " \
                f"'time_format': '{self.time_format}', 'last_updated': '{self.last_updated}'"
@@ -44,8 +84,13 @@ class Feed(sql_db.Model):
 class FeedItem(sql_db.Model):
     """Representation of a FeedItem in the database, meaning a single post related to any specific feed"""
     __tablename__ = "feed_items"
+    __table_args__ = (
+        sql_db.UniqueConstraint("feed_id", "guid", name="uq_feed_items_feed_id_guid"),
+    )
 
     id = sql_db.Column(sql_db.Integer, primary_key=True)
+    # Stable key of the item within its feed: the RSS guid, or a hash of the link and title when it has none
+    guid = sql_db.Column(sql_db.String(2000), nullable=False)
     url = sql_db.Column(sql_db.String(2000))
     title = sql_db.Column(sql_db.String(100))
     description = sql_db.Column(sql_db.String(5000))
@@ -67,11 +112,20 @@ class FeedItem(sql_db.Model):
                f"published='{self.published}')"
 
 
+# Newest first timelines of a feed, undated items last, are read straight from this index
+sql_db.Index("ix_feed_items_feed_id_published", FeedItem.feed_id, FeedItem.published.desc().nullslast(),
+             FeedItem.id.desc())
+
+
 class Follows(sql_db.Model):
     """This table describes a follow relationship between a User and a Feed, more specific it is showing that
     for each feed a user follows, the table will be populated with a new record
     """
     __tablename__ = "follows"
+    __table_args__ = (
+        sql_db.UniqueConstraint("username", "feed_id", name="uq_follows_username_feed_id"),
+        sql_db.Index("ix_follows_feed_id_username", "feed_id", "username"),
+    )
 
     id = sql_db.Column(sql_db.Integer(), primary_key=True)
 
@@ -81,12 +135,21 @@ class Follows(sql_db.Model):
     feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'))
     feed = sql_db.relationship('Feed', backref=sql_db.backref('follows', lazy=True))
 
+    # The (since, since_item_id) horizon of the 'reads' read state model: the items of the feed before it are not part
+    # of the user's timeline, every item is when it is not set
+    since = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    since_item_id = sql_db.Column(sql_db.Integer)
+
 
 class Read(sql_db.Model):
     """This table describes the relationship between a User and a FeedItem, meaning that every item from a feed that
      a user follows that was already seen is considered a Read item
     """
     __tablename__ = "reads"
+    __table_args__ = (
+        sql_db.UniqueConstraint("username", "item_id", name="uq_reads_username_item_id"),
+        sql_db.Index("ix_reads_username_feed_id_item_id", "username", "feed_id", "item_id"),
+    )
 
     id = sql_db.Column(sql_db.Integer(), primary_key=True)
 
@@ -105,6 +168,10 @@ class Unread(sql_db.Model):
     a user follows that wasn't yet seen is considered an Unread item
     """
     __tablename__ = "unreads"
+    __table_args__ = (
+        sql_db.UniqueConstraint("username", "item_id", name="uq_unreads_username_item_id"),
+        sql_db.Index("ix_unreads_username_feed_id_item_id", "username", "feed_id", "item_id"),
+    )
 
     id = sql_db.Column(sql_db.Integer(), primary_key=True)
 
@@ -116,3 +183,134 @@ class Unread(sql_db.Model):
 
     feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'))
     feed = sql_db.relationship('Feed', backref=sql_db.backref('unreads', lazy=True))
+
+
+class ReadMark(sql_db.Model):
+    """This table holds the compact read state of a User for a Feed, used by the 'watermark' read state model instead
+    of one Unread row per item: every item of the feed up to the (read_until, read_until_item_id) watermark is read,
+    and the items before the (since, since_item_id) horizon are not part of the user's timeline at all
+    """
+    __tablename__ = "read_marks"
+
+    username = sql_db.Column(sql_db.String, sql_db.ForeignKey('users.username'), primary_key=True)
+    user = sql_db.relationship('User', backref=sql_db.backref('read_marks', lazy=True))
+
+    feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'), primary_key=True)
+    feed = sql_db.relationship('Feed', backref=sql_db.backref('read_marks', lazy=True))
+
+    since = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    since_item_id = sql_db.Column(sql_db.Integer)
+    read_until = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    read_until_item_id = sql_db.Column(sql_db.Integer)
+
+
+class ReadException(sql_db.Model):
+    """This table describes a FeedItem newer than the ReadMark watermark that a User has already read, meaning an item
+    read out of order. Exceptions are dropped as soon as the watermark moves past them
+    """
+    __tablename__ = "read_exceptions"
+    __table_args__ = (
+        sql_db.Index("ix_read_exceptions_username_feed_id", "username", "feed_id"),
+    )
+
+    username = sql_db.Column(sql_db.String, sql_db.ForeignKey('users.username'), primary_key=True)
+    user = sql_db.relationship('User', backref=sql_db.backref('read_exceptions', lazy=True))
+
+    item_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feed_items.id'), primary_key=True)
+    item = sql_db.relationship('FeedItem', backref=sql_db.backref('read_exceptions', lazy=True))
+
+    feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'))
+    feed = sql_db.relationship('Feed', backref=sql_db.backref('read_exceptions', lazy=True))
+
+
+class UnreadCounter(sql_db.Model):
+    """This table holds the number of unread items of a User in a Feed they follow. It is kept up to date by the read
+    state model in the same transaction as the changes to the read state, and can be recomputed from the source tables
+    with the 'reconcile_counters' command
+    """
+    __tablename__ = "unread_counters"
+
+    username = sql_db.Column(sql_db.String, sql_db.ForeignKey('users.username'), primary_key=True)
+    user = sql_db.relationship('User', backref=sql_db.backref('unread_counters', lazy=True))
+
+    feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'), primary_key=True)
+    feed = sql_db.relationship('Feed', backref=sql_db.backref('unread_counters', lazy=True))
+
+    unread_count = sql_db.Column(sql_db.Integer, nullable=False, default=0)
+
+    def serialize(self):
+        return {
+            'feed_id': self.feed_id,
+            'unread_count': self.unread_count,
+        }
+
+
+class ScrapeRun(sql_db.Model):
+    """This table describes a single scrape of a Feed, requested by RefreshJobs or done by the periodic task. A feed has
+    at most one PENDING or RUNNING run: the refresh requests made meanwhile join it instead of scraping the feed again
+    """
+    __tablename__ = "scrape_runs"
+    __table_args__ = (
+        sql_db.Index("uq_scrape_runs_feed_id_in_flight", "feed_id", unique=True,
+                     postgresql_where=sql_db.text("status IN ('PENDING', 'RUNNING')")),
+    )
+
+    id = sql_db.Column(sql_db.Integer, primary_key=True)
+
+    feed_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('feeds.id'), nullable=False)
+    feed = sql_db.relationship('Feed', backref=sql_db.backref('scrape_runs', lazy=True))
+
+    # PENDING, RUNNING, SUCCESSFUL or FAILED
+    status = sql_db.Column(sql_db.String(16), nullable=False)
+    created_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True), nullable=False)
+    started_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True))
+    finished_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True), index=True)
+    error = sql_db.Column(sql_db.String(1000))
+    # Time the run waited for the lease of its feed and held it, in seconds
+    lease_wait_seconds = sql_db.Column(sql_db.Float)
+    lease_hold_seconds = sql_db.Column(sql_db.Float)
+
+    def serialize(self):
+        return {
+            'feed_id': f"{self.feed_id}",
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error
+        }
+
+
+class RefreshJob(sql_db.Model):
+    """This table describes a request of a User to refresh some feeds, carried out by the workers as ScrapeRuns"""
+    __tablename__ = "refresh_jobs"
+
+    id = sql_db.Column(sql_db.Integer, primary_key=True)
+
+    username = sql_db.Column(sql_db.String, sql_db.ForeignKey('users.username'), nullable=False, index=True)
+    user = sql_db.relationship('User', backref=sql_db.backref('refresh_jobs', lazy=True))
+
+    created_at = sql_db.Column(sql_db.TIMESTAMP(timezone=True), nullable=False)
+    runs = sql_db.relationship('ScrapeRun', secondary='refresh_job_runs', lazy=True, order_by='ScrapeRun.feed_id')
+
+    @property
+    def status(self) -> str:
+        statuses = {run.status for run in self.runs}
+        for status in ("RUNNING", "PENDING", "FAILED"):
+            if status in statuses:
+                return status
+        return "SUCCESSFUL"
+
+    def serialize(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'feeds': [run.serialize() for run in self.runs]
+        }
+
+
+class RefreshJobRun(sql_db.Model):
+    """This table links a RefreshJob to the ScrapeRun of each of its feeds, a run being shared by the jobs it served"""
+    __tablename__ = "refresh_job_runs"
+
+    job_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('refresh_jobs.id'), primary_key=True)
+    run_id = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('scrape_runs.id'), primary_key=True, index=True)
@@ -1,15 +1,29 @@
-from flask import request, g
+import hashlib
+import hmac
+from datetime import datetime
+from urllib.parse import urlparse
+
+import pytz
+from flask import request, g, make_response
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from werkzeug.exceptions import HTTPException
 
 from manager import sql_db
-from manager.db_model import User, Feed, FeedItem, Follows, Read, Unread
-from manager.celery_periodic.scraper import Scraper
+from manager.db_model import User, Feed, FeedItem, Follows, UnreadCounter, RefreshJob, RefreshJobRun
+from manager.celery_periodic import circuit_breaker, scrape_runs
+from manager.celery_periodic.scrape_lock import lock_stats
+from manager.celery_periodic.scraper import FEED_PARSERS
+from manager.helper.pagination import paginate
+from manager.helper.ttl_cache import TTLCache
+from manager.read_state import MAX_ITEM_ID, get_read_state, touch_read_state
 
 import json
 
-from manager import auth
+from manager import auth, basic_auth, token_auth
 from manager.helper.exceptions.error_handler import *
-from manager.celery_periodic.tasks import scrape_single
+from manager.celery_periodic.tasks import refresh_feed
 
 
 @app.route('/api/users', methods=['POST'])
@@ -38,16 +52,68 @@ def register():
 @app.route("/api/feeds", methods=["GET"])
 @auth.login_required
 def get_all_feeds():
-    feeds = Feed.query.all()
-    return jsonify([feed.serialize() for feed in feeds]), 200
+    def build_response():
+        feeds = Feed.query.all()
+        return jsonify([feed.serialize() for feed in feeds]), 200
+
+    return conditional_response(build_response, *sql_db.session.query(func.count(Feed.id), func.max(Feed.id)).one())
+
+
+@app.route("/api/feeds", methods=["POST"])
+@auth.login_required
+def register_feed():
+    if request.json is None:
+        log_and_raise(app.logger, MissingRequiredParameter("Missing request body", 400, payload=request.json))
+
+    url = request.json.get('url')
+    if not url:
+        log_and_raise(app.logger, MissingRequiredParameter("Missing 'url' in request body", 400, payload=request.json))
+    if not isinstance(url, str) or urlparse(url).scheme not in ("http", "https") or not urlparse(url).netloc \
+            or len(url) > 2000:
+        log_and_raise(app.logger, InvalidParameter("'url' must be an http or https URL", 400, payload=request.json))
+    parser = request.json.get('parser', "lxml")
+    if parser not in FEED_PARSERS:
+        log_and_raise(app.logger, InvalidParameter(f"'parser' must be one of {', '.join(sorted(FEED_PARSERS))}", 400,
+                                                   payload=request.json))
+    time_format = request.json.get('time_format')
+    if time_format is not None and (not isinstance(time_format, str) or len(time_format) > 50):
+        log_and_raise(app.logger, InvalidParameter("'time_format' must be a strptime format", 400,
+                                                   payload=request.json))
+    sorted_by_date = request.json.get('sorted_by_date', False)
+    if not isinstance(sorted_by_date, bool):
+        log_and_raise(app.logger, InvalidParameter("'sorted_by_date' must be a boolean", 400, payload=request.json))
+
+    # The unique url constraint makes concurrent registrations of a feed insert a single row, the new feed is due at
+    # once and scraped by the next periodic scrape
+    registered = sql_db.session.execute(
+        insert(Feed.__table__).values(url=url, parser=parser, time_format=time_format, sorted_by_date=sorted_by_date,
+                                      breaker_state=circuit_breaker.CLOSED, failure_count=0)
+        .on_conflict_do_nothing(index_elements=["url"])
+        .returning(Feed.id)).first()
+    if not registered:
+        log_and_raise(app.logger, FeedExists(f"Feed '{url}' already exists", 409, payload=request.json))
+    sql_db.session.commit()
+
+    app.logger.info(f"User '{g.user.username}' registered feed '{registered.id}' at '{url}'")
+    return jsonify(Feed.query.get(registered.id).serialize()), 201
 
 
 @app.route("/api/my-feeds")
 @auth.login_required
 def get_all_user_subscribed_feeds():
-    follows = Follows.query.filter_by(username=g.user.username).all()
-    feeds = Feed.query.filter(Feed.id.in_([relationship.feed_id for relationship in follows])).all()
-    return jsonify([feed.serialize() for feed in feeds]), 200
+    def build_response():
+        follows = Follows.query.filter_by(username=g.user.username).all()
+        feeds = Feed.query.filter(Feed.id.in_([relationship.feed_id for relationship in follows])).all()
+        return jsonify([feed.serialize() for feed in feeds]), 200
+
+    return conditional_response(build_response, g.user.username, g.user.read_state_version)
+
+
+@app.route("/api/my-feeds/counts")
+@auth.login_required
+def get_unread_counts():
+    counters = UnreadCounter.query.filter_by(username=g.user.username).order_by(UnreadCounter.feed_id).all()
+    return jsonify([counter.serialize() for counter in counters]), 200
 
 
 @app.route("/api/feeds/follow", methods=["POST"])
@@ -66,20 +132,23 @@ def follow_feed():
     if not feed:
         log_and_raise(app.logger, FeedNotFound("Feed id not found", 404, payload=request.json))
 
-    follow_relationship = Follows.query.filter_by(username=g.user.username, feed_id=feed_id).first()
-    if not follow_relationship:
-        sql_db.session.add(Follows(username=g.user.username, feed_id=feed_id))
-    else:
+    backfill_limit = get_non_negative_int(request.json, 'backfill_limit', app.config.get("FOLLOW_BACKFILL_LIMIT"))
+    backfill_days = get_non_negative_int(request.json, 'backfill_days', app.config.get("FOLLOW_BACKFILL_DAYS"))
+
+    # The unique (username, feed_id) constraint makes concurrent follow requests insert a single row
+    followed = sql_db.session.execute(
+        insert(Follows.__table__).values(username=g.user.username, feed_id=feed.id)
+        .on_conflict_do_nothing(index_elements=["username", "feed_id"])
+        .returning(Follows.id)).first()
+    if not followed:
         log_and_raise(app.logger, FeedAlreadyFollowed(f"User '{g.user.username}' "
                                                       f"already follows feed '{feed_id}'", status_code=409))
 
-    feed_items_by_feed_id = FeedItem.query.filter_by(feed_id=feed_id).all()
-
-    for item in feed_items_by_feed_id:
-        sql_db.session.add(Unread(username=g.user.username, item_id=item.id, feed_id=feed_id))
+    get_read_state().follow(g.user.username, feed.id, backfill_limit=backfill_limit, backfill_days=backfill_days)
+    touch_read_state(g.user.username)
     sql_db.session.commit()
 
-    app.logger.info(f"User '{g.user.username}' already follows feed '{feed_id}'")
+    app.logger.info(f"User '{g.user.username}' now follows feed '{feed_id}'")
     return jsonify(""), 204
 
 
@@ -99,16 +168,18 @@ def unfollow_feed():
     if not feed:
         log_and_raise(app.logger, FeedNotFound("Feed id not found", 404, payload=request.json))
 
-    follow_relationship = Follows.query.filter_by(username=g.user.username, feed_id=feed_id).first()
-    if follow_relationship:
-        sql_db.session.delete(follow_relationship)
-    else:
+    keep_history = request.json.get('keep_history', app.config.get("UNFOLLOW_KEEP_HISTORY"))
+    if not isinstance(keep_history, bool):
+        log_and_raise(app.logger, InvalidParameter("'keep_history' must be a boolean", 400, payload=request.json))
+
+    # Bulk DELETE statements, the number of round trips does not depend on the size of the user's history
+    deleted_follows = Follows.query.filter_by(username=g.user.username, feed_id=feed.id) \
+        .delete(synchronize_session=False)
+    if not deleted_follows:
         raise FeedNotFollowed(f"User '{g.user.username}' does not follow feed '{feed_id}'", status_code=409)
 
-    unnecessary_items = Unread.query.filter_by(username=g.user.username, feed_id=feed_id).all()
-    if unnecessary_items:
-        for item in unnecessary_items:
-            sql_db.session.delete(item)
+    get_read_state().unfollow(g.user.username, feed.id, keep_history=keep_history)
+    touch_read_state(g.user.username)
     sql_db.session.commit()
 
     app.logger.info(f"User '{g.user.username}' stopped following feed '{feed_id}'")
@@ -127,30 +198,17 @@ def get_unread_items_from_feed(feed_id):
         log_and_raise(app.logger,
                       FeedNotFollowed(f"User {g.user.username} does not follow feed {feed_id}", status_code=409))
 
-    unread_list = Unread.query.filter_by(username=g.user.username, feed_id=feed_id).all()
-    unread_item_ids = [unread.item_id for unread in unread_list]
-    unread_items = FeedItem.query.filter(FeedItem.id.in_(unread_item_ids)).order_by(FeedItem.published.desc()).all()
-    if not unread_items:
-        return jsonify({'message': f"No new items from feed '{feed_id}'"}), 200
-    return jsonify([item.serialize() for item in unread_items]), 200
+    return item_list_response(get_read_state().unread_items(g.user.username).filter(FeedItem.feed_id == feed.id),
+                              empty_message=f"No new items from feed '{feed_id}'", feed_id=feed.id)
 
 
 @app.route("/api/my-feeds/new")
 @auth.login_required
 def get_unread_items_from_all_feeds():
-    follow_relationships = Follows.query.filter_by(username=g.user.username).all()
-    if not follow_relationships:
+    if not follows_any_feed(g.user.username):
         return jsonify(f"User '{g.user.username}' does not follow any feeds")
 
-    unread_item_ids = list()
-    for relationship in follow_relationships:
-        unread_items = Unread.query.filter_by(username=g.user.username, feed_id=relationship.feed_id).all()
-        if unread_items:
-            for unread_item in unread_items:
-                unread_item_ids.append(unread_item.item_id)
-
-    unread_items = FeedItem.query.filter(FeedItem.id.in_(unread_item_ids)).order_by(FeedItem.published.desc()).all()
-    return jsonify([item.serialize() for item in unread_items]), 200
+    return item_list_response(get_read_state().unread_items(g.user.username))
 
 
 @app.route("/api/my-feeds/<feed_id>/old")
@@ -165,30 +223,17 @@ def get_read_items_from_feed(feed_id):
         log_and_raise(app.logger,
                       FeedNotFollowed(f"User '{g.user.username}' does not follow feed '{feed_id}'", status_code=409))
 
-    reads = Read.query.filter_by(username=g.user.username, feed_id=feed_id).all()
-    read_item_ids = [read.item_id for read in reads]
-    read_items = FeedItem.query.filter(FeedItem.id.in_(read_item_ids)).order_by(FeedItem.published.desc()).all()
-    if not read_items:
-        return jsonify({"message": f"Nothing in feed '{feed_id}' has been read."}), 200
-    return jsonify([item.serialize() for item in read_items]), 200
+    return item_list_response(get_read_state().read_items(g.user.username).filter(FeedItem.feed_id == feed.id),
+                              empty_message=f"Nothing in feed '{feed_id}' has been read.", feed_id=feed.id)
 
 
 @app.route("/api/my-feeds/old")
 @auth.login_required
 def get_read_items_from_all_feeds():
-    follow_relationships = Follows.query.filter_by(username=g.user.username).all()
-    if not follow_relationships:
+    if not follows_any_feed(g.user.username):
         return jsonify(f"User '{g.user.username}' does not follow any feeds")
 
-    read_item_ids = list()
-    for relationship in follow_relationships:
-        read_items = Read.query.filter_by(username=g.user.username, feed_id=relationship.feed_id).all()
-        if read_items:
-            for read_item in read_items:
-                read_item_ids.append(read_item.item_id)
-
-    unread_items = FeedItem.query.filter(FeedItem.id.in_(read_item_ids)).order_by(FeedItem.published.desc()).all()
-    return jsonify([item.serialize() for item in unread_items]), 200
+    return item_list_response(get_read_state().read_items(g.user.username))
 
 
 @app.route("/api/items/<item_id>/read", methods=["POST"])
@@ -202,12 +247,8 @@ def read_feed_item(item_id):
     if not follow_relationship:
         raise FeedNotFollowed(f"User '{g.user.username}' does not follow feed '{item.feed_id}'", status_code=409)
 
-    unread = Unread.query.filter_by(username=g.user.username, item_id=item.id).first()
-    read = Read(username=g.user.username, item_id=item.id, feed_id=item.feed_id)
-
-    if unread:
-        sql_db.session.delete(unread)
-    sql_db.session.add(read)
+    get_read_state().mark_item_as_read(g.user.username, item)
+    touch_read_state(g.user.username)
     sql_db.session.commit()
     return "", 204
 
@@ -221,15 +262,38 @@ def read_multiple_feed_items():
     if not item_ids:
         raise MissingRequiredParameter("Missing 'item_ids' in request body", 400, payload=request.json)
 
-    feed_items = FeedItem.query.filter(FeedItem.id.in_(item_ids)).all()
+    if not isinstance(item_ids, list):
+        log_and_raise(app.logger, InvalidParameter("'item_ids' must be a list", 400, payload=request.json))
+
+    get_read_state().mark_as_read(g.user.username, FeedItem.id.in_(item_ids))
+    touch_read_state(g.user.username)
+    sql_db.session.commit()
+    return "", 204
 
-    for feed_item in feed_items:
-        unread = Unread.query.filter_by(username=g.user.username, item_id=feed_item.id).first()
-        if unread:
-            sql_db.session.delete(unread)
-            read = Read(username=g.user.username, item_id=feed_item.id, feed_id=feed_item.feed_id)
-            sql_db.session.add(read)
 
+@app.route("/api/my-feeds/<feed_id>/read-all", methods=["POST"])
+@auth.login_required
+def read_all_feed_items(feed_id):
+    feed = Feed.query.get(feed_id)
+    if not feed:
+        log_and_raise(app.logger, FeedNotFound("Feed id not found", 404, payload=request.json))
+
+    follow_relationship = Follows.query.filter_by(username=g.user.username, feed_id=feed.id).first()
+    if not follow_relationship:
+        log_and_raise(app.logger,
+                      FeedNotFollowed(f"User '{g.user.username}' does not follow feed '{feed_id}'", status_code=409))
+
+    get_read_state().mark_all_as_read(g.user.username, feed.id, until=get_read_up_to_keyset())
+    touch_read_state(g.user.username)
+    sql_db.session.commit()
+    return "", 204
+
+
+@app.route("/api/my-feeds/read-all", methods=["POST"])
+@auth.login_required
+def read_all_items_from_all_feeds():
+    get_read_state().mark_all_as_read(g.user.username, until=get_read_up_to_keyset())
+    touch_read_state(g.user.username)
     sql_db.session.commit()
     return "", 204
 
@@ -241,46 +305,224 @@ def refresh_single_feed(feed_id):
     if not feed:
         log_and_raise(app.logger, FeedNotFound("Feed id not found", 404, payload=request.json))
 
-    try:
-        scraper = Scraper({"url": feed.url, "parser": feed.parser, "time_format": feed.time_format})
-        feed_items = scraper.parse()
-        scraper.persist(feed_items)
-    except Exception:
-        raise InternalServerError("There was a problem updating the requested feed", 500, payload=request.json)
-    else:
-        scrape_single.delay(feed={"url": feed.url}, from_app=True, no_op=True)
-        return jsonify({'message': 'Update successful'}), 200
+    return start_refresh_job([feed])
 
 
 @app.route("/api/my-feeds/update", methods=["POST"])
 @auth.login_required
 def refresh_all_user_feeds():
     follows = Follows.query.filter_by(username=g.user.username).all()
-    feeds = Feed.query.filter(Feed.id.in_([item.feed_id for item in follows])).all()
-    update_tasks = list()
+    feeds = Feed.query.filter(Feed.id.in_([item.feed_id for item in follows])).order_by(Feed.id).all()
+    return start_refresh_job(feeds)
+
+
+@app.route("/api/refresh-jobs/<int:job_id>")
+@auth.login_required
+def get_refresh_job(job_id):
+    job = RefreshJob.query.filter_by(id=job_id, username=g.user.username).first()
+    if not job:
+        log_and_raise(app.logger, RefreshJobNotFound(f"Refresh job '{job_id}' not found", 404))
+    return jsonify(job.serialize()), 200
+
+
+@app.route("/api/scraper/stats")
+@auth.login_required
+def get_scraper_stats():
+    return jsonify({'locks': lock_stats(app.config)}), 200
+
+
+@app.route("/api/scraper/breakers")
+@auth.login_required
+def get_scraper_breakers():
+    feeds = Feed.query.order_by(Feed.id).all()
+    return jsonify([feed.serialize_breaker() for feed in feeds]), 200
+
+
+def start_refresh_job(feeds):
+    """Opens a refresh job of the current user for some feeds and queues a scrape of each feed on the workers
+
+    A feed already being scraped, on request or by the periodic task, is not scraped again: the job joins its run.
+
+    :return A 202 response with the job, whose progress is reported by get_refresh_job
+    """
+    job = RefreshJob(username=g.user.username, created_at=datetime.now(pytz.utc))
+    sql_db.session.add(job)
+    sql_db.session.flush()
+    created_runs = list()
     for feed in feeds:
+        run_id, created = scrape_runs.open_run(feed.id, scrape_runs.PENDING, app.config)
+        sql_db.session.add(RefreshJobRun(job_id=job.id, run_id=run_id))
+        if created:
+            created_runs.append(run_id)
+    sql_db.session.commit()
+
+    for run_id in created_runs:
+        try:
+            refresh_feed.delay(run_id)
+        except Exception as err:
+            app.logger.error(f"Queuing scrape run '{run_id}' failed: {err!r}")
+            scrape_runs.finish_run(run_id, err)
+            sql_db.session.commit()
+
+    app.logger.info(f"User '{g.user.username}' requested the refresh of {len(feeds)} feeds as job '{job.id}'")
+    response = make_response(jsonify(job.serialize()), 202)
+    response.headers["Location"] = f"/api/refresh-jobs/{job.id}"
+    return response
+
+
+def follows_any_feed(username) -> bool:
+    """Checks with a single EXISTS query whether a user follows at least one feed"""
+    return sql_db.session.query(Follows.query.filter_by(username=username).exists()).scalar()
+
+
+def get_read_up_to_keyset():
+    """Reads the optional upper bound of a 'mark all as read' request body as a (published, id) keyset
+
+    The bound is either the 'until' ISO 8601 timestamp, items published up to it are read, or the 'until_item_id' of
+    an item, that item and every item listed after it in the newest first timelines are read.
+    """
+    body = request.get_json(silent=True) or {}
+    until, until_item_id = body.get('until'), body.get('until_item_id')
+    if until is not None and until_item_id is not None:
+        log_and_raise(app.logger,
+                      InvalidParameter("Only one of 'until' and 'until_item_id' can be set", 400, payload=body))
+
+    if until is not None:
         try:
-            scraper = Scraper({"url": feed.url, "parser": feed.parser, "time_format": feed.time_format})
-            feed_items = scraper.parse()
-            scraper.persist(feed_items)
-        except Exception:
-            update_tasks.append({"feed_id": f"{feed.id}", "status": "FAILED"})
-        else:
-            scrape_single.delay(feed={"url": feed.url}, from_app=True, no_op=True)
-            update_tasks.append({"feed_id": f"{feed.id}", "status": "SUCCESSFUL"})
+            until = datetime.fromisoformat(until)
+        except (TypeError, ValueError):
+            log_and_raise(app.logger, InvalidParameter("'until' must be an ISO 8601 timestamp", 400, payload=body))
+        return until if until.tzinfo else until.replace(tzinfo=pytz.utc), MAX_ITEM_ID
+
+    if until_item_id is not None:
+        item = FeedItem.query.get(until_item_id)
+        if not item:
+            log_and_raise(app.logger, FeedNotFound("Item id not found", 404, payload=body))
+        return item.published, item.id
+
+    return None
+
+
+def item_list_response(query, empty_message=None, feed_id=None):
+    """Serializes the FeedItems of a query, paginated when the request asks for it
+
+    Without the 'limit' and 'cursor' query parameters the whole list is returned as it always was, otherwise a page
+    of at most 'limit' items is returned along with the 'next_cursor' to be sent back for the following page.
+    The list only changes with the read state of the user and with the items version of the feeds it is made of, when
+    none of them changed since the client's last request the query is not even run.
+
+    :param query: The FeedItem query ordered by (published, id) descending
+    :param empty_message: Message returned instead of an empty list when the request is not paginated
+    :param feed_id: The feed the items belong to, None for all the feeds the user follows
+    """
+    items_versions = sql_db.session.query(Feed.id, Feed.items_version) \
+        .join(Follows, Follows.feed_id == Feed.id) \
+        .filter(Follows.username == g.user.username)
+    if feed_id is not None:
+        items_versions = items_versions.filter(Feed.id == feed_id)
+    return conditional_response(lambda: serialize_item_list(query, empty_message), g.user.username,
+                                g.user.read_state_version, items_versions.order_by(Feed.id).all())
+
+
+def serialize_item_list(query, empty_message=None):
+    if "limit" not in request.args and "cursor" not in request.args:
+        items = query.all()
+        if not items and empty_message:
+            return jsonify({'message': empty_message}), 200
+        return jsonify([item.serialize() for item in items]), 200
+
+    limit = request.args.get("limit", str(app.config.get("PAGE_SIZE_DEFAULT")))
+    if not limit.isdigit() or int(limit) <= 0:
+        log_and_raise(app.logger, InvalidParameter("'limit' must be a positive integer", 400))
+    limit = min(int(limit), app.config.get("PAGE_SIZE_MAX"))
+    try:
+        items, next_cursor = paginate(query, limit, request.args.get("cursor"))
+    except ValueError as err:
+        log_and_raise(app.logger, InvalidParameter(str(err), 400))
+    return jsonify({'items': [item.serialize() for item in items], 'next_cursor': next_cursor}), 200
+
+
+def conditional_response(build_response, *version_markers):
+    """Answers with a weak ETag derived from cheap version markers, and with a 304 when the client already has it
+
+    :param build_response: Callable building the response, only called when the client's copy is outdated
+    :param version_markers: Values that change whenever the response would, hashed along with the requested URL
+    """
+    markers = json.dumps([request.full_path, *version_markers], default=str)
+    etag = hashlib.sha1(markers.encode("utf-8")).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(build_response())
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def get_non_negative_int(body, key, default=None):
+    """Reads an optional non negative integer parameter from a request body
+
+    :param body: The decoded JSON request body
+    :param key: The name of the parameter
+    :param default: The value returned when the parameter is missing
+    :raises InvalidParameter: When the parameter is not a non negative integer
+    """
+    value = body.get(key, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        log_and_raise(app.logger,
+                      InvalidParameter(f"'{key}' must be a non negative integer", 400, payload=body))
+    return value
+
+
+@app.route("/api/tokens", methods=["POST"])
+@basic_auth.login_required
+def issue_token():
+    token = token_serializer().dumps(g.user.username)
+    return jsonify({'token': token, 'expires_in': app.config.get("AUTH_TOKEN_TTL")}), 200
 
-    return jsonify(update_tasks), 200
 
+def token_serializer() -> URLSafeTimedSerializer:
+    """Builds the serializer signing the authentication tokens with the application's SECRET_KEY"""
+    return URLSafeTimedSerializer(app.config.get("SECRET_KEY"), salt="auth-token")
 
-@auth.verify_password
+
+def credentials_digest(username, password) -> str:
+    """Keyed digest of a pair of basic credentials, so that the cache never holds a clear text password"""
+    secret_key = app.config.get("SECRET_KEY")
+    secret_key = secret_key if isinstance(secret_key, bytes) else secret_key.encode("utf-8")
+    return hmac.new(secret_key, f"{username}\0{password}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+# Basic credentials recently verified, so that clients sending them on every request do not pay PBKDF2 every time
+verified_credentials = TTLCache(app.config.get("AUTH_CACHE_SIZE"), app.config.get("AUTH_CACHE_TTL"))
+
+
+@basic_auth.verify_password
 def verify_password(username, password):
+    digest = credentials_digest(username, password)
+    if verified_credentials.get(digest) == username:
+        g.user = User.query.get(username)
+        return g.user is not None
+
     user = User.query.filter_by(username=username).first()
     if not user or not user.verify_password(password):
         return False
+    verified_credentials.set(digest, username)
     g.user = user
     return True
 
 
+@token_auth.verify_token
+def verify_token(token):
+    try:
+        username = token_serializer().loads(token, max_age=app.config.get("AUTH_TOKEN_TTL"))
+    except BadSignature:
+        return False
+    g.user = User.query.get(username)
+    return g.user is not None
+
+
 @app.errorhandler(HTTPException)
 def internal_server_error(error):
     sql_db.session.rollback()
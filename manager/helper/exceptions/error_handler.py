@@ -18,6 +18,10 @@ class MissingRequiredParameter(BaseErrorResponse):
     pass
 
 
+class InvalidParameter(BaseErrorResponse):
+    pass
+
+
 class UserExists(BaseErrorResponse):
     pass
 
@@ -30,6 +34,10 @@ class FeedNotFound(BaseErrorResponse):
     pass
 
 
+class FeedExists(BaseErrorResponse):
+    pass
+
+
 class FeedNotFollowed(BaseErrorResponse):
     pass
 
@@ -38,6 +46,10 @@ class FeedAlreadyFollowed(BaseErrorResponse):
     pass
 
 
+class RefreshJobNotFound(BaseErrorResponse):
+    pass
+
+
 class InternalServerError(BaseErrorResponse):
     pass
 
@@ -0,0 +1,64 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_, tuple_
+
+from manager.db_model import FeedItem
+
+
+def newest_first() -> tuple:
+    """The ORDER BY of a newest first listing of FeedItems, the items without a publication time coming last"""
+    return FeedItem.published.desc().nullslast(), FeedItem.id.desc()
+
+
+def encode_cursor(item: FeedItem) -> str:
+    """Builds the opaque cursor pointing right after the given FeedItem in a newest first listing
+
+    :param item: The last FeedItem of the returned page
+    :return The urlsafe base64 encoding of the (published, id) keyset of the item, published being null for an item
+        without a publication time
+    """
+    keyset = [item.published.isoformat() if item.published else None, item.id]
+    return base64.urlsafe_b64encode(json.dumps(keyset).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Reads the (published, id) keyset out of a cursor built by encode_cursor
+
+    :param cursor: The opaque cursor sent back by the client
+    :raises ValueError: When the cursor was not built by encode_cursor
+    """
+    try:
+        published, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(published) if published is not None else None, int(item_id)
+    except (TypeError, ValueError, UnicodeError) as err:
+        raise ValueError(f"Invalid cursor '{cursor}'") from err
+
+
+def after_cursor(published, item_id):
+    """The keyset condition selecting the FeedItems listed after the given keyset in the order of newest_first"""
+    if published is None:
+        # Only undated items of lower ids are left after an undated item
+        return and_(FeedItem.published.is_(None), FeedItem.id < item_id)
+    return or_(tuple_(FeedItem.published, FeedItem.id) < tuple_(published, item_id), FeedItem.published.is_(None))
+
+
+def paginate(query, limit: int, cursor: str = None) -> tuple:
+    """Fetches a single page of a FeedItem query ordered by (published, id) descending, see newest_first
+
+    The page is selected with a keyset condition instead of an OFFSET, so deep pages are as cheap as the first one.
+
+    :param query: The FeedItem query, already ordered by newest_first
+    :param limit: The maximum number of items in the page
+    :param cursor: The cursor returned along with the previous page, None for the first page
+    :return The items of the page and the cursor of the next page, None when this is the last page
+    """
+    if cursor is not None:
+        published, item_id = decode_cursor(cursor)
+        query = query.filter(after_cursor(published, item_id))
+
+    items = query.limit(limit + 1).all()
+    if len(items) > limit:
+        return items[:limit], encode_cursor(items[limit - 1])
+    return items, None
@@ -0,0 +1,561 @@
+import abc
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytz
+from flask import current_app
+from sqlalchemy import and_, exists, func, literal, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from manager import sql_db
+from manager.db_model import Feed, FeedItem, Follows, Read, ReadException, ReadMark, Unread, UnreadCounter, User
+from manager.helper.pagination import newest_first
+
+# Item id of a watermark built from a timestamp, so that every item published at that time is below the watermark
+MAX_ITEM_ID = 2 ** 31 - 1
+
+
+def item_keyset():
+    """The (published, id) keyset that orders the items of a timeline"""
+    return tuple_(FeedItem.published, FeedItem.id)
+
+
+class ReadState(abc.ABC):
+    """Upkeep of the UnreadCounter rows, shared by the read state models
+
+    Every change to the read state updates the counters of the (user, feed) pairs it touches in the same transaction,
+    either by applying the known difference or by counting again the unread items of those pairs only.
+    """
+
+    @abc.abstractmethod
+    def unread_items(self, username):
+        """The query of the items a user has not read yet in the feeds they follow, counted by refresh_counters"""
+
+    def refresh_counters(self, username, feed_id=None):
+        """Counts again the unread items of a user, in a feed or in all the feeds they follow, and stores the counters
+
+        :param username: The user whose counters are refreshed
+        :param feed_id: The feed whose counter is refreshed, None for all the followed feeds
+        """
+        counts = self.unread_items(username).order_by(None)
+        if feed_id is not None:
+            counts = counts.filter(FeedItem.feed_id == feed_id)
+        counts = counts.with_entities(FeedItem.feed_id, func.count().label("unread_count")) \
+            .group_by(FeedItem.feed_id).subquery()
+
+        # Followed feeds without unread items get a counter of 0
+        counters = sql_db.session.query(literal(username), Follows.feed_id, func.coalesce(counts.c.unread_count, 0)) \
+            .outerjoin(counts, counts.c.feed_id == Follows.feed_id) \
+            .filter(Follows.username == username)
+        if feed_id is not None:
+            counters = counters.filter(Follows.feed_id == feed_id)
+        statement = insert(UnreadCounter.__table__) \
+            .from_select(["username", "feed_id", "unread_count"], counters.statement)
+        sql_db.session.execute(statement.on_conflict_do_update(
+            index_elements=["username", "feed_id"], set_={"unread_count": statement.excluded.unread_count}))
+
+    @staticmethod
+    def follow_horizon(feed_id, backfill_limit=None, backfill_days=None) -> tuple:
+        """The (published, id) keyset of the oldest item of a feed that is part of the timeline of a new follower
+
+        :param feed_id: The followed feed
+        :param backfill_limit: Maximum number of already scraped items to be unread, None for no limit
+        :param backfill_days: Only already scraped items published in the last days are unread, None for no limit
+        :return The keyset, (None, None) when every item of the feed is part of the timeline
+        """
+        horizons = list()
+        if backfill_days is not None:
+            horizons.append((datetime.now(pytz.utc) - timedelta(days=backfill_days), 0))
+        if backfill_limit is not None:
+            newest_items = sql_db.session.query(FeedItem.published, FeedItem.id) \
+                .filter(FeedItem.feed_id == feed_id) \
+                .order_by(FeedItem.published.desc(), FeedItem.id.desc())
+            if backfill_limit:
+                oldest_backfilled = newest_items.offset(backfill_limit - 1).first()
+                if oldest_backfilled:
+                    horizons.append(tuple(oldest_backfilled))
+            else:
+                newest = newest_items.first()
+                if newest:
+                    horizons.append((newest.published, newest.id + 1))
+        return max(horizons) if horizons else (None, None)
+
+    @staticmethod
+    def decrement_counters(username, read_counts):
+        """Subtracts from the counters of a user the number of items they just read in each feed
+
+        :param username: The user that read the items
+        :param read_counts: (feed_id, number of items read) pairs
+        """
+        for feed_id, read in read_counts:
+            UnreadCounter.query.filter_by(username=username, feed_id=feed_id) \
+                .update({UnreadCounter.unread_count: UnreadCounter.unread_count - read}, synchronize_session=False)
+
+    def drop_counter(self, username, feed_id):
+        UnreadCounter.query.filter_by(username=username, feed_id=feed_id).delete(synchronize_session=False)
+
+    def reconcile_counters(self):
+        """Recomputes every counter from the source tables and drops the counters of the feeds no longer followed"""
+        followed = exists().where(and_(Follows.username == UnreadCounter.username,
+                                       Follows.feed_id == UnreadCounter.feed_id))
+        UnreadCounter.query.filter(~followed).delete(synchronize_session=False)
+        for username, in sql_db.session.query(Follows.username).distinct():
+            self.refresh_counters(username)
+
+
+class UnreadRowsReadState(ReadState):
+    """Read state stored as one Unread row per item a user still has to read and one Read row per item already read
+
+    The Unread rows are fanned out on write, when a user starts following a feed and whenever new items of a followed
+    feed are scraped.
+    """
+
+    def follow(self, username, feed_id, backfill_limit=None, backfill_days=None):
+        """Marks as unread the already scraped items of a feed that a user just started following
+
+        :param username: The user following the feed
+        :param feed_id: The followed feed
+        :param backfill_limit: Maximum number of items to mark as unread, newest first, None for no limit
+        :param backfill_days: Only mark as unread the items published in the last days, None for no limit
+        """
+        # The backfill is done server side with a single INSERT ... SELECT statement
+        # Items that are still in the user's history, from a previous follow, are not backfilled as unread
+        already_read = exists().where(and_(Read.username == username, Read.item_id == FeedItem.id))
+        backfill = sql_db.session.query(literal(username), FeedItem.id, FeedItem.feed_id) \
+            .filter(FeedItem.feed_id == feed_id, ~already_read)
+        if backfill_days is not None:
+            backfill = backfill.filter(FeedItem.published >= datetime.now(pytz.utc) - timedelta(days=backfill_days))
+        if backfill_limit is not None:
+            backfill = backfill.order_by(FeedItem.published.desc(), FeedItem.id.desc()).limit(backfill_limit)
+        sql_db.session.execute(
+            insert(Unread.__table__).from_select(["username", "item_id", "feed_id"], backfill.statement)
+            .on_conflict_do_nothing(index_elements=["username", "item_id"]))
+        self.refresh_counters(username, feed_id)
+
+    def unfollow(self, username, feed_id, keep_history=False):
+        """Drops the read state of a user for a feed with bulk DELETE statements
+
+        :param username: The user that stopped following the feed
+        :param feed_id: The unfollowed feed
+        :param keep_history: Whether the items already read are kept
+        """
+        Unread.query.filter_by(username=username, feed_id=feed_id).delete(synchronize_session=False)
+        if not keep_history:
+            Read.query.filter_by(username=username, feed_id=feed_id).delete(synchronize_session=False)
+        self.drop_counter(username, feed_id)
+
+    def add_items(self, feed_id, item_ids, chunk_size=None):
+        """Marks newly scraped items as unread for every user following their feed
+
+        The Unread rows are fanned out server side by INSERT ... SELECT statements from the Follows of the feed, each
+        one also adding the rows it inserted to the counters of its followers. With a chunk_size the followers are
+        taken chunk_size at a time and each chunk is committed on its own, so that the size of the transactions does
+        not grow with the followers of the feed.
+
+        The first commit also stores the items, along with the oldest of them as the fanout_item_id of the Feed, which
+        the last chunk clears. A fan out failing in between is resumed by the next call for the feed, even without new
+        items: the items from fanout_item_id on are fanned out again, skipping the followers that already have them
+        unread or read.
+
+        :param feed_id: The feed the items were scraped from
+        :param item_ids: The ids of the FeedItems just inserted
+        :param chunk_size: Number of followers fanned out per transaction, None for a single statement
+        """
+        pending = sql_db.session.query(Feed.fanout_item_id).filter(Feed.id == feed_id).scalar()
+        if pending is not None:
+            unfinished = FeedItem.query.filter(FeedItem.feed_id == feed_id, FeedItem.id >= pending) \
+                .with_entities(FeedItem.id)
+            item_ids = sorted(set(item_ids) | {item_id for item_id, in unfinished})
+        if not item_ids:
+            return
+        if chunk_size is None:
+            self.fan_out(feed_id, item_ids)
+            if pending is not None:
+                self.mark_fan_out(feed_id, None)
+            return
+        last_username = None
+        while True:
+            followers = Follows.query.filter(Follows.feed_id == feed_id)
+            if last_username is not None:
+                followers = followers.filter(Follows.username > last_username)
+            usernames = [username for username, in followers.with_entities(Follows.username)
+                         .order_by(Follows.username).limit(chunk_size + 1)]
+            last = len(usernames) <= chunk_size
+            usernames = usernames[:chunk_size]
+            if last_username is None and not last:
+                self.mark_fan_out(feed_id, min(item_ids))
+            elif last and (last_username is not None or pending is not None):
+                self.mark_fan_out(feed_id, None)
+            if usernames:
+                self.fan_out(feed_id, item_ids, Follows.username.between(usernames[0], usernames[-1]))
+            sql_db.session.commit()
+            if last:
+                return
+            last_username = usernames[-1]
+
+    @staticmethod
+    def mark_fan_out(feed_id, item_id):
+        """Stores the oldest item of the fan out of a feed in progress, None once it is over"""
+        Feed.query.filter(Feed.id == feed_id).update({Feed.fanout_item_id: item_id}, synchronize_session=False)
+
+    @staticmethod
+    def fan_out(feed_id, item_ids, *criteria):
+        """Inserts the Unread rows of the followers of a feed matching the criteria and updates their counters"""
+        # A user that already read an item, e.g. before a failed fan out was resumed, does not get it back unread
+        already_read = exists().where(and_(Read.username == Follows.username, Read.item_id == FeedItem.id))
+        unreads = select([Follows.username, FeedItem.id, Follows.feed_id]) \
+            .where(and_(Follows.feed_id == feed_id, FeedItem.id.in_(item_ids), ~already_read, *criteria))
+        # A user that followed the feed after the items were inserted already has them unread
+        fanned_out = insert(Unread.__table__).from_select(["username", "item_id", "feed_id"], unreads) \
+            .on_conflict_do_nothing(index_elements=["username", "item_id"]) \
+            .returning(Unread.username).cte("fanned_out")
+        counts = select([fanned_out.c.username, func.count().label("unread_count")]) \
+            .group_by(fanned_out.c.username).alias("counts")
+        sql_db.session.execute(
+            UnreadCounter.__table__.update()
+            .values(unread_count=UnreadCounter.unread_count + counts.c.unread_count)
+            .where(and_(UnreadCounter.feed_id == feed_id, UnreadCounter.username == counts.c.username)))
+        # Each chunk of followers committed on its own gets the new items in their lists
+        touch_feed_items(feed_id)
+
+    def unread_items(self, username):
+        """Builds the query of the unread FeedItems of a user in the feeds they still follow, newest first"""
+        # Joined on the feed of the item rather than the one of the Unread row, which is NULL for legacy rows until the
+        # b7d3e5a91c26 migration has filled it
+        return FeedItem.query.join(Unread, Unread.item_id == FeedItem.id) \
+            .join(Follows, and_(Follows.username == Unread.username, Follows.feed_id == FeedItem.feed_id)) \
+            .filter(Unread.username == username) \
+            .order_by(*newest_first())
+
+    def read_items(self, username):
+        """Builds the query of the read FeedItems of a user in the feeds they still follow, newest first"""
+        return FeedItem.query.join(Read, Read.item_id == FeedItem.id) \
+            .join(Follows, and_(Follows.username == Read.username, Follows.feed_id == Read.feed_id)) \
+            .filter(Read.username == username) \
+            .order_by(*newest_first())
+
+    def mark_item_as_read(self, username, item):
+        """Marks a single item as read, whether or not it was unread"""
+        unread = Unread.query.filter_by(username=username, item_id=item.id).delete(synchronize_session=False)
+        if unread:
+            self.decrement_counters(username, [(item.feed_id, unread)])
+        sql_db.session.execute(
+            insert(Read.__table__).values(username=username, item_id=item.id, feed_id=item.feed_id)
+            .on_conflict_do_nothing(index_elements=["username", "item_id"]))
+
+    def mark_as_read(self, username, *criteria):
+        """Moves the unread items of a user to the read ones with two set based statements
+
+        :param username: The user that read the items
+        :param criteria: SQL conditions on FeedItem selecting the items that were read
+        """
+        unreads = sql_db.session.query(Unread.username, Unread.item_id, Unread.feed_id) \
+            .join(FeedItem, FeedItem.id == Unread.item_id) \
+            .filter(Unread.username == username, *criteria)
+        sql_db.session.execute(
+            insert(Read.__table__).from_select(["username", "item_id", "feed_id"], unreads.statement)
+            .on_conflict_do_nothing(index_elements=["username", "item_id"]))
+
+        # Only the unread rows that were just copied are deleted, rows inserted in the meantime by a scrape are kept
+        already_read = exists().where(and_(Read.username == Unread.username, Read.item_id == Unread.item_id))
+        copied = [Unread.username == username, already_read]
+        if criteria:
+            copied.append(Unread.item_id.in_(sql_db.session.query(FeedItem.id).filter(*criteria).subquery()))
+        deleted = sql_db.session.execute(Unread.__table__.delete().where(and_(*copied)).returning(Unread.feed_id))
+        self.decrement_counters(username, Counter(row.feed_id for row in deleted).items())
+
+    def mark_all_as_read(self, username, feed_id=None, until=None):
+        """Marks as read every unread item of a feed, or of all the followed feeds, up to a keyset
+
+        :param username: The user that read the items
+        :param feed_id: The feed whose items were read, None for all the feeds
+        :param until: The (published, id) keyset of the newest item read, None to read everything
+        """
+        criteria = list()
+        if feed_id is not None:
+            criteria.append(FeedItem.feed_id == feed_id)
+        if until is not None:
+            criteria.append(item_keyset() <= tuple_(*until))
+        self.mark_as_read(username, *criteria)
+
+
+class WatermarkReadState(ReadState):
+    """Read state stored as a ReadMark watermark per followed feed plus the sparse ReadException items read out of order
+
+    Nothing is written for the users when new items are scraped. An item is unread when it is newer than the horizon
+    and the watermark of the user for its feed, and it is not an exception. Since the timeline is ordered by
+    publication time, items scraped late with a publication time older than the watermark are considered read.
+    """
+
+    @staticmethod
+    def after_horizon():
+        return or_(ReadMark.since.is_(None), item_keyset() >= tuple_(ReadMark.since, ReadMark.since_item_id))
+
+    @staticmethod
+    def below_watermark():
+        return and_(ReadMark.read_until.isnot(None),
+                    item_keyset() <= tuple_(ReadMark.read_until, ReadMark.read_until_item_id))
+
+    @staticmethod
+    def is_exception(username):
+        return exists().where(and_(ReadException.username == username, ReadException.item_id == FeedItem.id))
+
+    def follow(self, username, feed_id, backfill_limit=None, backfill_days=None):
+        """Sets the horizon of the timeline of a feed that a user just started following
+
+        A watermark left by a previous follow of the same feed is kept.
+
+        :param username: The user following the feed
+        :param feed_id: The followed feed
+        :param backfill_limit: Maximum number of already scraped items to be unread, None for no limit
+        :param backfill_days: Only already scraped items published in the last days are unread, None for no limit
+        """
+        since, since_item_id = self.follow_horizon(feed_id, backfill_limit, backfill_days)
+        statement = insert(ReadMark.__table__).values(
+            username=username, feed_id=feed_id, since=since, since_item_id=since_item_id)
+        sql_db.session.execute(statement.on_conflict_do_update(
+            index_elements=["username", "feed_id"],
+            set_={"since": statement.excluded.since, "since_item_id": statement.excluded.since_item_id}))
+        self.refresh_counters(username, feed_id)
+
+    def unfollow(self, username, feed_id, keep_history=False):
+        """Drops the read state of a user for a feed, unless it is kept as history
+
+        :param username: The user that stopped following the feed
+        :param feed_id: The unfollowed feed
+        :param keep_history: Whether the watermark and the exceptions are kept
+        """
+        if not keep_history:
+            ReadException.query.filter_by(username=username, feed_id=feed_id).delete(synchronize_session=False)
+            ReadMark.query.filter_by(username=username, feed_id=feed_id).delete(synchronize_session=False)
+        self.drop_counter(username, feed_id)
+
+    def add_items(self, feed_id, item_ids, chunk_size=None):
+        """New items are unread for the followers of their feed without writing anything but their counters
+
+        Each counter grows by the number of new items after the horizon and the watermark of its user, with a single
+        UPDATE statement whatever the chunk_size.
+        """
+        if not item_ids:
+            return
+        unread = select([func.count(FeedItem.id)]) \
+            .where(and_(FeedItem.id.in_(item_ids),
+                        ReadMark.username == UnreadCounter.username, ReadMark.feed_id == UnreadCounter.feed_id,
+                        self.after_horizon(), ~self.below_watermark())) \
+            .as_scalar()
+        UnreadCounter.query.filter_by(feed_id=feed_id) \
+            .update({UnreadCounter.unread_count: UnreadCounter.unread_count + unread}, synchronize_session=False)
+
+    def timeline(self, username):
+        """Builds the query of the FeedItems of the feeds a user follows, joined with the ReadMark of their feed"""
+        return FeedItem.query.join(ReadMark, ReadMark.feed_id == FeedItem.feed_id) \
+            .join(Follows, and_(Follows.username == ReadMark.username, Follows.feed_id == ReadMark.feed_id)) \
+            .filter(ReadMark.username == username)
+
+    def unread_items(self, username):
+        """Builds the query of the unread FeedItems of a user, newest first"""
+        return self.timeline(username) \
+            .filter(self.after_horizon(), ~self.below_watermark(), ~self.is_exception(username)) \
+            .order_by(*newest_first())
+
+    def read_items(self, username):
+        """Builds the query of the read FeedItems of a user in the feeds they still follow, newest first"""
+        return self.timeline(username) \
+            .filter(or_(and_(self.after_horizon(), self.below_watermark()), self.is_exception(username))) \
+            .order_by(*newest_first())
+
+    def mark_item_as_read(self, username, item):
+        """Marks a single item as read, even when it is older than the horizon"""
+        read = self.add_exceptions(username, FeedItem.id == item.id, self.after_horizon(), ~self.below_watermark())
+        self.add_exceptions(username, FeedItem.id == item.id, ~self.after_horizon())
+        self.decrement_counters(username, read.items())
+
+    def mark_as_read(self, username, *criteria):
+        """Marks as read the unread items of a user matching the criteria
+
+        :param username: The user that read the items
+        :param criteria: SQL conditions on FeedItem selecting the items that were read
+        """
+        read = self.add_exceptions(username, self.after_horizon(), ~self.below_watermark(), *criteria)
+        self.decrement_counters(username, read.items())
+
+    def add_exceptions(self, username, *criteria):
+        """Stores the items matching the criteria as exceptions, then moves the watermarks past the contiguous ones
+
+        :return The number of exceptions stored per feed
+        """
+        items = self.timeline(username).filter(*criteria) \
+            .with_entities(literal(username), FeedItem.id, FeedItem.feed_id)
+        statement = insert(ReadException.__table__) \
+            .from_select(["username", "item_id", "feed_id"], items.statement) \
+            .on_conflict_do_nothing() \
+            .returning(ReadException.feed_id)
+        stored = Counter(row.feed_id for row in sql_db.session.execute(statement))
+        for feed_id in stored:
+            self.compact(username, feed_id)
+        return stored
+
+    def compact(self, username, feed_id):
+        """Moves the watermark of a feed right before its oldest unread item, dropping the exceptions it moves past"""
+        oldest_unread = self.unread_items(username) \
+            .filter(FeedItem.feed_id == feed_id) \
+            .order_by(None).order_by(FeedItem.published, FeedItem.id) \
+            .with_entities(FeedItem.published, FeedItem.id).first()
+
+        newest_read = sql_db.session.query(FeedItem.published, FeedItem.id) \
+            .join(ReadException, ReadException.item_id == FeedItem.id) \
+            .filter(ReadException.username == username, ReadException.feed_id == feed_id)
+        if oldest_unread:
+            newest_read = newest_read.filter(item_keyset() < tuple_(*oldest_unread))
+        newest_read = newest_read.order_by(FeedItem.published.desc(), FeedItem.id.desc()).first()
+
+        if newest_read:
+            self.move_watermark(username, feed_id, tuple(newest_read))
+
+    def mark_all_as_read(self, username, feed_id=None, until=None):
+        """Moves forward the watermark of a feed, or of all the followed feeds, and drops the exceptions below it
+
+        :param username: The user that read the items
+        :param feed_id: The feed whose items were read, None for all the feeds
+        :param until: The (published, id) keyset of the newest item read, None to read everything
+        """
+        if until is None:
+            counters = UnreadCounter.query.filter_by(username=username)
+            if feed_id is not None:
+                counters = counters.filter_by(feed_id=feed_id)
+            counters.update({UnreadCounter.unread_count: 0}, synchronize_session=False)
+        else:
+            # Only the unread items up to the keyset are counted, before the watermark moves past them
+            read = self.unread_items(username).order_by(None).filter(item_keyset() <= tuple_(*until))
+            if feed_id is not None:
+                read = read.filter(FeedItem.feed_id == feed_id)
+            self.decrement_counters(username, read.with_entities(FeedItem.feed_id, func.count())
+                                    .group_by(FeedItem.feed_id))
+        self.move_watermark(username, feed_id, until)
+
+    def move_watermark(self, username, feed_id=None, until=None):
+        if until is None:
+            newest = select([FeedItem.published, FeedItem.id]) \
+                .where(FeedItem.feed_id == ReadMark.feed_id) \
+                .order_by(FeedItem.published.desc(), FeedItem.id.desc()) \
+                .limit(1)
+            until = (newest.with_only_columns([FeedItem.published]).as_scalar(),
+                     newest.with_only_columns([FeedItem.id]).as_scalar())
+
+        followed = exists().where(and_(Follows.username == ReadMark.username, Follows.feed_id == ReadMark.feed_id))
+        watermark = tuple_(ReadMark.read_until, ReadMark.read_until_item_id)
+        moved = ReadMark.query.filter(ReadMark.username == username, followed,
+                                      or_(ReadMark.read_until.is_(None), watermark < tuple_(*until)))
+        if feed_id is not None:
+            moved = moved.filter(ReadMark.feed_id == feed_id)
+        moved.update({ReadMark.read_until: until[0], ReadMark.read_until_item_id: until[1]},
+                     synchronize_session=False)
+
+        below_watermark = exists().where(and_(
+            ReadMark.username == ReadException.username, ReadMark.feed_id == ReadException.feed_id,
+            FeedItem.id == ReadException.item_id, self.below_watermark()))
+        dropped = ReadException.query.filter(ReadException.username == username, below_watermark)
+        if feed_id is not None:
+            dropped = dropped.filter(ReadException.feed_id == feed_id)
+        dropped.delete(synchronize_session=False)
+
+
+class ReadRowsReadState(UnreadRowsReadState):
+    """Read state computed on read: only the items already read are stored, as Read rows
+
+    Nothing is written for the users when new items are scraped but their counters. An item is unread when it belongs
+    to a feed the user follows, it is newer than the horizon set on the Follows row when the user started following
+    the feed, and it has no Read row. The horizon honours the backfill settings, so that the items of the timeline are
+    the ones the 'unreads' model would have fanned out.
+    """
+
+    @staticmethod
+    def after_horizon():
+        return or_(Follows.since.is_(None), item_keyset() >= tuple_(Follows.since, Follows.since_item_id))
+
+    @staticmethod
+    def is_read(username):
+        return exists().where(and_(Read.username == username, Read.item_id == FeedItem.id))
+
+    def follow(self, username, feed_id, backfill_limit=None, backfill_days=None):
+        """Sets the horizon of the timeline of a feed that a user just started following
+
+        :param username: The user following the feed
+        :param feed_id: The followed feed
+        :param backfill_limit: Maximum number of already scraped items to be unread, None for no limit
+        :param backfill_days: Only already scraped items published in the last days are unread, None for no limit
+        """
+        since, since_item_id = self.follow_horizon(feed_id, backfill_limit, backfill_days)
+        Follows.query.filter_by(username=username, feed_id=feed_id) \
+            .update({Follows.since: since, Follows.since_item_id: since_item_id}, synchronize_session=False)
+        self.refresh_counters(username, feed_id)
+
+    def add_items(self, feed_id, item_ids, chunk_size=None):
+        """New items are unread for the followers of their feed without writing anything but their counters
+
+        Each counter grows by the number of new items after the horizon of its user, with a single UPDATE statement
+        whatever the chunk_size.
+        """
+        if not item_ids:
+            return
+        unread = select([func.count(FeedItem.id)]) \
+            .where(and_(FeedItem.id.in_(item_ids),
+                        Follows.username == UnreadCounter.username, Follows.feed_id == UnreadCounter.feed_id,
+                        self.after_horizon())) \
+            .as_scalar()
+        UnreadCounter.query.filter_by(feed_id=feed_id) \
+            .update({UnreadCounter.unread_count: UnreadCounter.unread_count + unread}, synchronize_session=False)
+
+    def unread_items(self, username):
+        """Builds the query of the unread FeedItems of a user, the items of their timeline without a Read row"""
+        return FeedItem.query.join(Follows, Follows.feed_id == FeedItem.feed_id) \
+            .filter(Follows.username == username, self.after_horizon(), ~self.is_read(username)) \
+            .order_by(*newest_first())
+
+    def mark_item_as_read(self, username, item):
+        """Marks a single item as read, whether or not it was unread"""
+        unread = sql_db.session.query(self.unread_items(username).order_by(None).filter(FeedItem.id == item.id)
+                                      .exists()).scalar()
+        read = sql_db.session.execute(
+            insert(Read.__table__).values(username=username, item_id=item.id, feed_id=item.feed_id)
+            .on_conflict_do_nothing(index_elements=["username", "item_id"]))
+        if unread and read.rowcount:
+            self.decrement_counters(username, [(item.feed_id, read.rowcount)])
+
+    def mark_as_read(self, username, *criteria):
+        """Stores the Read rows of the unread items of a user matching the criteria with a single statement
+
+        :param username: The user that read the items
+        :param criteria: SQL conditions on FeedItem selecting the items that were read
+        """
+        unread = self.unread_items(username).order_by(None).filter(*criteria) \
+            .with_entities(literal(username), FeedItem.id, FeedItem.feed_id)
+        read = sql_db.session.execute(
+            insert(Read.__table__).from_select(["username", "item_id", "feed_id"], unread.statement)
+            .on_conflict_do_nothing(index_elements=["username", "item_id"])
+            .returning(Read.feed_id))
+        self.decrement_counters(username, Counter(row.feed_id for row in read).items())
+
+
+read_state_models = {
+    "unreads": UnreadRowsReadState(),
+    "watermark": WatermarkReadState(),
+    "reads": ReadRowsReadState(),
+}
+
+
+def touch_read_state(username):
+    """Bumps the read state version of a user, invalidating the ETags of their feed and item lists"""
+    User.query.filter_by(username=username) \
+        .update({User.read_state_version: User.read_state_version + 1}, synchronize_session=False)
+
+
+def touch_feed_items(feed_id):
+    """Bumps the items version of a feed, invalidating the ETags of the item lists it is part of"""
+    Feed.query.filter_by(id=feed_id) \
+        .update({Feed.items_version: Feed.items_version + 1}, synchronize_session=False)
+
+
+def get_read_state():
+    """Returns the read state model configured for the running application"""
+    return read_state_models[current_app.config.get("READ_STATE_MODEL", "unreads")]
@@ -0,0 +1,25 @@
+"""
+Revision ID: 0a4c7f93e1d6
+Revises: d52a8e4c1b07
+Create Date: 2026-10-18 16:12:30.804519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0a4c7f93e1d6'
+down_revision = 'd52a8e4c1b07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The existing follows keep every item of their feed in their timeline
+    op.add_column('follows', sa.Column('since', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('follows', sa.Column('since_item_id', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('follows', 'since_item_id')
+    op.drop_column('follows', 'since')
@@ -0,0 +1,44 @@
+"""
+Revision ID: 3b1e5d0f7a92
+Revises: c6bea77c5216
+Create Date: 2026-10-18 15:02:41.318052
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '3b1e5d0f7a92'
+down_revision = 'c6bea77c5216'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feed_items', sa.Column('guid', sa.String(length=2000), nullable=True))
+
+    # The RSS guid of the stored items is unknown, they are keyed by the hash of their link and title like the items
+    # without one
+    op.execute("UPDATE feed_items SET guid = md5(coalesce(url, '') || chr(10) || coalesce(title, ''))")
+
+    # Keeping the first copy of the items stored more than once, along with the read state of their copies
+    op.execute("CREATE TEMPORARY TABLE duplicate_feed_items AS "
+               "SELECT id, min(id) OVER (PARTITION BY feed_id, guid) AS kept_id FROM feed_items")
+    op.execute("DELETE FROM duplicate_feed_items WHERE id = kept_id")
+    for table in ('reads', 'unreads', 'read_exceptions'):
+        op.execute(f"DELETE FROM {table} t USING duplicate_feed_items d "
+                   f"WHERE t.item_id = d.id AND EXISTS "
+                   f"(SELECT 1 FROM {table} k WHERE k.username = t.username AND k.item_id = d.kept_id)")
+        op.execute(f"UPDATE {table} t SET item_id = d.kept_id FROM duplicate_feed_items d WHERE t.item_id = d.id")
+    op.execute("DELETE FROM feed_items i USING duplicate_feed_items d WHERE i.id = d.id")
+    op.execute("DROP TABLE duplicate_feed_items")
+
+    op.alter_column('feed_items', 'guid', nullable=False)
+    op.create_unique_constraint('uq_feed_items_feed_id_guid', 'feed_items', ['feed_id', 'guid'])
+
+    # The unread counters of the duplicates are stale: run the 'reconcile_counters' command after the upgrade
+
+
+def downgrade():
+    op.drop_constraint('uq_feed_items_feed_id_guid', 'feed_items', type_='unique')
+    op.drop_column('feed_items', 'guid')
@@ -0,0 +1,22 @@
+"""
+Revision ID: 3b7e9f12c4d8
+Revises: a4d8c2f61e37
+Create Date: 2026-10-19 10:12:41.228306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '3b7e9f12c4d8'
+down_revision = 'a4d8c2f61e37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('fanout_item_id', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feeds', 'fanout_item_id')
@@ -0,0 +1,49 @@
+"""
+Revision ID: 5c93e0b7a1f4
+Revises: e81f4a6d2c95
+Create Date: 2026-10-18 18:12:47.905316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '5c93e0b7a1f4'
+down_revision = 'e81f4a6d2c95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'scrape_runs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('feed_id', sa.Integer(), sa.ForeignKey('feeds.id'), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('started_at', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('error', sa.String(length=1000), nullable=True),
+    )
+    # At most one run in flight per feed, the refresh requests made meanwhile join it
+    op.create_index('uq_scrape_runs_feed_id_in_flight', 'scrape_runs', ['feed_id'], unique=True,
+                    postgresql_where=sa.text("status IN ('PENDING', 'RUNNING')"))
+    op.create_table(
+        'refresh_jobs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('username', sa.String(), sa.ForeignKey('users.username'), nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    )
+    op.create_index('ix_refresh_jobs_username', 'refresh_jobs', ['username'])
+    op.create_table(
+        'refresh_job_runs',
+        sa.Column('job_id', sa.Integer(), sa.ForeignKey('refresh_jobs.id'), primary_key=True),
+        sa.Column('run_id', sa.Integer(), sa.ForeignKey('scrape_runs.id'), primary_key=True),
+    )
+    op.create_index('ix_refresh_job_runs_run_id', 'refresh_job_runs', ['run_id'])
+
+
+def downgrade():
+    op.drop_table('refresh_job_runs')
+    op.drop_table('refresh_jobs')
+    op.drop_table('scrape_runs')
@@ -0,0 +1,27 @@
+"""
+Revision ID: 5d2a8c7e41b9
+Revises: 3b7e9f12c4d8
+Create Date: 2026-10-19 14:36:05.812944
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '5d2a8c7e41b9'
+down_revision = '3b7e9f12c4d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The newest first listings put the undated items last, unlike the default NULLS FIRST of a descending index
+    op.drop_index('ix_feed_items_feed_id_published', table_name='feed_items')
+    op.create_index('ix_feed_items_feed_id_published', 'feed_items',
+                    ['feed_id', sa.text('published DESC NULLS LAST'), sa.text('id DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_feed_items_feed_id_published', table_name='feed_items')
+    op.create_index('ix_feed_items_feed_id_published', 'feed_items',
+                    ['feed_id', sa.text('published DESC'), sa.text('id DESC')])
@@ -0,0 +1,22 @@
+"""
+Revision ID: 69efae069903
+Revises: 6f191c47b13a
+Create Date: 2026-10-18 12:58:40.172305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '69efae069903'
+down_revision = '6f191c47b13a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('read_state_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'read_state_version')
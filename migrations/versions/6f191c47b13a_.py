@@ -0,0 +1,39 @@
+"""
+Revision ID: 6f191c47b13a
+Revises: 9c699faa4fe2
+Create Date: 2026-10-18 12:21:09.318840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '6f191c47b13a'
+down_revision = '9c699faa4fe2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'unread_counters',
+        sa.Column('username', sa.String(), sa.ForeignKey('users.username'), primary_key=True),
+        sa.Column('feed_id', sa.Integer(), sa.ForeignKey('feeds.id'), primary_key=True),
+        sa.Column('unread_count', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    # Counting the unread rows of the default 'unreads' read state model, deployments using the 'watermark' model
+    # recompute the counters with 'python db_initializer.py reconcile_counters' after the upgrade. The rows are counted
+    # in the feed of their item, the unread rows fanned out by the former scraper having no feed_id
+    op.execute("""
+        INSERT INTO unread_counters (username, feed_id, unread_count)
+        SELECT f.username, f.feed_id, count(u.id)
+        FROM follows f
+        LEFT JOIN (unreads u JOIN feed_items fi ON fi.id = u.item_id)
+            ON u.username = f.username AND fi.feed_id = f.feed_id
+        GROUP BY f.username, f.feed_id
+    """)
+
+
+def downgrade():
+    op.drop_table('unread_counters')
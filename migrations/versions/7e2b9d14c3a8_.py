@@ -0,0 +1,30 @@
+"""
+Revision ID: 7e2b9d14c3a8
+Revises: 0a4c7f93e1d6
+Create Date: 2026-10-18 16:58:47.113920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = '7e2b9d14c3a8'
+down_revision = '0a4c7f93e1d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Every feed is due right after the upgrade, its schedule is computed by its first scrape
+    op.add_column('feeds', sa.Column('next_due', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('feeds', sa.Column('ttl', sa.Integer(), nullable=True))
+    op.add_column('feeds', sa.Column('skip_hours', postgresql.ARRAY(sa.Integer()), nullable=True))
+    op.create_index(op.f('ix_feeds_next_due'), 'feeds', ['next_due'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_feeds_next_due'), table_name='feeds')
+    op.drop_column('feeds', 'skip_hours')
+    op.drop_column('feeds', 'ttl')
+    op.drop_column('feeds', 'next_due')
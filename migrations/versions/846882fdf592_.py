@@ -0,0 +1,24 @@
+"""
+Revision ID: 846882fdf592
+Revises: 69efae069903
+Create Date: 2026-10-18 13:24:55.604471
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '846882fdf592'
+down_revision = '69efae069903'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('etag', sa.String(length=1024), nullable=True))
+    op.add_column('feeds', sa.Column('last_modified', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feeds', 'last_modified')
+    op.drop_column('feeds', 'etag')
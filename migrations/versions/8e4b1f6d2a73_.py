@@ -0,0 +1,22 @@
+"""
+Revision ID: 8e4b1f6d2a73
+Revises: 5d2a8c7e41b9
+Create Date: 2026-10-19 16:02:48.377120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '8e4b1f6d2a73'
+down_revision = '5d2a8c7e41b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('items_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('feeds', 'items_version')
@@ -0,0 +1,48 @@
+"""
+Revision ID: 9c699faa4fe2
+Revises: c72c10c076a0
+Create Date: 2026-10-18 11:03:27.551092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '9c699faa4fe2'
+down_revision = 'c72c10c076a0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Dropping the duplicates left by concurrent requests before the unique constraints can be created
+    for table, columns in (('follows', ('username', 'feed_id')),
+                           ('reads', ('username', 'item_id')),
+                           ('unreads', ('username', 'item_id'))):
+        duplicate = " AND ".join(f"newer.{column} = older.{column}" for column in columns)
+        op.execute(f"DELETE FROM {table} newer USING {table} older WHERE {duplicate} AND newer.id > older.id")
+
+    op.create_unique_constraint('uq_feeds_url', 'feeds', ['url'])
+    op.create_unique_constraint('uq_follows_username_feed_id', 'follows', ['username', 'feed_id'])
+    op.create_unique_constraint('uq_reads_username_item_id', 'reads', ['username', 'item_id'])
+    op.create_unique_constraint('uq_unreads_username_item_id', 'unreads', ['username', 'item_id'])
+
+    op.create_index('ix_feed_items_feed_id_published', 'feed_items',
+                    ['feed_id', sa.text('published DESC'), sa.text('id DESC')])
+    op.create_index('ix_follows_feed_id_username', 'follows', ['feed_id', 'username'])
+    op.create_index('ix_reads_username_feed_id_item_id', 'reads', ['username', 'feed_id', 'item_id'])
+    op.create_index('ix_unreads_username_feed_id_item_id', 'unreads', ['username', 'feed_id', 'item_id'])
+    op.create_index('ix_read_exceptions_username_feed_id', 'read_exceptions', ['username', 'feed_id'])
+
+
+def downgrade():
+    op.drop_index('ix_read_exceptions_username_feed_id', table_name='read_exceptions')
+    op.drop_index('ix_unreads_username_feed_id_item_id', table_name='unreads')
+    op.drop_index('ix_reads_username_feed_id_item_id', table_name='reads')
+    op.drop_index('ix_follows_feed_id_username', table_name='follows')
+    op.drop_index('ix_feed_items_feed_id_published', table_name='feed_items')
+
+    op.drop_constraint('uq_unreads_username_item_id', 'unreads', type_='unique')
+    op.drop_constraint('uq_reads_username_item_id', 'reads', type_='unique')
+    op.drop_constraint('uq_follows_username_feed_id', 'follows', type_='unique')
+    op.drop_constraint('uq_feeds_url', 'feeds', type_='unique')
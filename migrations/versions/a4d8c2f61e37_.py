@@ -0,0 +1,24 @@
+"""
+Revision ID: a4d8c2f61e37
+Revises: 5c93e0b7a1f4
+Create Date: 2026-10-18 18:47:20.613958
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'a4d8c2f61e37'
+down_revision = '5c93e0b7a1f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('lease_owner', sa.String(length=32), nullable=True))
+    op.add_column('feeds', sa.Column('lease_expires_at', sa.TIMESTAMP(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feeds', 'lease_expires_at')
+    op.drop_column('feeds', 'lease_owner')
@@ -0,0 +1,27 @@
+"""
+Revision ID: b7d3e5a91c26
+Revises: 8e4b1f6d2a73
+Create Date: 2026-10-20 09:14:37.602518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'b7d3e5a91c26'
+down_revision = '8e4b1f6d2a73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The unread rows fanned out by the former scraper have no feed_id, so that unfollowing a feed left them behind
+    op.execute("""
+        UPDATE unreads u SET feed_id = fi.feed_id
+        FROM feed_items fi
+        WHERE u.item_id = fi.id AND u.feed_id IS NULL
+    """)
+
+
+def downgrade():
+    pass
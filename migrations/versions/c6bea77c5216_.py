@@ -0,0 +1,26 @@
+"""
+Revision ID: c6bea77c5216
+Revises: 846882fdf592
+Create Date: 2026-10-18 14:07:13.885129
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'c6bea77c5216'
+down_revision = '846882fdf592'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('sorted_by_date', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+    # Both feeds declared in config.py list their items newest first
+    op.execute("UPDATE feeds SET sorted_by_date = true "
+               "WHERE url IN ('http://www.nu.nl/rss/Algemeen', 'https://feeds.feedburner.com/tweakers/mixed')")
+
+
+def downgrade():
+    op.drop_column('feeds', 'sorted_by_date')
@@ -0,0 +1,73 @@
+"""
+Revision ID: c72c10c076a0
+Revises: 86fa213c8c6d
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'c72c10c076a0'
+down_revision = '86fa213c8c6d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'read_marks',
+        sa.Column('username', sa.String(), sa.ForeignKey('users.username'), primary_key=True),
+        sa.Column('feed_id', sa.Integer(), sa.ForeignKey('feeds.id'), primary_key=True),
+        sa.Column('since', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('since_item_id', sa.Integer(), nullable=True),
+        sa.Column('read_until', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('read_until_item_id', sa.Integer(), nullable=True),
+    )
+    op.create_table(
+        'read_exceptions',
+        sa.Column('username', sa.String(), sa.ForeignKey('users.username'), primary_key=True),
+        sa.Column('item_id', sa.Integer(), sa.ForeignKey('feed_items.id'), primary_key=True),
+        sa.Column('feed_id', sa.Integer(), sa.ForeignKey('feeds.id'), nullable=True),
+    )
+
+    # Converting the reads / unreads rows of every follow: the horizon is the oldest item the user has a row for, the
+    # watermark is the newest read item older than the oldest unread one and the newer read items are exceptions
+    op.execute("""
+        INSERT INTO read_marks (username, feed_id, since, since_item_id, read_until, read_until_item_id)
+        SELECT f.username, f.feed_id,
+               COALESCE(first_item.published, now()), COALESCE(first_item.id, 0),
+               last_read.published, last_read.id
+        FROM (SELECT DISTINCT username, feed_id FROM follows) f
+        LEFT JOIN LATERAL (
+            SELECT fi.published, fi.id FROM feed_items fi
+            WHERE fi.feed_id = f.feed_id
+              AND (EXISTS (SELECT 1 FROM reads r WHERE r.username = f.username AND r.item_id = fi.id)
+                   OR EXISTS (SELECT 1 FROM unreads u WHERE u.username = f.username AND u.item_id = fi.id))
+            ORDER BY fi.published, fi.id LIMIT 1
+        ) first_item ON true
+        LEFT JOIN LATERAL (
+            SELECT fi.published, fi.id FROM unreads u JOIN feed_items fi ON fi.id = u.item_id
+            WHERE u.username = f.username AND fi.feed_id = f.feed_id
+            ORDER BY fi.published, fi.id LIMIT 1
+        ) first_unread ON true
+        LEFT JOIN LATERAL (
+            SELECT fi.published, fi.id FROM reads r JOIN feed_items fi ON fi.id = r.item_id
+            WHERE r.username = f.username AND fi.feed_id = f.feed_id
+              AND (first_unread.id IS NULL OR (fi.published, fi.id) < (first_unread.published, first_unread.id))
+            ORDER BY fi.published DESC, fi.id DESC LIMIT 1
+        ) last_read ON true
+    """)
+    op.execute("""
+        INSERT INTO read_exceptions (username, item_id, feed_id)
+        SELECT DISTINCT r.username, r.item_id, fi.feed_id
+        FROM reads r
+        JOIN feed_items fi ON fi.id = r.item_id
+        JOIN read_marks m ON m.username = r.username AND m.feed_id = fi.feed_id
+        WHERE m.read_until IS NULL OR (fi.published, fi.id) > (m.read_until, m.read_until_item_id)
+    """)
+
+
+def downgrade():
+    op.drop_table('read_exceptions')
+    op.drop_table('read_marks')
@@ -0,0 +1,24 @@
+"""
+Revision ID: d52a8e4c1b07
+Revises: 3b1e5d0f7a92
+Create Date: 2026-10-18 15:41:09.527316
+
+"""
+from alembic import op
+
+
+revision = 'd52a8e4c1b07'
+down_revision = '3b1e5d0f7a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The followers of a feed are fanned out in chunks, walking the index by username. 9c699faa4fe2 creates it
+    # already, only the databases upgraded by its first version still have the index on feed_id alone
+    op.execute("CREATE INDEX IF NOT EXISTS ix_follows_feed_id_username ON follows (feed_id, username)")
+    op.execute("DROP INDEX IF EXISTS ix_follows_feed_id")
+
+
+def downgrade():
+    pass
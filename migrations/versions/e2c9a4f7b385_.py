@@ -0,0 +1,26 @@
+"""
+Revision ID: e2c9a4f7b385
+Revises: b7d3e5a91c26
+Create Date: 2026-10-20 11:42:05.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'e2c9a4f7b385'
+down_revision = 'b7d3e5a91c26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scrape_runs', sa.Column('lease_wait_seconds', sa.Float(), nullable=True))
+    op.add_column('scrape_runs', sa.Column('lease_hold_seconds', sa.Float(), nullable=True))
+    op.create_index(op.f('ix_scrape_runs_finished_at'), 'scrape_runs', ['finished_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scrape_runs_finished_at'), table_name='scrape_runs')
+    op.drop_column('scrape_runs', 'lease_hold_seconds')
+    op.drop_column('scrape_runs', 'lease_wait_seconds')
@@ -0,0 +1,28 @@
+"""
+Revision ID: e81f4a6d2c95
+Revises: 7e2b9d14c3a8
+Create Date: 2026-10-18 17:36:02.441207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'e81f4a6d2c95'
+down_revision = '7e2b9d14c3a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feeds', sa.Column('breaker_state', sa.String(length=16), nullable=False, server_default='closed'))
+    op.add_column('feeds', sa.Column('failure_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('feeds', sa.Column('retry_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('feeds', sa.Column('last_error', sa.String(length=1000), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feeds', 'last_error')
+    op.drop_column('feeds', 'retry_at')
+    op.drop_column('feeds', 'failure_count')
+    op.drop_column('feeds', 'breaker_state')
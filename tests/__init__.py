@@ -4,6 +4,8 @@ from sqlalchemy_utils import database_exists, drop_database, create_database
 
 from config import TestConfig
 from manager import create_app, sql_db
+from manager.celery_periodic.scraper import recently_stored_items
+from manager.read_state import get_read_state
 
 
 def basic_auth_headers(username: str, password: str) -> dict:
@@ -12,7 +14,7 @@ def basic_auth_headers(username: str, password: str) -> dict:
 
 
 class TestWrapper(unittest.TestCase):
-    app = create_app()
+    app = create_app("testing")
     client = app.test_client()
     database = sql_db
     url = TestConfig.SQLALCHEMY_DATABASE_URI
@@ -24,8 +26,13 @@ class TestWrapper(unittest.TestCase):
             drop_database(cls.url)
         create_database(cls.url)
 
+        recently_stored_items.clear()
         with cls.app.app_context():
             sql_db.create_all()
             items = generate_setup()
             sql_db.session.add_all(items)
+            get_read_state().reconcile_counters()
+            # The fixtures have hardcoded ids, the rows created by the tests get theirs from the sequences
+            for table in ("feeds", "feed_items"):
+                sql_db.session.execute(f"SELECT setval('{table}_id_seq', (SELECT max(id) FROM {table}))")
             sql_db.session.commit()
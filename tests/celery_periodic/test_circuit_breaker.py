@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+from requests import HTTPError
+
+from manager import sql_db
+from manager.celery_periodic import circuit_breaker, tasks
+from manager.db_model import Feed
+from tests import TestWrapper
+from tests.celery_periodic.test_fetcher import rss_document
+from tests.utils import FeedServer
+
+NOW = datetime(2020, 11, 12, 10, tzinfo=pytz.utc)
+
+
+class TestCircuitBreaker(TestWrapper):
+    def get_feed(self, feed_id=1):
+        sql_db.session.expire_all()
+        return Feed.query.get(feed_id)
+
+    def test_backoff(self):
+        config = {"SCRAPE_BREAKER_THRESHOLD": 3, "SCRAPE_BREAKER_BACKOFF": 60, "SCRAPE_BREAKER_MAX_BACKOFF": 600}
+        for failure_count, delay in ((3, 60), (4, 120), (5, 240), (6, 480), (7, 600), (1000, 600)):
+            backoff = circuit_breaker.backoff(failure_count, config).total_seconds()
+            self.assertTrue(delay / 2 <= backoff <= delay, (failure_count, backoff))
+
+    def test_open_probe_and_close(self):
+        config = self.app.config
+        with self.app.app_context():
+            for _ in range(config.get("SCRAPE_BREAKER_THRESHOLD")):
+                self.assertEqual("closed", self.get_feed().breaker_state)
+                circuit_breaker.record_failure(1, ConnectionError("refused"), config, NOW)
+                sql_db.session.commit()
+            feed = self.get_feed()
+            retry_at = feed.retry_at
+            self.assertEqual("open", feed.breaker_state)
+            self.assertLessEqual(NOW + timedelta(seconds=30), retry_at)
+
+            self.assertFalse(circuit_breaker.acquire_probe(1, config, NOW))
+            # Only one of the processes whose backoff is over gets the probe
+            self.assertTrue(circuit_breaker.acquire_probe(1, config, retry_at))
+            self.assertFalse(circuit_breaker.acquire_probe(1, config, retry_at))
+            self.assertEqual("half_open", self.get_feed().breaker_state)
+
+            circuit_breaker.record_success(1)
+            sql_db.session.commit()
+            feed = self.get_feed()
+            self.assertEqual(("closed", 0, None, None),
+                             (feed.breaker_state, feed.failure_count, feed.retry_at, feed.last_error))
+
+    def test_error_status_opens_breaker(self):
+        documents = {"/rss.xml": {"body": b"<html>Internal error</html>", "status": 500}}
+        config = {"SCRAPE_BREAKER_THRESHOLD": 2, "SCRAPE_MIN_INTERVAL": 0, "SCRAPE_MAX_INTERVAL": 0}
+        with FeedServer(documents) as server, patch.dict(self.app.config, config), self.app.app_context():
+            feed = Feed(url=server.url("/rss.xml"), parser="lxml", time_format="%a, %d %b %Y %H:%M:%S %z")
+            sql_db.session.add(feed)
+            sql_db.session.commit()
+            feed_id = feed.id
+
+            # A server error fails the periodic scrape and the refresh of the feed alike
+            tasks.scrape_feeds.run([feed_id])
+            feed = self.get_feed(feed_id)
+            self.assertEqual(("closed", 1), (feed.breaker_state, feed.failure_count))
+            self.assertIn("500", feed.last_error)
+            self.assertIsInstance(tasks.scrape_feed(feed_id), HTTPError)
+            feed = self.get_feed(feed_id)
+            self.assertEqual(("open", 2), (feed.breaker_state, feed.failure_count))
+
+            # The feed serving its document again closes the breaker
+            documents["/rss.xml"] = {"body": rss_document("back")}
+            self.assertIsNone(tasks.scrape_feed(feed_id))
+            feed = self.get_feed(feed_id)
+            self.assertEqual(("closed", 0), (feed.breaker_state, feed.failure_count))
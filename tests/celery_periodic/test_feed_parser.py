@@ -0,0 +1,140 @@
+import unittest
+from datetime import datetime
+
+import pytz
+
+from manager.celery_periodic.feed_parser import DocumentTooLarge, PublishedTimeParser, StreamingFeedParser, \
+    item_key, parse_iso_8601_time, parse_rfc_822_time
+
+
+
+
+def rss_document(*days) -> bytes:
+    items = "".join(f"<item><title>Item {day}</title><link>https://www.nu.nl/{day}</link>"
+                    f"<description><![CDATA[<p>Desc {day}</p>]]></description>"
+                    f"<pubDate>{day:02d} Nov 2020 10:00:00 +0000</pubDate></item>" for day in days)
+    return f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>{items}</channel></rss>'.encode()
+
+
+def feed_in_chunks(parser, document, size=50) -> int:
+    """Feeds a document in chunks like a download would, returns the number of chunks the parser asked for"""
+    chunks = 0
+    for start in range(0, len(document), size):
+        chunks += 1
+        if not parser.feed(document[start:start + size]):
+            break
+    return chunks
+
+
+class TestStreamingFeedParser(unittest.TestCase):
+    def test_parse_items(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z")
+        feed_in_chunks(parser, rss_document(12, 11))
+        items = parser.close()
+
+        self.assertFalse(parser.malformed)
+        self.assertListEqual(["Item 12", "Item 11"], [item["title"] for item in items])
+        self.assertDictEqual({"guid": item_key(None, "https://www.nu.nl/12", "Item 12"), "title": "Item 12",
+                              "link": "https://www.nu.nl/12", "description": "<p>Desc 12</p>",
+                              "published": datetime(2020, 11, 12, 10, tzinfo=pytz.utc)}, items[0])
+
+    def test_skip_old_items(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z", newer_than=datetime(2020, 11, 11, tzinfo=pytz.utc))
+        feed_in_chunks(parser, rss_document(12, 10, 11))
+        self.assertListEqual(["Item 12", "Item 11"], [item["title"] for item in parser.close()])
+
+    def test_stop_at_first_old_item_of_sorted_feed(self):
+        document = rss_document(*range(20, 0, -1))
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z", newer_than=datetime(2020, 11, 18, tzinfo=pytz.utc),
+                                     sorted_by_date=True)
+        chunks = feed_in_chunks(parser, document)
+
+        self.assertListEqual(["Item 20", "Item 19", "Item 18"], [item["title"] for item in parser.close()])
+        self.assertFalse(parser.malformed)
+        self.assertLess(chunks * 50, len(document) / 2)
+
+    def test_malformed_document(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z")
+        document = rss_document(12).replace(b"Item 12", b"Item & 12")
+        feed_in_chunks(parser, document)
+        parser.close()
+
+        self.assertTrue(parser.malformed)
+        self.assertEqual(document, parser.content)
+
+    def test_document_too_large(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z", max_size=100)
+        with self.assertRaises(DocumentTooLarge):
+            feed_in_chunks(parser, rss_document(12, 11))
+
+    def test_scheduling_hints(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z")
+        document = rss_document(12).replace(b"<channel>", b"<channel><ttl> 30 </ttl>"
+                                                           b"<skipHours><hour>2</hour><hour>1</hour></skipHours>")
+        feed_in_chunks(parser, document)
+        parser.close()
+        self.assertEqual(30, parser.ttl)
+        self.assertListEqual([1, 2], parser.skip_hours)
+
+    def test_parse_rdf_items(self):
+        # RSS 1.0 documents put their items in a namespace and date them with <dc:date>
+        document = b'''<?xml version="1.0" encoding="UTF-8"?>
+            <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/"
+                     xmlns:dc="http://purl.org/dc/elements/1.1/">
+            <channel rdf:about="https://www.nu.nl/"><title>nu.nl</title></channel>
+            <item rdf:about="https://www.nu.nl/12"><title>Item 12</title><link>https://www.nu.nl/12</link>
+                <description>Desc 12</description><dc:date>2020-11-12T10:00:00Z</dc:date></item>
+            <item rdf:about="https://www.nu.nl/11"><title>Item 11</title><link>https://www.nu.nl/11</link>
+                <description>Desc 11</description><dc:date>2020-11-11T10:00:00+00:00</dc:date></item>
+            </rdf:RDF>'''
+        parser = StreamingFeedParser()
+        feed_in_chunks(parser, document)
+        items = parser.close()
+
+        self.assertFalse(parser.malformed)
+        self.assertListEqual(["Item 12", "Item 11"], [item["title"] for item in items])
+        self.assertDictEqual({"guid": item_key(None, "https://www.nu.nl/12", "Item 12"), "title": "Item 12",
+                              "link": "https://www.nu.nl/12", "description": "Desc 12",
+                              "published": datetime(2020, 11, 12, 10, tzinfo=pytz.utc)}, items[0])
+
+    def test_item_key(self):
+        parser = StreamingFeedParser("%d %b %Y %H:%M:%S %z")
+        feed_in_chunks(parser, rss_document(12).replace(b"<title>", b"<guid> nu-12 </guid><title>"))
+        self.assertEqual("nu-12", parser.close()[0]["guid"])
+
+        self.assertEqual(item_key("", "https://www.nu.nl/12", "Item 12"),
+                         item_key(None, "https://www.nu.nl/12", "Item 12"))
+        self.assertNotEqual(item_key(None, "https://www.nu.nl/12", "Item 12"),
+                            item_key(None, "https://www.nu.nl/12", "Item 13"))
+
+
+class TestPublishedTimeParser(unittest.TestCase):
+    def test_rfc_822_fast_path(self):
+        for time_format, value in (("%a, %d %b %Y %H:%M:%S %z", "Tue, 10 Nov 2020 11:00:00 +0100"),
+                                   ("%a, %d %b %Y %H:%M:%S %Z", "Tue, 10 Nov 2020 10:00:00 GMT")):
+            parser = PublishedTimeParser(time_format)
+            self.assertEqual(datetime(2020, 11, 10, 10, tzinfo=pytz.utc), parser(value))
+            self.assertIs(parse_rfc_822_time, parser.parse)
+
+    def test_iso_8601_fast_path(self):
+        parser = PublishedTimeParser()
+        self.assertEqual(datetime(2020, 11, 10, 10, tzinfo=pytz.utc), parser("2020-11-10T10:00:00Z"))
+        self.assertEqual(datetime(2020, 11, 10, 10, tzinfo=pytz.utc), parser("2020-11-10T11:00:00.250+01:00"))
+        self.assertIs(parse_iso_8601_time, parser.parse)
+
+    def test_wrong_time_format(self):
+        parser = PublishedTimeParser("%d %b %Y %H:%M:%S %z")
+        self.assertEqual(datetime(2020, 11, 10, 10, tzinfo=pytz.utc), parser("Tue, 10 Nov 2020 10:00:00 GMT"))
+
+    def test_time_format_without_fast_path(self):
+        parser = PublishedTimeParser("%d/%m/%Y %H:%M")
+        self.assertEqual(datetime(2020, 11, 10, 10, tzinfo=pytz.utc), parser("10/11/2020 10:00"))
+        self.assertEqual(parser.parse_with_format, parser.parse)
+
+        # A feed switching format is detected again
+        self.assertEqual(datetime(2020, 11, 11, 10, tzinfo=pytz.utc), parser("Wed, 11 Nov 2020 10:00:00 GMT"))
+        self.assertIs(parse_rfc_822_time, parser.parse)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            PublishedTimeParser("%d/%m/%Y %H:%M")("yesterday")
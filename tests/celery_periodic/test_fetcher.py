@@ -0,0 +1,183 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+
+from manager.celery_periodic import tasks
+from manager.celery_periodic.fetcher import FeedFetcher
+from manager.db_model import Feed, FeedItem
+from tests import TestWrapper
+from tests.utils import FeedServer
+
+
+def rss_document(*titles) -> bytes:
+    items = "".join(f"<item><title>{title}</title><link>https://www.nu.nl/{title}</link>"
+                    f"<description>Desc</description><pubDate>Thu, 12 Nov 2020 10:00:00 +0000</pubDate></item>"
+                    for title in titles)
+    return f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>{items}</channel></rss>'.encode()
+
+
+def fetch_documents(fetcher: FeedFetcher, requests: dict) -> list:
+    """Downloads the feeds like the fetch stage of a ScrapePipeline, returning the FetchedDocument of each url in the
+    order of the requests
+    """
+    async def fetch_all():
+        return {document.url: document async for document in fetcher.fetch_as_completed(requests)}
+
+    fetched = asyncio.run(fetch_all())
+    return [fetched[url] for url in requests]
+
+
+class TestFeedFetcher(unittest.TestCase):
+    def test_fetch_documents(self):
+        documents = {"/a.xml": {"body": rss_document("a"), "etag": '"a"'}, "/b.xml": {"body": rss_document("b")},
+                     "/error.xml": {"body": b"<html>Internal error</html>", "status": 500}}
+        with FeedServer(documents) as server:
+            fetched = fetch_documents(FeedFetcher(), {server.url("/a.xml"): {}, server.url("/b.xml"): {},
+                                                      server.url("/missing.xml"): {}, server.url("/error.xml"): {}})
+
+        self.assertListEqual([server.url(path) for path in ("/a.xml", "/b.xml", "/missing.xml", "/error.xml")],
+                             [document.url for document in fetched])
+        self.assertListEqual([200, 200, 404, 500], [document.status_code for document in fetched])
+        self.assertEqual(rss_document("a"), fetched[0].sink.content)
+        self.assertEqual('"a"', fetched[0].headers.get("etag"))
+        self.assertIsNone(fetched[0].error)
+        # The error pages fail their downloads, without their bodies being streamed into the sinks
+        self.assertListEqual([404, 500], [document.error.status for document in fetched[2:]])
+        self.assertEqual(b"", fetched[3].sink.content)
+
+    def test_fetch_conditional(self):
+        with FeedServer({"/a.xml": {"body": rss_document("a"), "etag": '"a"'}}) as server:
+            fetched = fetch_documents(FeedFetcher(), {server.url("/a.xml"): {"If-None-Match": '"a"'}})
+        self.assertEqual(304, fetched[0].status_code)
+        self.assertEqual(b"", fetched[0].sink.content)
+
+    def test_per_host_concurrency(self):
+        documents = {f"/{index}.xml": {"body": rss_document(index), "delay": 0.1} for index in range(6)}
+        with FeedServer(documents) as server:
+            fetched = fetch_documents(FeedFetcher(concurrency=10, per_host_concurrency=2),
+                                      {server.url(path): {} for path in documents})
+        self.assertListEqual([200] * 6, [document.status_code for document in fetched])
+        self.assertEqual(2, server.max_active_requests)
+
+    def test_read_timeout(self):
+        documents = {"/slow.xml": {"body": rss_document("slow"), "delay": 1},
+                     "/fast.xml": {"body": rss_document("fast")}}
+        with FeedServer(documents) as server:
+            fetched = fetch_documents(FeedFetcher(read_timeout=0.2), {server.url(path): {} for path in documents})
+        self.assertIsNotNone(fetched[0].error)
+        self.assertIsNone(fetched[0].status_code)
+        self.assertEqual(200, fetched[1].status_code)
+
+
+class TestScrapeTask(TestWrapper):
+    def add_feed(self, url) -> int:
+        with self.app.app_context():
+            feed = Feed(url=url, parser="lxml", time_format="%a, %d %b %Y %H:%M:%S %z",
+                        last_updated=datetime(2020, 11, 10, tzinfo=pytz.utc))
+            self.database.session.add(feed)
+            self.database.session.commit()
+            return feed.id
+
+    def test_dispatch_due_feeds_in_shards(self):
+        feed_ids = [self.add_feed(f"https://shard.example.com/{number}.xml") for number in range(3)]
+        later = datetime.now(pytz.utc) + timedelta(hours=1)
+        with self.app.app_context():
+            # Neither the feeds not due yet nor the ones leased by another scrape are dispatched
+            Feed.query.filter_by(id=feed_ids[1]).update({Feed.next_due: later})
+            Feed.query.filter_by(id=feed_ids[2]).update({Feed.lease_owner: "other", Feed.lease_expires_at: later})
+            self.database.session.commit()
+
+        config = {"SCRAPE_SHARDS": 2, "SCRAPE_DISPATCH_BATCH_SIZE": 1}
+        with patch.dict(self.app.config, config), self.app.app_context():
+            with patch.object(tasks.dispatch_shard, "delay") as dispatch_shard:
+                tasks.scrape.run()
+            self.assertListEqual([(0,), (1,)], [call.args for call in dispatch_shard.call_args_list])
+
+            # Each shard is paged by id, its due feeds are queued in batches
+            with patch.object(tasks.scrape_feeds, "apply_async") as scrape_feeds:
+                for shard in range(2):
+                    tasks.dispatch_shard.run(shard)
+            batches = [call.args[0][0] for call in scrape_feeds.call_args_list]
+            self.assertListEqual([[2], [1], [feed_ids[0]]], batches)
+            self.assertEqual(300, scrape_feeds.call_args.kwargs["expires"])
+
+    def test_scrape_all_feeds_at_once(self):
+        documents = {"/nu.xml": {"body": rss_document("nu 1", "nu 2"), "etag": '"nu"'},
+                     "/slow.xml": {"body": rss_document("slow"), "delay": 1}}
+        with FeedServer(documents) as server:
+            feed_ids = [self.add_feed(server.url(path)) for path in documents]
+
+            # Every feed is due again right after its scrape
+            config = {"SCRAPE_READ_TIMEOUT": 0.2, "SCRAPE_MIN_INTERVAL": 0, "SCRAPE_MAX_INTERVAL": 0}
+            with patch.dict(self.app.config, config), self.app.app_context():
+                tasks.scrape_feeds.run(feed_ids)
+                nu_items = FeedItem.query.join(Feed).filter(Feed.url == server.url("/nu.xml"))
+                self.assertListEqual(["nu 1", "nu 2"], sorted(item.title for item in nu_items))
+                slow_feed = Feed.query.filter_by(url=server.url("/slow.xml")).one()
+                self.assertEqual(1, slow_feed.failure_count)
+                self.assertIn("Timeout", slow_feed.last_error)
+
+                # The second scrape sends the validators and gets a 304 for the unchanged document
+                tasks.scrape_feeds.run(feed_ids)
+                self.assertIn('"nu"', [headers.get("If-None-Match") for headers in server.received_headers[2:]])
+                self.assertEqual(2, nu_items.count())
+
+    def test_scrape_due_feeds_only(self):
+        documents = {"/due.xml": {"body": rss_document("due 1")}, "/later.xml": {"body": rss_document("later 1")}}
+        with FeedServer(documents) as server:
+            feed_ids = [self.add_feed(server.url(path)) for path in documents]
+
+            with self.app.app_context():
+                tasks.scrape_feeds.run(feed_ids)
+                self.assertEqual(2, len(server.received_headers))
+
+                # Only the feed whose next scrape is due is downloaded again
+                Feed.query.filter_by(url=server.url("/due.xml")).update({Feed.next_due: datetime.now(pytz.utc)})
+                self.database.session.commit()
+                tasks.scrape_feeds.run(feed_ids)
+                self.assertEqual(3, len(server.received_headers))
+
+    def test_scrape_error_status(self):
+        documents = {"/gone.xml": {"body": rss_document("gone"), "status": 410}}
+        with FeedServer(documents) as server:
+            feed_ids = [self.add_feed(server.url("/gone.xml"))]
+            with self.app.app_context():
+                tasks.scrape_feeds.run(feed_ids)
+                self.assertEqual(0, FeedItem.query.filter_by(feed_id=feed_ids[0]).count())
+                feed = Feed.query.get(feed_ids[0])
+                self.assertEqual(1, feed.failure_count)
+                self.assertIn("410", feed.last_error)
+                self.assertIsNone(feed.etag)
+
+    def test_scrape_failing_feed_with_circuit_breaker(self):
+        # Nothing listens on port 1
+        url = "http://127.0.0.1:1/rss.xml"
+        feed_ids = [self.add_feed(url)]
+        config = {"SCRAPE_BREAKER_THRESHOLD": 2, "SCRAPE_MIN_INTERVAL": 0, "SCRAPE_MAX_INTERVAL": 0}
+        with patch.dict(self.app.config, config), self.app.app_context():
+            tasks.scrape_feeds.run(feed_ids)
+            feed = Feed.query.filter_by(url=url).one()
+            self.assertEqual(("closed", 1), (feed.breaker_state, feed.failure_count))
+
+            tasks.scrape_feeds.run(feed_ids)
+            feed = Feed.query.filter_by(url=url).one()
+            self.assertEqual(("open", 2), (feed.breaker_state, feed.failure_count))
+            retry_at = feed.retry_at
+            self.assertLess(datetime.now(pytz.utc), retry_at)
+
+            # The open breaker skips the feed until its backoff is over
+            with patch.object(tasks.ScrapePipeline, "run") as run_pipeline:
+                tasks.scrape_feeds.run(feed_ids)
+                self.assertListEqual([], run_pipeline.call_args[0][0])
+
+            # Then a single probe is sent, whose failure opens the breaker again for longer
+            Feed.query.filter_by(url=url).update({Feed.retry_at: datetime.now(pytz.utc)})
+            self.database.session.commit()
+            with patch("manager.celery_periodic.circuit_breaker.random.uniform", side_effect=lambda low, high: high):
+                tasks.scrape_feeds.run(feed_ids)
+            feed = Feed.query.filter_by(url=url).one()
+            self.assertEqual(("open", 3), (feed.breaker_state, feed.failure_count))
+            self.assertLess(retry_at + timedelta(seconds=60), feed.retry_at)
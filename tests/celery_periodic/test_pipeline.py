@@ -0,0 +1,150 @@
+import multiprocessing
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+import pytz
+
+from manager.celery_periodic import scrape_lock, scrape_runs, tasks
+from manager.celery_periodic.pipeline import FeedJob, ScrapePipeline, parse_content
+from manager.celery_periodic.scraper import Scraper
+from manager.db_model import Feed, FeedItem, ScrapeRun
+from tests import TestWrapper
+from tests.celery_periodic.test_fetcher import rss_document
+from tests.utils import FeedServer
+
+
+class TestParseContent(unittest.TestCase):
+    def test_parse_content(self):
+        parsed = parse_content(rss_document("a", "b"))
+        self.assertFalse(parsed.malformed)
+        self.assertListEqual(["a", "b"], [item["title"] for item in parsed.items])
+
+    def test_parse_malformed_content(self):
+        parsed = parse_content(b"<rss><channel><item><title>a</item></channel></rss>")
+        self.assertTrue(parsed.malformed)
+        self.assertIsNone(parsed.items)
+
+    def test_parse_sorted_content_until_old_item(self):
+        parsed = parse_content(rss_document("a", "b"), newer_than=datetime(2020, 11, 13, tzinfo=pytz.utc),
+                               sorted_by_date=True)
+        self.assertListEqual([], parsed.items)
+
+
+class TestScrapePipeline(TestWrapper):
+    def add_feeds(self, urls) -> list:
+        with self.app.app_context():
+            feeds = [Feed(url=url, parser="lxml", time_format="%a, %d %b %Y %H:%M:%S %z",
+                          last_updated=datetime(2020, 11, 10, tzinfo=pytz.utc)) for url in urls]
+            self.database.session.add_all(feeds)
+            self.database.session.commit()
+            return [feed.id for feed in feeds]
+
+    def test_persist_feeds_in_one_transaction(self):
+        documents = {f"/{index}.xml": {"body": rss_document(f"{index} a", f"{index} b")} for index in range(4)}
+        for processes in (0, 2):
+            with self.subTest(processes=processes), FeedServer(documents) as server:
+                # Nothing listens on port 1
+                urls = [server.url(path) for path in documents] + [f"http://127.0.0.1:1/{processes}.xml"]
+                feed_ids = self.add_feeds(urls)
+                with patch.dict(self.app.config, {"SCRAPE_PARSE_PROCESSES": processes}), self.app.app_context():
+                    report = tasks.scrape_feeds.run(feed_ids)
+
+                    self.assertEqual(1, report["transactions"])
+                    self.assertEqual(5, report["stages"]["fetch"]["documents"])
+                    self.assertEqual(4, report["stages"]["parse"]["documents"])
+                    self.assertEqual(8, report["stages"]["persist"]["items"])
+                    self.assertEqual(8, FeedItem.query.filter(FeedItem.feed_id.in_(feed_ids)).count())
+                    runs = ScrapeRun.query.filter(ScrapeRun.feed_id.in_(feed_ids)).order_by(ScrapeRun.feed_id)
+                    self.assertListEqual(["SUCCESSFUL"] * 4 + ["FAILED"], [run.status for run in runs])
+                    feeds = Feed.query.filter(Feed.id.in_(feed_ids)).all()
+                    self.assertListEqual([None] * 5, [feed.lease_owner for feed in feeds])
+
+    def test_persist_feeds_one_by_one_after_failure(self):
+        # The title of the item of the second feed does not fit in its column, failing the whole batch
+        documents = {"/ok.xml": {"body": rss_document("ok"), "etag": '"ok"'},
+                     "/long.xml": {"body": rss_document("long" * 100)}}
+        with FeedServer(documents) as server:
+            ok_id, long_id = self.add_feeds([server.url(path) for path in documents])
+            with self.app.app_context():
+                report = tasks.scrape_feeds.run([ok_id, long_id])
+
+                self.assertEqual(2, report["transactions"])
+                self.assertListEqual(["ok"], [item.title for item in FeedItem.query.filter_by(feed_id=ok_id)])
+                # The validators and the schedule of the document are stored with its items, despite the rollback
+                ok_feed = Feed.query.get(ok_id)
+                self.assertEqual('"ok"', ok_feed.etag)
+                self.assertIsNotNone(ok_feed.next_due)
+                self.assertEqual(0, FeedItem.query.filter_by(feed_id=long_id).count())
+                long_feed = Feed.query.get(long_id)
+                self.assertEqual(1, long_feed.failure_count)
+                self.assertIsNone(long_feed.lease_owner)
+                self.assertEqual("FAILED", ScrapeRun.query.filter_by(feed_id=long_id).one().status)
+                self.assertEqual("SUCCESSFUL", ScrapeRun.query.filter_by(feed_id=ok_id).one().status)
+
+    def test_renew_leases_when_fetching(self):
+        documents = {"/renewed.xml": {"body": rss_document("renewed")}, "/lost.xml": {"body": rss_document("lost")}}
+        with FeedServer(documents) as server:
+            feed_ids = self.add_feeds([server.url(path) for path in documents])
+            with self.app.app_context():
+                jobs = list()
+                for feed in Feed.query.filter(Feed.id.in_(feed_ids)).order_by(Feed.id):
+                    lease = scrape_lock.acquire(feed.id, self.app.config)
+                    run_id, _ = scrape_runs.open_run(feed.id, scrape_runs.RUNNING, self.app.config)
+                    jobs.append(FeedJob(Scraper(feed), feed.id, feed.url, run_id, lease))
+                # Both leases expire while the batch waits, and the second one is taken over by another scrape
+                expired = datetime.now(pytz.utc)
+                Feed.query.filter(Feed.id.in_(feed_ids)).update({Feed.lease_expires_at: expired},
+                                                                 synchronize_session=False)
+                self.database.session.commit()
+                self.assertTrue(scrape_lock.try_acquire(feed_ids[1], "other", self.app.config))
+
+                ScrapePipeline(self.app.config).run(jobs)
+
+                self.assertEqual(1, len(server.received_headers))
+                items = FeedItem.query.filter_by(feed_id=feed_ids[0])
+                self.assertListEqual(["renewed"], [item.title for item in items])
+                runs = ScrapeRun.query.filter(ScrapeRun.feed_id.in_(feed_ids)).order_by(ScrapeRun.feed_id).all()
+                self.assertListEqual(["SUCCESSFUL", "FAILED"], [run.status for run in runs])
+                self.assertIn("LeaseLost", runs[1].error)
+                lost = Feed.query.get(feed_ids[1])
+                # The feed did not fail, the other scrape still holds its lease
+                self.assertEqual((0, "other"), (lost.failure_count, lost.lease_owner))
+
+    def scrape_in_child(self, feed_ids, reports):
+        engine = self.database.get_engine(self.app)
+        try:
+            # The child opens its own connections, the ones inherited from the parent are left alone
+            with patch.object(engine, "pool", engine.pool.recreate()), \
+                    patch.dict(self.app.config, {"SCRAPE_PARSE_PROCESSES": 2}), self.app.app_context():
+                reports.put(tasks.scrape_feeds.run(feed_ids))
+        except Exception as err:
+            reports.put(repr(err))
+
+    def test_scrape_in_daemonic_process(self):
+        # Like the children of the prefork pool of a worker, which are not allowed to start parser processes
+        documents = {"/daemon.xml": {"body": rss_document("daemon a", "daemon b")}}
+        with FeedServer(documents) as server:
+            feed_ids = self.add_feeds([server.url("/daemon.xml")])
+            context = multiprocessing.get_context("fork")
+            reports = context.Queue()
+            child = context.Process(target=self.scrape_in_child, args=(feed_ids, reports), daemon=True)
+            child.start()
+            report = reports.get(timeout=30)
+            child.join(30)
+
+        self.assertIsInstance(report, dict, report)
+        self.assertEqual(2, report["stages"]["persist"]["items"])
+        with self.app.app_context():
+            self.assertEqual(2, FeedItem.query.filter_by(feed_id=feed_ids[0]).count())
+            self.assertEqual("SUCCESSFUL", ScrapeRun.query.filter_by(feed_id=feed_ids[0]).one().status)
+
+    def test_pipeline_failure_finishes_runs(self):
+        feed_ids = self.add_feeds(["https://failing-pipeline.example.com/rss.xml"])
+        with self.app.app_context(), patch.object(tasks.ScrapePipeline, "run", side_effect=RuntimeError("broken")):
+            with self.assertRaises(RuntimeError):
+                tasks.scrape_feeds.run(feed_ids)
+            run = ScrapeRun.query.filter_by(feed_id=feed_ids[0]).one()
+            self.assertEqual("FAILED", run.status)
+            self.assertIn("broken", run.error)
+            self.assertIsNone(Feed.query.get(feed_ids[0]).lease_owner)
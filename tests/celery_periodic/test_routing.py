@@ -0,0 +1,46 @@
+import unittest
+
+from celery.bin.worker import worker
+
+from config import Config
+from manager.celery_periodic import tasks, worker_argv
+
+
+class TestTaskRouting(unittest.TestCase):
+    def route(self, task):
+        options = task.app.amqp.router.route({}, task.name)
+        return options["queue"].name, options.get("priority")
+
+    def test_refreshes_routed_apart_from_the_scrape(self):
+        self.assertEqual(("refresh", 9), self.route(tasks.refresh_feed))
+        self.assertEqual(("scrape", 8), self.route(tasks.scrape))
+        self.assertEqual(("scrape", 7), self.route(tasks.dispatch_shard))
+        self.assertEqual(("scrape", 3), self.route(tasks.scrape_feeds))
+
+    def test_queues_have_workers(self):
+        conf = tasks.scrape.app.conf
+        queues = {queue.name for queue in conf.task_queues}
+        self.assertSetEqual(queues, set(Config.WORKER_CONCURRENCY))
+        self.assertIn(conf.task_default_queue, queues)
+        self.assertEqual(10, tasks.scrape.app.amqp.queues["refresh"].queue_arguments["x-max-priority"])
+
+    def test_worker_command_line(self):
+        config = {"WORKER_CONCURRENCY": Config.WORKER_CONCURRENCY, "WORKER_POOL": Config.WORKER_POOL}
+        argv = worker_argv("refresh", config, ["-l", "info"])
+        # Parsed like celery.worker_main does, the first argument being the name of the program
+        options, _ = worker(app=tasks.scrape.app).parse_options(argv[0], argv[1:])
+        self.assertEqual("refresh", options["queues"])
+        self.assertEqual("prefork", options["pool"])
+        self.assertEqual(4, options["concurrency"])
+        self.assertEqual("refresh@%h", options["hostname"])
+        self.assertEqual("info", options["loglevel"])
+        with self.assertRaises(ValueError):
+            worker_argv("unknown", config)
+
+    def test_scrape_worker_runs_threads(self):
+        # The children of a prefork pool could not start the parser processes of the pipeline
+        argv = worker_argv("scrape", {"WORKER_CONCURRENCY": Config.WORKER_CONCURRENCY,
+                                      "WORKER_POOL": Config.WORKER_POOL})
+        options, _ = worker(app=tasks.scrape.app).parse_options(argv[0], argv[1:])
+        self.assertEqual("threads", options["pool"])
+        self.assertEqual(2, options["concurrency"])
@@ -0,0 +1,40 @@
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from manager.celery_periodic.schedule import cache_lifetime, next_due, publish_interval
+
+NOW = datetime(2020, 11, 12, 10, tzinfo=pytz.utc)
+
+
+class TestSchedule(unittest.TestCase):
+    def test_cache_lifetime(self):
+        self.assertEqual(300, cache_lifetime({"Cache-Control": "public, max-age=300"}, NOW))
+        self.assertEqual(0, cache_lifetime({"Cache-Control": "no-cache", "Expires": "Thu, 12 Nov 2020 11:00:00 GMT"},
+                                           NOW))
+        self.assertEqual(3600, cache_lifetime({"Expires": "Thu, 12 Nov 2020 11:00:00 GMT"}, NOW))
+        self.assertEqual(0, cache_lifetime({"Expires": "0"}, NOW))
+        self.assertIsNone(cache_lifetime({}, NOW))
+
+    def test_publish_interval(self):
+        # 10 items over the last 10 hours are polled every half hour
+        published_times = [NOW - timedelta(hours=hours) for hours in range(1, 11)]
+        self.assertEqual(1800, publish_interval(published_times, NOW))
+        self.assertIsNone(publish_interval([], NOW))
+
+    def test_next_due_bounds(self):
+        self.assertEqual(NOW + timedelta(seconds=60), next_due(NOW, 10, min_interval=60, max_interval=3600))
+        self.assertEqual(NOW + timedelta(seconds=600), next_due(NOW, 600, min_interval=60, max_interval=3600))
+        self.assertEqual(NOW + timedelta(seconds=3600), next_due(NOW, 86400, min_interval=60, max_interval=3600))
+        self.assertEqual(NOW + timedelta(seconds=60), next_due(NOW, None, min_interval=60, max_interval=3600))
+
+    def test_next_due_hints(self):
+        self.assertEqual(NOW + timedelta(seconds=900),
+                         next_due(NOW, 600, min_interval=60, max_interval=3600, lifetime=900))
+        self.assertEqual(NOW + timedelta(minutes=30), next_due(NOW, 600, min_interval=60, max_interval=3600, ttl=30))
+        # Due at 10:10 GMT, but the feed asks not to be scraped between 10:00 and 12:00
+        self.assertEqual(datetime(2020, 11, 12, 12, tzinfo=pytz.utc),
+                         next_due(NOW, 600, min_interval=60, max_interval=3600, skip_hours=[10, 11]))
+        self.assertEqual(NOW + timedelta(seconds=600),
+                         next_due(NOW, 600, min_interval=60, max_interval=3600, skip_hours=range(24)))
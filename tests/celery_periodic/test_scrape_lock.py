@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+
+from manager import sql_db
+from manager.celery_periodic import scrape_lock, scrape_runs, tasks
+from manager.db_model import Feed, ScrapeRun, User
+from tests import TestWrapper
+
+NOW = datetime(2020, 11, 12, 10, tzinfo=pytz.utc)
+
+
+class TestScrapeLock(TestWrapper):
+    def test_exclusive_lease(self):
+        config = self.app.config
+        with self.app.app_context():
+            self.assertTrue(scrape_lock.try_acquire(1, "first", config, NOW))
+            self.assertFalse(scrape_lock.try_acquire(1, "second", config, NOW))
+            self.assertTrue(scrape_lock.try_acquire(2, "second", config, NOW))
+
+            # An expired lease is taken over, and its former holder can no longer release it
+            expired = NOW + timedelta(seconds=config.get("SCRAPE_LOCK_LEASE"))
+            self.assertTrue(scrape_lock.try_acquire(1, "third", config, expired))
+            scrape_lock.Lease(1, "first").release()
+            self.assertEqual("third", Feed.query.get(1).lease_owner)
+            scrape_lock.Lease(1, "third").release()
+            scrape_lock.Lease(2, "second").release()
+            self.assertIsNone(Feed.query.get(1).lease_owner)
+
+    def test_lease_apart_from_session(self):
+        config = self.app.config
+        with self.app.app_context():
+            # The unit of work of the caller is neither committed nor rolled back by the lease
+            User.query.filter_by(username="user3").update({User.password: "changed"})
+            self.assertTrue(scrape_lock.try_acquire(1, "first", config, NOW))
+            lease = scrape_lock.Lease(1, "first")
+            self.assertTrue(lease.renew(config, NOW + timedelta(seconds=10)))
+            sql_db.session.rollback()
+            self.assertNotEqual("changed", User.query.get("user3").password)
+            feed = Feed.query.get(1)
+            self.assertEqual("first", feed.lease_owner)
+            self.assertEqual(NOW + timedelta(seconds=10 + config.get("SCRAPE_LOCK_LEASE")), feed.lease_expires_at)
+
+            # A lease taken over once expired can no longer be renewed by its former holder
+            expired = NOW + timedelta(seconds=10 + config.get("SCRAPE_LOCK_LEASE"))
+            self.assertTrue(scrape_lock.try_acquire(1, "second", config, expired))
+            self.assertFalse(lease.renew(config, expired))
+            scrape_lock.Lease(1, "second").release()
+
+    def test_skip_or_wait(self):
+        config = {"SCRAPE_LOCK_LEASE": 300, "SCRAPE_LOCK_WAIT_TIMEOUT": 0.2, "SCRAPE_LOCK_POLL_INTERVAL": 0.05}
+        with self.app.app_context():
+            with scrape_lock.acquire(1, config):
+                self.assertIsNone(scrape_lock.acquire(1, config))
+                self.assertIsNone(scrape_lock.acquire(1, config, wait=True))
+
+            # A waiting contender gets the lease as soon as it is released
+            lease = scrape_lock.acquire(1, config)
+            with patch.object(scrape_lock.time, "sleep", side_effect=lambda seconds: lease.release()):
+                with scrape_lock.acquire(1, config, wait=True) as waited:
+                    self.assertIsNotNone(waited)
+                    self.assertLess(0, waited.wait_seconds)
+
+    def test_lock_stats_of_finished_runs(self):
+        config = {"SCRAPE_RUN_TIMEOUT": 300, "SCRAPE_LOCK_STATS_WINDOW": 3600}
+        with self.app.app_context():
+            # The lease of a run is timed by the worker that held it, and reported by any process
+            run_id, _ = scrape_runs.open_run(2, scrape_runs.RUNNING, config, NOW)
+            scrape_runs.finish_run(run_id, now=NOW, lease=scrape_lock.Lease(2, "worker", wait_seconds=2.5))
+            sql_db.session.commit()
+            self.assertEqual(2.5, ScrapeRun.query.get(run_id).lease_wait_seconds)
+
+            stats = scrape_lock.lock_stats(config, NOW)
+            self.assertEqual(1, stats["acquired"])
+            self.assertEqual(2.5, stats["max_wait_seconds"])
+            self.assertLessEqual(0, stats["max_hold_seconds"])
+            # Only the runs finished within the window are reported
+            self.assertEqual(0, scrape_lock.lock_stats(config, NOW + timedelta(hours=2))["acquired"])
+
+    def test_entry_points_share_the_lease(self):
+        config = {"SCRAPE_LOCK_WAIT_TIMEOUT": 0}
+        with self.app.app_context(), patch.dict(self.app.config, config):
+            lease = scrape_lock.acquire(2, self.app.config)
+
+            # The periodic task skips the leased feed
+            with patch.object(tasks.ScrapePipeline, "run") as run_pipeline:
+                tasks.scrape_feeds.run([2])
+            self.assertListEqual([], run_pipeline.call_args[0][0])
+
+            # The refresh gives up once it waited for the lease long enough
+            run_id, _ = scrape_runs.open_run(2, scrape_runs.PENDING, self.app.config)
+            sql_db.session.commit()
+            with patch.object(tasks, "scrape_feed") as scrape_feed:
+                tasks.refresh_feed.run(run_id)
+            scrape_feed.assert_not_called()
+            self.assertEqual("FAILED", ScrapeRun.query.get(run_id).status)
+            lease.release()
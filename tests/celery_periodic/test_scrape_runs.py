@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+
+from manager import sql_db
+from manager.celery_periodic import scrape_runs, tasks
+from manager.db_model import ScrapeRun
+from tests import TestWrapper
+
+NOW = datetime(2020, 11, 12, 10, tzinfo=pytz.utc)
+
+
+class TestScrapeRuns(TestWrapper):
+    def get_run(self, run_id):
+        sql_db.session.expire_all()
+        return ScrapeRun.query.get(run_id)
+
+    def test_coalesce_and_finish(self):
+        config = self.app.config
+        with self.app.app_context():
+            run_id, created = scrape_runs.open_run(1, scrape_runs.PENDING, config, NOW)
+            self.assertTrue(created)
+            # Every request made while the run is in flight joins it, whatever its state
+            self.assertEqual((run_id, False), scrape_runs.open_run(1, scrape_runs.RUNNING, config, NOW))
+            self.assertEqual(1, scrape_runs.start_run(run_id, NOW))
+            self.assertIsNone(scrape_runs.start_run(run_id, NOW))
+            self.assertEqual((run_id, False), scrape_runs.open_run(1, scrape_runs.PENDING, config, NOW))
+            # The runs of the other feeds are independent
+            self.assertTrue(scrape_runs.open_run(2, scrape_runs.PENDING, config, NOW)[1])
+
+            scrape_runs.finish_run(run_id, ConnectionError("refused"), NOW)
+            sql_db.session.commit()
+            run = self.get_run(run_id)
+            self.assertEqual(("FAILED", "ConnectionError('refused')"), (run.status, run.error))
+            new_run_id, created = scrape_runs.open_run(1, scrape_runs.PENDING, config, NOW)
+            self.assertTrue(created)
+            self.assertNotEqual(run_id, new_run_id)
+            sql_db.session.rollback()
+
+    def test_timed_out_run(self):
+        config = self.app.config
+        later = NOW + timedelta(seconds=config.get("SCRAPE_RUN_TIMEOUT") + 1)
+        with self.app.app_context():
+            run_id, _ = scrape_runs.open_run(1, scrape_runs.RUNNING, config, NOW)
+            sql_db.session.commit()
+
+            # A run lost with its worker is failed, and no longer blocks the refresh of its feed
+            new_run_id, created = scrape_runs.open_run(1, scrape_runs.PENDING, config, later)
+            sql_db.session.commit()
+            self.assertTrue(created)
+            self.assertEqual(("FAILED", "Timed out"), (self.get_run(run_id).status, self.get_run(run_id).error))
+            scrape_runs.finish_run(new_run_id, now=later)
+            sql_db.session.commit()
+            self.assertEqual("SUCCESSFUL", self.get_run(new_run_id).status)
+
+    def test_scrape_task_joins_refresh(self):
+        with self.app.app_context():
+            run_id, _ = scrape_runs.open_run(2, scrape_runs.PENDING, self.app.config)
+            sql_db.session.commit()
+
+            # The periodic task leaves the feed to the run requested through the API
+            with patch.object(tasks.ScrapePipeline, "run") as run_pipeline:
+                tasks.scrape_feeds.run([2])
+            self.assertListEqual([], run_pipeline.call_args[0][0])
+            self.assertEqual("PENDING", self.get_run(run_id).status)
+            scrape_runs.finish_run(run_id)
+            sql_db.session.commit()
+
+    def test_scrape_of_deleted_feed(self):
+        # The feed of a run can be gone by the time a worker picks the run up
+        with self.app.app_context(), patch.object(tasks, "Scraper") as scraper:
+            self.assertIsInstance(tasks.scrape_feed(1000), LookupError)
+            scraper.assert_not_called()
@@ -0,0 +1,223 @@
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+import pytz
+from requests import HTTPError
+from sqlalchemy.exc import OperationalError
+
+from manager.celery_periodic.feed_parser import StreamingFeedParser
+from manager.celery_periodic.http_session import pool_stats
+from manager.celery_periodic.scraper import Scraper, recently_stored_items
+from manager import sql_db
+from manager.db_model import Feed, FeedItem, Follows, Unread, UnreadCounter, User
+from manager.read_state import UnreadRowsReadState, get_read_state
+from tests import TestWrapper, basic_auth_headers
+from tests.utils import FeedServer
+
+RSS_DOCUMENT = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>nu.nl</title>
+<item>
+<title>Item 10</title>
+<link>https://www.nu.nl/10</link>
+<description>Desc 10</description>
+<pubDate>Thu, 12 Nov 2020 10:00:00 +0000</pubDate>
+</item>
+</channel></rss>"""
+
+
+def feed_response(status_code=200, content=b"", headers=None):
+    response = MagicMock(status_code=status_code)
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [content]
+    response.headers = headers or dict()
+    return response
+
+
+class TestConditionalScrape(TestWrapper):
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_scrape_document_stores_validators(self, get_session):
+        get = get_session.return_value.get
+        get.return_value = feed_response(content=RSS_DOCUMENT,
+                                         headers={"ETag": '"abc"', "Last-Modified": "Thu, 12 Nov 2020 10:00:00 GMT"})
+        with self.app.app_context():
+            scraper = Scraper({"url": "http://www.nu.nl/rss/Algemeen"})
+            feed_items = scraper.parse()
+            scraper.persist(feed_items)
+
+            self.assertEqual({}, get.call_args[1]["headers"])
+            self.assertEqual(1, FeedItem.query.filter_by(feed_id=2, title="Item 10").count())
+            feed = Feed.query.get(2)
+            self.assertEqual('"abc"', feed.etag)
+            self.assertEqual("Thu, 12 Nov 2020 10:00:00 GMT", feed.last_modified)
+
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_scrape_not_modified(self, get_session):
+        get = get_session.return_value.get
+        get.return_value = feed_response(status_code=304)
+        with self.app.app_context():
+            scraper = Scraper({"url": "http://www.nu.nl/rss/Algemeen"})
+            with patch.object(StreamingFeedParser, "feed") as feed:
+                feed_items = scraper.parse()
+                self.assertFalse(feed.called)
+            self.assertListEqual([], feed_items)
+
+            # Only the schedule of the feed is stored
+            with patch("manager.celery_periodic.scraper.sql_db.session.execute") as execute:
+                scraper.persist(feed_items)
+                self.assertFalse(execute.called)
+            self.assertLess(datetime.now(pytz.utc), Feed.query.get(2).next_due)
+
+            self.assertDictEqual({"If-None-Match": '"abc"', "If-Modified-Since": "Thu, 12 Nov 2020 10:00:00 GMT"},
+                                 get.call_args[1]["headers"])
+
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_scrape_error_status(self, get_session):
+        get_session.return_value.get.return_value = feed_response(status_code=503, content=RSS_DOCUMENT)
+        with self.app.app_context():
+            scraper = Scraper({"url": "http://www.nu.nl/rss/Algemeen"})
+            with patch.object(StreamingFeedParser, "feed") as feed, self.assertRaises(HTTPError):
+                scraper.parse()
+            self.assertFalse(feed.called)
+
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_scrape_malformed_document(self, get_session):
+        get = get_session.return_value.get
+        document = RSS_DOCUMENT.replace(b"Item 10", b"Item 11 & more").replace(b"+0000", b"GMT")
+        get.return_value = feed_response(content=document)
+        with self.app.app_context():
+            scraper = Scraper({"url": "https://feeds.feedburner.com/tweakers/mixed"})
+            feed_items = scraper.parse()
+            self.assertListEqual(["Item 11 & more"], [item.title for item in feed_items])
+
+
+class TestIdempotentIngestion(TestWrapper):
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_retried_scrape_stores_items_once(self, get_session):
+        get_session.return_value.get.return_value = feed_response(content=RSS_DOCUMENT)
+        with self.app.app_context():
+            scraper = Scraper({"url": "http://www.nu.nl/rss/Algemeen"})
+            feed_items = scraper.parse()
+            scraper.persist(feed_items)
+            # A retry of the same scrape, e.g. after a failure past the commit
+            scraper.persist(feed_items)
+            recently_stored_items.clear()
+            scraper.persist(Scraper({"url": "http://www.nu.nl/rss/Algemeen"}).parse())
+
+            self.assertEqual(1, FeedItem.query.filter_by(feed_id=2, title="Item 10").count())
+            self.assertEqual(2, UnreadCounter.query.get(("user2", 2)).unread_count)
+
+    @patch("manager.celery_periodic.scraper.get_session")
+    def test_scrape_late_item(self, get_session):
+        # Added late to the feed: older than its newest stored item, but within the lookback window
+        document = RSS_DOCUMENT.replace(b"Item 10", b"Item 13").replace(b"Thu, 12 Nov 2020 10:00",
+                                                                          b"Wed, 11 Nov 2020 12:00")
+        get_session.return_value.get.return_value = feed_response(content=document)
+        with self.app.app_context():
+            scraper = Scraper({"url": "http://www.nu.nl/rss/Algemeen"})
+            scraper.persist(scraper.parse())
+            self.assertEqual(1, FeedItem.query.filter_by(feed_id=2, title="Item 13").count())
+
+
+class TestPooledSession(TestWrapper):
+    def test_scrapes_share_connections(self):
+        documents = {"/nu.xml": {"body": RSS_DOCUMENT.replace(b"Item 10", b"Item 12"), "etag": '"nu"'}}
+        with FeedServer(documents) as server, self.app.app_context():
+            self.database.session.add(Feed(url=server.url("/nu.xml"), parser="lxml",
+                                           time_format="%a, %d %b %Y %H:%M:%S %z",
+                                           last_updated=datetime(2020, 11, 10, tzinfo=pytz.utc)))
+            self.database.session.commit()
+
+            for _ in range(3):
+                scraper = Scraper({"url": server.url("/nu.xml")})
+                scraper.persist(scraper.parse())
+
+            self.assertEqual(1, FeedItem.query.filter_by(title="Item 12").count())
+            self.assertEqual("gzip, deflate", server.received_headers[0].get("Accept-Encoding"))
+            self.assertDictEqual({'connections': 1, 'requests': 3, 'idle': 1},
+                                 pool_stats().get(f"http://127.0.0.1:{server.server_port}"))
+
+        # The pools are the ones of the current process, the API reports the leases shared by every worker instead
+        response = self.client.get('/api/scraper/stats', headers=basic_auth_headers("user", "pass"))
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual(["locks"], list(response.get_json()))
+
+
+class TestUnreadFanOut(TestWrapper):
+    def test_fan_out_in_chunks(self):
+        with self.app.app_context():
+            for number in range(5):
+                sql_db.session.add(User(username=f"follower{number}", password="pass"))
+                sql_db.session.add(Follows(username=f"follower{number}", feed_id=1))
+            sql_db.session.flush()
+            get_read_state().reconcile_counters()
+            sql_db.session.commit()
+
+            published = datetime(2020, 11, 11, tzinfo=pytz.utc)
+            with patch.dict(self.app.config, {"SCRAPE_FANOUT_CHUNK_SIZE": 2}), \
+                    patch.object(sql_db.session, "commit", wraps=sql_db.session.commit) as commit:
+                Scraper({"url": "https://feeds.feedburner.com/tweakers/mixed"}).persist(
+                    [FeedItem(title=f"Fanned out {number}", feed_id=1, published=published) for number in range(3)])
+                # 3 chunks of the 6 followers and the Feed
+                self.assertEqual(4, commit.call_count)
+
+            item_ids = [item.id for item in FeedItem.query.filter(FeedItem.title.like("Fanned out %"))]
+            for username in ["user"] + [f"follower{number}" for number in range(5)]:
+                self.assertEqual(3, Unread.query.filter(Unread.username == username, Unread.feed_id == 1,
+                                                        Unread.item_id.in_(item_ids)).count())
+            self.assertEqual(4, UnreadCounter.query.get(("user", 1)).unread_count)
+            self.assertEqual(3, UnreadCounter.query.get(("follower4", 1)).unread_count)
+
+            # Followers that already have the items unread are not counted twice
+            get_read_state().add_items(1, item_ids, chunk_size=2)
+            sql_db.session.commit()
+            self.assertEqual(4, UnreadCounter.query.get(("user", 1)).unread_count)
+            self.assertEqual(3, UnreadCounter.query.get(("follower4", 1)).unread_count)
+
+    def test_resume_failed_fan_out(self):
+        with self.app.app_context():
+            for number in range(4):
+                sql_db.session.add(User(username=f"resumed{number}", password="pass"))
+                sql_db.session.add(Follows(username=f"resumed{number}", feed_id=2))
+            sql_db.session.flush()
+            get_read_state().reconcile_counters()
+            sql_db.session.commit()
+            fan_out = UnreadRowsReadState.fan_out
+            fan_outs = list()
+
+            def fail_second_chunk(*args):
+                fan_outs.append(args)
+                if len(fan_outs) == 2:
+                    raise OperationalError("INSERT INTO unreads", {}, None)
+                fan_out(*args)
+
+            published = datetime(2020, 11, 11, tzinfo=pytz.utc)
+            with patch.dict(self.app.config, {"SCRAPE_FANOUT_CHUNK_SIZE": 2}):
+                with patch.object(UnreadRowsReadState, "fan_out", side_effect=fail_second_chunk), \
+                        self.assertRaises(OperationalError):
+                    Scraper({"url": "http://www.nu.nl/rss/Algemeen"}).persist(
+                        [FeedItem(title=f"Resumed {number}", feed_id=2, published=published) for number in range(2)])
+
+                # The items and the first chunk of followers were committed, the fan out is left pending
+                item_ids = sorted(item.id for item in FeedItem.query.filter(FeedItem.title.like("Resumed %")))
+                self.assertEqual(2, len(item_ids))
+                self.assertEqual(item_ids[0], Feed.query.get(2).fanout_item_id)
+                self.assertEqual(2, Unread.query.filter_by(username="resumed0").filter(
+                    Unread.item_id.in_(item_ids)).count())
+                self.assertEqual(0, Unread.query.filter_by(username="user2").filter(
+                    Unread.item_id.in_(item_ids)).count())
+                get_read_state().mark_item_as_read("resumed0", FeedItem.query.get(item_ids[0]))
+                sql_db.session.commit()
+
+                # The next scrape of the feed resumes the fan out, even without new items
+                Scraper({"url": "http://www.nu.nl/rss/Algemeen"}).persist([])
+
+            self.assertIsNone(Feed.query.get(2).fanout_item_id)
+            for username in ["user2"] + [f"resumed{number}" for number in range(4)]:
+                unread = Unread.query.filter(Unread.username == username, Unread.item_id.in_(item_ids)).count()
+                # The item already read is not unread again
+                self.assertEqual(1 if username == "resumed0" else 2, unread, username)
+            counters = {counter.username: counter.unread_count for counter in UnreadCounter.query.filter_by(feed_id=2)}
+            get_read_state().reconcile_counters()
+            self.assertDictEqual(
+                {counter.username: counter.unread_count for counter in UnreadCounter.query.filter_by(feed_id=2)},
+                counters)
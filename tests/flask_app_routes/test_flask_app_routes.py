@@ -1,6 +1,15 @@
+import os
+import subprocess
+import sys
+from datetime import datetime
 from unittest.mock import patch
 
-from manager.db_model import FeedItem, Unread
+import pytz
+
+from manager.celery_periodic import tasks
+from manager.celery_periodic.scraper import Scraper
+from manager.db_model import Feed, FeedItem, Follows, Unread, Read, ReadMark, ReadException, UnreadCounter, User
+from manager.read_state import get_read_state
 from tests import TestWrapper, basic_auth_headers
 
 
@@ -46,6 +55,59 @@ class TestSignup(TestWrapper):
         self.assertEqual(400, response.status_code)
 
 
+class TestAuthentication(TestWrapper):
+    def test_issue_token_not_authenticated(self):
+        response = self.client.post('/api/tokens')
+        self.assertIsNone(response.json)
+        self.assertEqual(401, response.status_code)
+
+    def test_issue_and_use_token(self):
+        response = self.client.post('/api/tokens', headers=basic_auth_headers("user", "pass"))
+        self.assertEqual(200, response.status_code)
+        token = response.get_json().get("token")
+
+        with patch.object(User, "verify_password") as verify_password:
+            response = self.client.get('/api/my-feeds', headers={'Authorization': f'Bearer {token}'})
+            self.assertFalse(verify_password.called)
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([{'id': 1, 'url': 'https://feeds.feedburner.com/tweakers/mixed'}], response.get_json())
+
+    def test_invalid_token(self):
+        response = self.client.get('/api/my-feeds', headers={'Authorization': 'Bearer lorem_ipsum'})
+        self.assertIsNone(response.json)
+        self.assertEqual(401, response.status_code)
+
+    def test_production_requires_secret_key(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        environment = {key: value for key, value in os.environ.items() if key != "SECRET_KEY"}
+        for secret_key, returncode in ((None, 1), ("from_the_environment", 0)):
+            with self.subTest(secret_key=secret_key):
+                env = {**environment, "FLASK_ENV": "production", **({"SECRET_KEY": secret_key} if secret_key else {})}
+                loaded = subprocess.run([sys.executable, "-c", "from manager import create_app; "
+                                         "print(create_app().config['SECRET_KEY'])"],
+                                        cwd=root, env=env, capture_output=True, text=True)
+                self.assertEqual(returncode, loaded.returncode, loaded.stderr)
+                if secret_key:
+                    self.assertEqual(secret_key, loaded.stdout.strip())
+                else:
+                    self.assertIn("SECRET_KEY must be set", loaded.stderr)
+
+    def test_verified_credentials_are_cached(self):
+        response = self.client.get('/api/my-feeds', headers=basic_auth_headers("user2", "pass"))
+        self.assertEqual(200, response.status_code)
+
+        with patch.object(User, "verify_password") as verify_password:
+            response = self.client.get('/api/my-feeds', headers=basic_auth_headers("user2", "pass"))
+            self.assertFalse(verify_password.called)
+        self.assertEqual(200, response.status_code)
+
+    def test_wrong_password_is_not_cached(self):
+        response = self.client.get('/api/my-feeds', headers=basic_auth_headers("user3", "wrong"))
+        self.assertEqual(401, response.status_code)
+        response = self.client.get('/api/my-feeds', headers=basic_auth_headers("user3", "wrong"))
+        self.assertEqual(401, response.status_code)
+
+
 class TestGetFeeds(TestWrapper):
     def test_get_all_feeds_not_authenticated(self):
         response = self.client.get('/api/feeds')
@@ -63,6 +125,43 @@ class TestGetFeeds(TestWrapper):
         self.assertEqual(200, response.status_code)
 
 
+class TestRegisterFeed(TestWrapper):
+    def test_register_feed_not_authenticated(self):
+        response = self.client.post('/api/feeds', json={"url": "https://example.com/rss"})
+        self.assertEqual(401, response.status_code)
+
+    def test_register_feed_successfully(self):
+        payload = {"url": "https://example.com/rss", "time_format": "%a, %d %b %Y %H:%M:%S %z", "sorted_by_date": True}
+        response = self.client.post('/api/feeds', headers=basic_auth_headers("user", "pass"), json=payload)
+        self.assertEqual(201, response.status_code)
+        self.assertDictEqual({'id': 3, 'url': 'https://example.com/rss'}, response.json)
+
+        # The feed is scraped by the next periodic scrape and can be followed right away
+        with self.app.app_context():
+            feed = Feed.query.get(3)
+            self.assertEqual(("lxml", True, "closed", None), (feed.parser, feed.sorted_by_date, feed.breaker_state,
+                                                               feed.next_due))
+        response = self.client.post('/api/feeds/follow', headers=basic_auth_headers("user", "pass"),
+                                    json={"feed_id": 3})
+        self.assertEqual(204, response.status_code)
+
+        response = self.client.post('/api/feeds', headers=basic_auth_headers("user2", "pass"), json=payload)
+        self.assertEqual(409, response.status_code)
+        self.assertEqual("Feed 'https://example.com/rss' already exists", response.json["message"])
+
+    def test_register_feed_case_invalid(self):
+        for payload, message in (({}, "Missing 'url' in request body"),
+                                 ({"url": "ftp://example.com/rss"}, "'url' must be an http or https URL"),
+                                 ({"url": 5}, "'url' must be an http or https URL"),
+                                 ({"url": "https://example.com/a", "parser": "regex"},
+                                  "'parser' must be one of html.parser, html5lib, lxml, lxml-xml, xml"),
+                                 ({"url": "https://example.com/b", "sorted_by_date": "yes"},
+                                  "'sorted_by_date' must be a boolean")):
+            response = self.client.post('/api/feeds', headers=basic_auth_headers("user", "pass"), json=payload)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual(message, response.json["message"])
+
+
 class TestFollowFeed(TestWrapper):
     def test_follow_feed_case_feed_not_exist(self):
         response = self.client.post(
@@ -93,6 +192,32 @@ class TestFollowFeed(TestWrapper):
             self.assertIn(element.feed_id, [1, 2, 2])
         self.assertEqual(204, response.status_code)
 
+    def test_follow_feed_with_backfill_limit(self):
+        response = self.client.post(
+            '/api/feeds/follow',
+            headers=basic_auth_headers("user3", "pass"),
+            json={"feed_id": 2, "backfill_limit": 1}
+        )
+        self.assertIsNotNone(response)
+        with self.app.app_context():
+            unread_list = Unread.query.filter_by(username="user3").all()
+
+        self.assertEqual(1, len(unread_list))
+        self.assertIn(unread_list[0].item_id, [3, 4])
+        self.assertEqual(2, unread_list[0].feed_id)
+        self.assertEqual(204, response.status_code)
+
+    def test_follow_feed_with_invalid_backfill_limit(self):
+        response = self.client.post(
+            '/api/feeds/follow',
+            headers=basic_auth_headers("user2", "pass"),
+            json={"feed_id": 1, "backfill_limit": -1}
+        )
+        self.assertIsNotNone(response)
+        self.assertDictEqual({'message': "'backfill_limit' must be a non negative integer",
+                              'payload': {'feed_id': 1, 'backfill_limit': -1}}, response.json)
+        self.assertEqual(400, response.status_code)
+
     def test_follow_feed_case_already_followed(self):
         response = self.client.post(
             '/api/feeds/follow',
@@ -148,8 +273,51 @@ class TestUnfollowFeed(TestWrapper):
             unread_list = Unread.query.filter_by(username="user2").all()
 
         self.assertEqual(0, len(unread_list))
+        with self.app.app_context():
+            self.assertEqual(0, len(Read.query.filter_by(username="user2").all()))
+        self.assertEqual(204, response.status_code)
+
+    def test_unfollow_feed_keeping_history(self):
+        response = self.client.delete(
+            '/api/feeds/unfollow',
+            headers=basic_auth_headers("user", "pass"),
+            json={"feed_id": 1, "keep_history": True}
+        )
+        self.assertIsNotNone(response)
+        with self.app.app_context():
+            unread_list = Unread.query.filter_by(username="user").all()
+            read_list = Read.query.filter_by(username="user").all()
+
+        self.assertEqual(0, len(unread_list))
+        self.assertEqual(1, len(read_list))
+        self.assertEqual(2, read_list[0].item_id)
         self.assertEqual(204, response.status_code)
 
+    def test_unfollow_feed_with_legacy_unread_rows(self):
+        self.client.post('/api/users', json={"username": "legacy", "password": "pass"})
+        for feed_id in (1, 2):
+            self.client.post('/api/feeds/follow', headers=basic_auth_headers("legacy", "pass"),
+                             json={"feed_id": feed_id})
+        # Unread rows fanned out by the former scraper have no feed_id
+        with self.app.app_context():
+            feed_items = FeedItem.query.filter_by(feed_id=1).with_entities(FeedItem.id)
+            Unread.query.filter(Unread.username == "legacy", Unread.item_id.in_(feed_items.subquery())) \
+                .update({Unread.feed_id: None}, synchronize_session=False)
+            self.database.session.commit()
+
+        response = self.client.delete(
+            '/api/feeds/unfollow',
+            headers=basic_auth_headers("legacy", "pass"),
+            json={"feed_id": 1}
+        )
+        self.assertEqual(204, response.status_code)
+
+        response = self.client.get('/api/my-feeds/new', headers=basic_auth_headers("legacy", "pass"))
+        self.assertEqual(200, response.status_code)
+        with self.app.app_context():
+            feed_ids = {FeedItem.query.get(item.get("id")).feed_id for item in response.get_json()}
+        self.assertSetEqual({2}, feed_ids)
+
     def test_unfollow_feed_case_not_following(self):
         response = self.client.delete(
             '/api/feeds/unfollow',
@@ -219,6 +387,17 @@ class TestReadFeedItems(TestWrapper):
 
         self.assertEqual(204, response.status_code)
 
+    def test_read_single_item_twice(self):
+        for _ in range(2):
+            response = self.client.post(
+                '/api/items/2/read',
+                headers=basic_auth_headers("user", "pass")
+            )
+            self.assertEqual(204, response.status_code)
+
+        with self.app.app_context():
+            self.assertEqual(1, len(Read.query.filter_by(username="user", item_id=2).all()))
+
     def test_read_multiple_items_case_not_authenticated(self):
         response = self.client.post('/api/items/read-multiple')
         self.assertIsNone(response.json)
@@ -247,7 +426,80 @@ class TestReadFeedItems(TestWrapper):
         self.assertEqual(204, response.status_code)
 
 
+class TestReadAllItems(TestWrapper):
+    def test_read_all_case_both_bounds(self):
+        response = self.client.post(
+            '/api/my-feeds/read-all',
+            headers=basic_auth_headers("user", "pass"),
+            json={"until": "2020-11-10T00:00:00+00:00", "until_item_id": 1}
+        )
+        self.assertEqual("Only one of 'until' and 'until_item_id' can be set", response.get_json().get("message"))
+        self.assertEqual(400, response.status_code)
+
+    def test_read_all_case_item_not_exist(self):
+        response = self.client.post(
+            '/api/my-feeds/read-all',
+            headers=basic_auth_headers("user", "pass"),
+            json={"until_item_id": 5}
+        )
+        self.assertDictEqual({'message': 'Item id not found', 'payload': {'until_item_id': 5}}, response.json)
+        self.assertEqual(404, response.status_code)
+
+    def test_read_all_case_not_followed(self):
+        response = self.client.post(
+            '/api/my-feeds/1/read-all',
+            headers=basic_auth_headers("user3", "pass")
+        )
+        self.assertDictEqual({'message': "User 'user3' does not follow feed '1'", 'payload': {}}, response.json)
+        self.assertEqual(409, response.status_code)
+
+    def test_read_all_feed_items(self):
+        response = self.client.post(
+            '/api/my-feeds/1/read-all',
+            headers=basic_auth_headers("user", "pass")
+        )
+        with self.app.app_context():
+            self.assertEqual(0, len(Unread.query.filter_by(username="user").all()))
+            read_list = Read.query.filter_by(username="user").all()
+            self.assertListEqual([1, 2], sorted([read.item_id for read in read_list]))
+
+        self.assertEqual(204, response.status_code)
+
+    def test_read_all_items_until_past_date(self):
+        response = self.client.post(
+            '/api/my-feeds/read-all',
+            headers=basic_auth_headers("user2", "pass"),
+            json={"until": "2020-01-01T00:00:00"}
+        )
+        with self.app.app_context():
+            unread_list = Unread.query.filter_by(username="user2").all()
+            self.assertListEqual([3], [unread.item_id for unread in unread_list])
+
+        self.assertEqual(204, response.status_code)
+
+    def test_read_all_items_up_to_item(self):
+        response = self.client.post(
+            '/api/my-feeds/read-all',
+            headers=basic_auth_headers("user2", "pass"),
+            json={"until_item_id": 3}
+        )
+        with self.app.app_context():
+            self.assertEqual(0, len(Unread.query.filter_by(username="user2").all()))
+            read_list = Read.query.filter_by(username="user2").all()
+            self.assertListEqual([3, 4], sorted([read.item_id for read in read_list]))
+
+        self.assertEqual(204, response.status_code)
+
+
 class TestGetReadItems(TestWrapper):
+    def test_get_all_read_items_response_body(self):
+        response = self.client.get(
+            '/api/my-feeds/old',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([2], [item.get("id") for item in response.get_json()])
+
     def test_get_read_items_from_feed_no_auth(self):
         response = self.client.get('/api/my-feeds/1/old')
         self.assertIsNone(response.json)
@@ -319,6 +571,14 @@ class TestGetReadItems(TestWrapper):
 
 
 class TestGetUnreadItems(TestWrapper):
+    def test_get_all_unread_items_response_body(self):
+        response = self.client.get(
+            '/api/my-feeds/new',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([1], [item.get("id") for item in response.get_json()])
+
     def test_get_unread_items_from_feed_no_auth(self):
         response = self.client.get('/api/my-feeds/1/new')
         self.assertIsNone(response.json)
@@ -391,6 +651,283 @@ class TestGetUnreadItems(TestWrapper):
         self.assertEqual(200, response.status_code)
 
 
+class TestPaginateItems(TestWrapper):
+    def test_paginate_unread_items(self):
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("user", "pass"), json={"feed_id": 2})
+
+        response = self.client.get(
+            '/api/my-feeds/new?limit=2',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([4, 3], [item.get("id") for item in response.get_json().get("items")])
+        self.assertIsNotNone(response.get_json().get("next_cursor"))
+
+        response = self.client.get(
+            '/api/my-feeds/new',
+            headers=basic_auth_headers("user", "pass"),
+            query_string={"limit": 2, "cursor": response.get_json().get("next_cursor")}
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([1], [item.get("id") for item in response.get_json().get("items")])
+        self.assertIsNone(response.get_json().get("next_cursor"))
+
+    def test_paginate_read_items_of_feed(self):
+        response = self.client.get(
+            '/api/my-feeds/1/old?limit=5',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([2], [item.get("id") for item in response.get_json().get("items")])
+        self.assertIsNone(response.get_json().get("next_cursor"))
+
+    def test_paginate_undated_items(self):
+        with self.app.app_context():
+            feed = Feed(url="https://undated.example.com/rss.xml", parser="lxml")
+            self.database.session.add(feed)
+            self.database.session.flush()
+            items = [FeedItem(guid=title, title=title, feed_id=feed.id, published=published) for title, published in
+                     (("Undated 1", None), ("Dated", datetime(2020, 11, 12, tzinfo=pytz.utc)), ("Undated 2", None))]
+            self.database.session.add_all(items + [Follows(username="user3", feed_id=feed.id)])
+            self.database.session.flush()
+            self.database.session.add_all([Unread(username="user3", item_id=item.id, feed_id=feed.id)
+                                           for item in items])
+            self.database.session.commit()
+            # Newest first, the undated items last
+            expected = [items[1].id, items[2].id, items[0].id]
+
+        item_ids, cursor = list(), None
+        for _ in expected:
+            response = self.client.get('/api/my-feeds/new', headers=basic_auth_headers("user3", "pass"),
+                                       query_string={"limit": 1, **({"cursor": cursor} if cursor else {})})
+            self.assertEqual(200, response.status_code)
+            item_ids += [item.get("id") for item in response.get_json().get("items")]
+            cursor = response.get_json().get("next_cursor")
+        self.assertListEqual(expected, item_ids)
+        self.assertIsNone(cursor)
+
+    def test_paginate_case_invalid_cursor(self):
+        response = self.client.get(
+            '/api/my-feeds/new?cursor=lorem_ipsum',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("Invalid cursor 'lorem_ipsum'", response.get_json().get("message"))
+
+    def test_paginate_case_invalid_limit(self):
+        response = self.client.get(
+            '/api/my-feeds/new?limit=0',
+            headers=basic_auth_headers("user", "pass")
+        )
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("'limit' must be a positive integer", response.get_json().get("message"))
+
+
+class TestWatermarkReadState(TestWrapper):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app.config["READ_STATE_MODEL"] = "watermark"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.config["READ_STATE_MODEL"] = "unreads"
+
+    def get_item_ids(self, url, username):
+        response = self.client.get(url, headers=basic_auth_headers(username, "pass"))
+        self.assertEqual(200, response.status_code)
+        return [item.get("id") for item in response.get_json()]
+
+    def test_read_out_of_order_then_compact(self):
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("user3", "pass"), json={"feed_id": 2})
+        self.assertListEqual([4, 3], self.get_item_ids('/api/my-feeds/new', "user3"))
+
+        response = self.client.post('/api/items/4/read', headers=basic_auth_headers("user3", "pass"))
+        self.assertEqual(204, response.status_code)
+        self.assertListEqual([3], self.get_item_ids('/api/my-feeds/new', "user3"))
+        self.assertListEqual([4], self.get_item_ids('/api/my-feeds/old', "user3"))
+        with self.app.app_context():
+            self.assertListEqual([4], [exception.item_id for exception in ReadException.query.all()])
+
+        response = self.client.post('/api/items/3/read', headers=basic_auth_headers("user3", "pass"))
+        self.assertEqual(204, response.status_code)
+        self.assertListEqual([], self.get_item_ids('/api/my-feeds/new', "user3"))
+        self.assertListEqual([4, 3], self.get_item_ids('/api/my-feeds/old', "user3"))
+        with self.app.app_context():
+            self.assertEqual(0, len(ReadException.query.all()))
+            self.assertEqual(4, ReadMark.query.get(("user3", 2)).read_until_item_id)
+
+    def test_read_all_then_unfollow(self):
+        self.client.post('/api/users', json={"username": "watermark", "password": "pass"})
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("watermark", "pass"),
+                         json={"feed_id": 1, "backfill_limit": 1})
+        self.assertListEqual([2], self.get_item_ids('/api/my-feeds/new', "watermark"))
+
+        response = self.client.post('/api/my-feeds/1/read-all', headers=basic_auth_headers("watermark", "pass"))
+        self.assertEqual(204, response.status_code)
+        self.assertListEqual([], self.get_item_ids('/api/my-feeds/new', "watermark"))
+        self.assertListEqual([2], self.get_item_ids('/api/my-feeds/old', "watermark"))
+
+        response = self.client.delete('/api/feeds/unfollow', headers=basic_auth_headers("watermark", "pass"),
+                                      json={"feed_id": 1})
+        self.assertEqual(204, response.status_code)
+        with self.app.app_context():
+            self.assertIsNone(ReadMark.query.get(("watermark", 1)))
+
+    def test_unread_counters(self):
+        self.client.post('/api/users', json={"username": "counted", "password": "pass"})
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("counted", "pass"),
+                         json={"feed_id": 2, "backfill_limit": 1})
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers("counted", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 1}], response.get_json())
+
+        # Only the new item published after the horizon is unread
+        with self.app.app_context():
+            Scraper({"url": Feed.query.get(2).url}).persist([
+                FeedItem(title="Item 7", feed_id=2, published=datetime(2020, 11, 11, tzinfo=pytz.utc)),
+                FeedItem(title="Item 8", feed_id=2, published=datetime(2020, 11, 9, tzinfo=pytz.utc))])
+            item_id = FeedItem.query.filter_by(title="Item 7").one().id
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers("counted", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 2}], response.get_json())
+
+        self.client.post(f'/api/items/{item_id}/read', headers=basic_auth_headers("counted", "pass"))
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers("counted", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 1}], response.get_json())
+
+        self.client.post('/api/my-feeds/read-all', headers=basic_auth_headers("counted", "pass"))
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers("counted", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 0}], response.get_json())
+
+
+class TestUnreadCounters(TestWrapper):
+    def get_counts(self, username):
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers(username, "pass"))
+        self.assertEqual(200, response.status_code)
+        return response.get_json()
+
+    def persist_items(self, feed_id, *titles) -> list:
+        published = datetime(year=2020, month=11, day=11, tzinfo=pytz.utc)
+        with self.app.app_context():
+            Scraper({"url": Feed.query.get(feed_id).url}).persist(
+                [FeedItem(title=title, feed_id=feed_id, published=published) for title in titles])
+            return [item.id for item in FeedItem.query.filter(FeedItem.title.in_(titles))]
+
+    def test_counts_not_authenticated(self):
+        response = self.client.get('/api/my-feeds/counts')
+        self.assertIsNone(response.json)
+        self.assertEqual(401, response.status_code)
+
+    def test_counts_of_setup(self):
+        self.assertListEqual([{'feed_id': 1, 'unread_count': 1}], self.get_counts("user"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 1}], self.get_counts("user2"))
+        self.assertListEqual([], self.get_counts("user3"))
+
+    def test_counts_updated_by_follow_persist_and_read(self):
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("user3", "pass"), json={"feed_id": 2})
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 2}], self.get_counts("user3"))
+
+        self.client.post('/api/items/3/read', headers=basic_auth_headers("user3", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 1}], self.get_counts("user3"))
+
+        item_ids = self.persist_items(2, "Item 5", "Item 6")
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 3}], self.get_counts("user3"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 3}], self.get_counts("user2"))
+        self.assertListEqual([{'feed_id': 1, 'unread_count': 1}], self.get_counts("user"))
+
+        self.client.post('/api/items/read-multiple', headers=basic_auth_headers("user3", "pass"),
+                         json={"item_ids": [4, *item_ids]})
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 0}], self.get_counts("user3"))
+
+        self.client.delete('/api/feeds/unfollow', headers=basic_auth_headers("user3", "pass"), json={"feed_id": 2})
+        self.assertListEqual([], self.get_counts("user3"))
+
+    def test_reconcile_counters(self):
+        with self.app.app_context():
+            UnreadCounter.query.filter_by(username="user").update({UnreadCounter.unread_count: 42})
+            get_read_state().reconcile_counters()
+            self.database.session.commit()
+        self.assertListEqual([{'feed_id': 1, 'unread_count': 1}], self.get_counts("user"))
+
+
+class TestConditionalResponses(TestWrapper):
+    def test_all_feeds_not_modified(self):
+        response = self.client.get('/api/feeds', headers=basic_auth_headers("user", "pass"))
+        self.assertEqual(200, response.status_code)
+        etag = response.headers.get("ETag")
+        self.assertTrue(etag.startswith('W/"'))
+
+        response = self.client.get('/api/feeds', headers={**basic_auth_headers("user", "pass"), 'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.data)
+
+    def test_item_list_not_modified_until_read(self):
+        response = self.client.get('/api/my-feeds/new', headers=basic_auth_headers("user", "pass"))
+        self.assertEqual(200, response.status_code)
+        etag = response.headers.get("ETag")
+
+        with patch.object(FeedItem, "serialize") as serialize:
+            response = self.client.get('/api/my-feeds/new',
+                                       headers={**basic_auth_headers("user", "pass"), 'If-None-Match': etag})
+            self.assertFalse(serialize.called)
+        self.assertEqual(304, response.status_code)
+
+        # Another user, or another page of the same list, has its own ETag
+        response = self.client.get('/api/my-feeds/new',
+                                   headers={**basic_auth_headers("user2", "pass"), 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        response = self.client.get('/api/my-feeds/new?limit=1',
+                                   headers={**basic_auth_headers("user", "pass"), 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+        self.client.post('/api/items/1/read', headers=basic_auth_headers("user", "pass"))
+        response = self.client.get('/api/my-feeds/new',
+                                   headers={**basic_auth_headers("user", "pass"), 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers.get("ETag"))
+
+    def test_item_list_modified_by_scrape(self):
+        response = self.client.get('/api/my-feeds/2/new', headers=basic_auth_headers("user2", "pass"))
+        etag = response.headers.get("ETag")
+
+        with self.app.app_context():
+            Scraper({"url": Feed.query.get(2).url}).persist(
+                [FeedItem(title="Item 9", feed_id=2, published=datetime(2020, 11, 11, tzinfo=pytz.utc))])
+        response = self.client.get('/api/my-feeds/2/new',
+                                   headers={**basic_auth_headers("user2", "pass"), 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual(["Item 9", "Item 3"], [item.get("title") for item in response.get_json()])
+
+    def test_item_list_modified_by_scrape_within_a_second(self):
+        with self.app.app_context():
+            last_updated = Feed.query.get(1).last_updated
+        response = self.client.get('/api/my-feeds/new', headers=basic_auth_headers("user", "pass"))
+        etag = response.headers.get("ETag")
+
+        with self.app.app_context():
+            Scraper({"url": Feed.query.get(1).url}).persist(
+                [FeedItem(title="Item 8", feed_id=1, published=datetime(2020, 11, 9, tzinfo=pytz.utc))])
+            # Like a second scrape within the same second, the last_updated time of the feed is left as it was
+            Feed.query.filter_by(id=1).update({Feed.last_updated: last_updated})
+            self.database.session.commit()
+        response = self.client.get('/api/my-feeds/new',
+                                   headers={**basic_auth_headers("user", "pass"), 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertIn("Item 8", [item.get("title") for item in response.get_json()])
+
+    def test_user_feeds_modified_by_follow(self):
+        response = self.client.get('/api/my-feeds', headers=basic_auth_headers("user3", "pass"))
+        etag = response.headers.get("ETag")
+
+        conditional_headers = {**basic_auth_headers("user3", "pass"), 'If-None-Match': etag}
+        response = self.client.get('/api/my-feeds', headers=conditional_headers)
+        self.assertEqual(304, response.status_code)
+
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("user3", "pass"), json={"feed_id": 1})
+        response = self.client.get('/api/my-feeds', headers=conditional_headers)
+        self.assertEqual(200, response.status_code)
+        self.assertListEqual([{'id': 1, 'url': 'https://feeds.feedburner.com/tweakers/mixed'}], response.get_json())
+
+
 class TestGetUserSubscribedFeeds(TestWrapper):
     def test_get_user_feeds_without_auth(self):
         response = self.client.get('/api/my-feeds')
@@ -436,34 +973,211 @@ class TestRefreshUserFeeds(TestWrapper):
         self.assertDictEqual({'message': 'Feed id not found', 'payload': {}}, response.json)
         self.assertEqual(404, response.status_code)
 
-    @patch("manager.flask_app_routes.Scraper")
-    @patch("manager.flask_app_routes.scrape_single")
-    def test_refresh_single_feed_successfully(self, scrape_single_task, scraper):
-        scraper.parse.return_value = [FeedItem(id=5), FeedItem(id=6)]
-        scrape_single_task.return_value = {}
+    def run_refresh(self, refresh_feed):
+        """Carries out the scrape runs queued by the refresh requests, like a worker would"""
+        with self.app.app_context():
+            for run_id, in [call.args for call in refresh_feed.delay.call_args_list]:
+                tasks.refresh_feed.run(run_id)
+        refresh_feed.delay.reset_mock()
+
+    @patch("manager.celery_periodic.tasks.Scraper")
+    @patch("manager.flask_app_routes.refresh_feed")
+    def test_refresh_single_feed_successfully(self, refresh_feed, scraper):
+        feed_items = [FeedItem(id=5), FeedItem(id=6)]
+        scraper.return_value.parse.return_value = feed_items
+        with self.app.app_context():
+            Feed.query.filter_by(id=1).update({Feed.breaker_state: "open", Feed.failure_count: 3})
+            self.database.session.commit()
 
         response = self.client.post(
             '/api/my-feeds/1/update',
             headers=basic_auth_headers("user", "pass")
         )
-        self.assertIsNotNone(response.json)
-        self.assertDictEqual({'message': 'Update successful'}, response.json)
+        self.assertEqual(202, response.status_code)
+        self.assertEqual("PENDING", response.json["status"])
+        self.assertListEqual([{'feed_id': '1', 'status': 'PENDING', 'started_at': None, 'finished_at': None,
+                               'error': None}], response.json["feeds"])
+        self.assertTrue(response.headers["Location"].endswith(f"/api/refresh-jobs/{response.json['job_id']}"))
+        refresh_feed.delay.assert_called_once()
+
+        # The request does not scrape the feed itself, the worker does
+        scraper.return_value.parse.assert_not_called()
+        self.run_refresh(refresh_feed)
+        scraper.return_value.persist.assert_called_once_with(feed_items)
+
+        response = self.client.get(response.headers["Location"], headers=basic_auth_headers("user", "pass"))
         self.assertEqual(200, response.status_code)
-        self.assertTrue(scraper.persist.called_with([FeedItem(id=5), FeedItem(id=6)]))
-        self.assertTrue(scrape_single_task.delay.called)
+        self.assertEqual("SUCCESSFUL", response.json["status"])
+        self.assertEqual("SUCCESSFUL", response.json["feeds"][0]["status"])
+        self.assertIsNotNone(response.json["feeds"][0]["finished_at"])
+        # A successful refresh closes the circuit breaker of the feed for every scraper process
+        with self.app.app_context():
+            self.assertEqual("closed", Feed.query.get(1).breaker_state)
+            self.assertEqual(0, Feed.query.get(1).failure_count)
 
-    @patch("manager.flask_app_routes.Scraper")
-    @patch("manager.flask_app_routes.scrape_single")
-    def test_refresh_all_user_feeds_successfully(self, scrape_single_task, scraper):
-        scraper.parse.return_value = [FeedItem(id=5), FeedItem(id=6)]
-        scrape_single_task.return_value = {}
+    @patch("manager.celery_periodic.tasks.Scraper")
+    @patch("manager.flask_app_routes.refresh_feed")
+    def test_refresh_all_user_feeds_successfully(self, refresh_feed, scraper):
+        scraper.return_value.parse.return_value = [FeedItem(id=5), FeedItem(id=6)]
 
         response = self.client.post(
             '/api/my-feeds/update',
             headers=basic_auth_headers("user", "pass")
         )
-        self.assertIsNotNone(response.json)
-        self.assertListEqual([{'feed_id': '1', 'status': 'SUCCESSFUL'}], response.json)
+        self.assertEqual(202, response.status_code)
+        self.assertListEqual(['1'], [feed["feed_id"] for feed in response.json["feeds"]])
+        self.run_refresh(refresh_feed)
+
+        response = self.client.get(response.headers["Location"], headers=basic_auth_headers("user", "pass"))
+        self.assertEqual("SUCCESSFUL", response.json["status"])
+
+    @patch("manager.celery_periodic.tasks.Scraper")
+    @patch("manager.flask_app_routes.refresh_feed")
+    def test_refresh_all_user_feeds_failed(self, refresh_feed, scraper):
+        scraper.return_value.parse.side_effect = ConnectionError("Connection refused")
+
+        response = self.client.post(
+            '/api/my-feeds/update',
+            headers=basic_auth_headers("user2", "pass")
+        )
+        self.run_refresh(refresh_feed)
+        response = self.client.get(response.headers["Location"], headers=basic_auth_headers("user2", "pass"))
+        self.assertEqual("FAILED", response.json["status"])
+        self.assertEqual("FAILED", response.json["feeds"][0]["status"])
+        self.assertEqual("ConnectionError('Connection refused')", response.json["feeds"][0]["error"])
+        response = self.client.get('/api/scraper/breakers', headers=basic_auth_headers("user2", "pass"))
+        self.assertEqual(200, response.status_code)
+        self.assertDictEqual({'feed_id': 2, 'url': 'http://www.nu.nl/rss/Algemeen', 'state': 'closed',
+                              'failure_count': 1, 'retry_at': None,
+                              'last_error': "ConnectionError('Connection refused')"}, response.json[1])
+
+    @patch("manager.celery_periodic.tasks.Scraper")
+    @patch("manager.flask_app_routes.refresh_feed")
+    def test_refresh_requests_coalesced(self, refresh_feed, scraper):
+        scraper.return_value.parse.return_value = []
+
+        first = self.client.post('/api/my-feeds/1/update', headers=basic_auth_headers("user", "pass"))
+        second = self.client.post('/api/my-feeds/update', headers=basic_auth_headers("user", "pass"))
+        third = self.client.post('/api/my-feeds/1/update', headers=basic_auth_headers("user3", "pass"))
+        self.assertEqual(3, len({first.json["job_id"], second.json["job_id"], third.json["job_id"]}))
+        # The three jobs share the run of the feed still in flight, which is queued and scraped once
+        refresh_feed.delay.assert_called_once()
+        self.run_refresh(refresh_feed)
+        scraper.return_value.parse.assert_called_once()
+        for response in (first, second):
+            response = self.client.get(response.headers["Location"], headers=basic_auth_headers("user", "pass"))
+            self.assertEqual("SUCCESSFUL", response.json["status"])
+
+        # Once the run is over, a new request scrapes the feed again
+        self.client.post('/api/my-feeds/1/update', headers=basic_auth_headers("user", "pass"))
+        refresh_feed.delay.assert_called_once()
+        self.run_refresh(refresh_feed)
+
+    def test_refresh_job_case_not_found(self):
+        response = self.client.get('/api/refresh-jobs/1000', headers=basic_auth_headers("user", "pass"))
+        self.assertEqual(404, response.status_code)
+        self.assertEqual("Refresh job '1000' not found", response.json["message"])
+
+    @patch("manager.celery_periodic.tasks.Scraper")
+    @patch("manager.flask_app_routes.refresh_feed")
+    def test_refresh_job_case_other_user(self, refresh_feed, scraper):
+        scraper.return_value.parse.return_value = []
+        response = self.client.post('/api/my-feeds/1/update', headers=basic_auth_headers("user", "pass"))
+        self.run_refresh(refresh_feed)
+        response = self.client.get(response.headers["Location"], headers=basic_auth_headers("user2", "pass"))
+        self.assertEqual(404, response.status_code)
+
+    def test_refresh_job_case_not_authenticated(self):
+        response = self.client.get('/api/refresh-jobs/1')
+        self.assertEqual(401, response.status_code)
+
+    def test_breakers_case_not_authenticated(self):
+        response = self.client.get('/api/scraper/breakers')
+        self.assertEqual(401, response.status_code)
+
+
+class ReadStateModelScenario:
+    """The same follow / scrape / read scenario run with each read state model, whose item lists must not differ"""
+    model = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app.config["READ_STATE_MODEL"] = cls.model
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.config["READ_STATE_MODEL"] = "unreads"
+
+    def get_titles(self, url):
+        response = self.client.get(url, headers=basic_auth_headers("user3", "pass"))
         self.assertEqual(200, response.status_code)
-        self.assertTrue(scraper.persist.called_with([FeedItem(id=5), FeedItem(id=6)]))
-        self.assertTrue(scrape_single_task.delay.called)
+        return [item.get("title") for item in response.get_json()]
+
+    def persist_items(self, **published_days):
+        with self.app.app_context():
+            Scraper({"url": Feed.query.get(2).url}).persist(
+                [FeedItem(title=title, feed_id=2, published=datetime(2020, 11, day, tzinfo=pytz.utc))
+                 for title, day in published_days.items()])
+
+    def test_item_lists(self):
+        self.client.post('/api/feeds/follow', headers=basic_auth_headers("user3", "pass"), json={"feed_id": 2})
+        self.assertListEqual(["Item 4", "Item 3"], self.get_titles('/api/my-feeds/new'))
+
+        # Item 6 is scraped late, with a publication time older than the items already stored
+        self.persist_items(**{"Item 5": 11, "Item 6": 9})
+        self.assertListEqual(["Item 5", "Item 4", "Item 3", "Item 6"], self.get_titles('/api/my-feeds/new'))
+
+        self.client.post('/api/items/4/read', headers=basic_auth_headers("user3", "pass"))
+        self.assertListEqual(["Item 5", "Item 3", "Item 6"], self.get_titles('/api/my-feeds/2/new'))
+        self.assertListEqual(["Item 4"], self.get_titles('/api/my-feeds/2/old'))
+
+        self.client.post('/api/my-feeds/2/read-all', headers=basic_auth_headers("user3", "pass"))
+        self.assertListEqual([], self.get_titles('/api/my-feeds/new'))
+
+        self.persist_items(**{"Item 7": 12})
+        self.assertListEqual(["Item 7"], self.get_titles('/api/my-feeds/2/new'))
+        response = self.client.get('/api/my-feeds/counts', headers=basic_auth_headers("user3", "pass"))
+        self.assertListEqual([{'feed_id': 2, 'unread_count': 1}], response.get_json())
+
+
+    def test_reads_decrement_counters(self):
+        headers = basic_auth_headers("reader", "pass")
+        self.client.post('/api/users', json={"username": "reader", "password": "pass"})
+        self.client.post('/api/feeds/follow', headers=headers, json={"feed_id": 2})
+        self.persist_items(**{"Item 9": 14, "Item 10": 15, "Item 11": 16})
+        with self.app.app_context():
+            item_ids = [item.id for item in get_read_state().unread_items("reader")]
+
+        # Reading applies the difference to the counter rather than counting the unread items again
+        with patch("manager.read_state.ReadState.refresh_counters") as refresh_counters:
+            for url, body in ((f'/api/items/{item_ids[0]}/read', None),
+                              ('/api/items/read-multiple', {"item_ids": item_ids[1:3]}),
+                              ('/api/my-feeds/2/read-all', {"until_item_id": item_ids[-2]}),
+                              ('/api/my-feeds/read-all', None)):
+                self.assertEqual(204, self.client.post(url, headers=headers, json=body).status_code)
+                unread_items = self.client.get('/api/my-feeds/new', headers=headers).get_json()
+                response = self.client.get('/api/my-feeds/counts', headers=headers)
+                self.assertListEqual([{'feed_id': 2, 'unread_count': len(unread_items)}], response.get_json())
+            refresh_counters.assert_not_called()
+        self.assertListEqual([], unread_items)
+
+class TestUnreadRowsScenario(ReadStateModelScenario, TestWrapper):
+    model = "unreads"
+
+
+class TestWatermarkScenario(ReadStateModelScenario, TestWrapper):
+    model = "watermark"
+
+
+class TestReadRowsScenario(ReadStateModelScenario, TestWrapper):
+    model = "reads"
+
+    def test_scrape_writes_no_unread_rows(self):
+        self.persist_items(**{"Item 8": 13})
+        with self.app.app_context():
+            self.assertEqual(0, Unread.query.filter(Unread.item_id == FeedItem.id, FeedItem.title == "Item 8").count())
+            unread_count = UnreadCounter.query.get(("user2", 2)).unread_count
+        response = self.client.get('/api/my-feeds/2/new', headers=basic_auth_headers("user2", "pass"))
+        self.assertIn("Item 8", [item.get("title") for item in response.get_json()])
+        self.assertEqual(len(response.get_json()), unread_count)
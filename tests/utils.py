@@ -1,4 +1,8 @@
+import gzip
+import threading
+import time
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytz
 from passlib.handlers.pbkdf2 import pbkdf2_sha256
@@ -29,15 +33,17 @@ def generate_setup() -> list:
     # --------------------------------------------- FeedItem table ----------------------------------------------------
     item_dt = datetime(year=2020, month=11, day=10, hour=0, minute=0, second=0, microsecond=0, tzinfo=pytz.utc)
     item1 = FeedItem(
-        id=1, url="https://www.amazon.com/", title="Item 1", description="Desc 1", feed_id=1,
-        published=item_dt)
+        id=1, guid="https://www.amazon.com/", url="https://www.amazon.com/", title="Item 1", description="Desc 1",
+        feed_id=1, published=item_dt)
     item2 = FeedItem(
-        id=2, url="https://www.ebay.com/", title="Item 2", description="Desc 2", feed_id=1, published=item_dt)
+        id=2, guid="https://www.ebay.com/", url="https://www.ebay.com/", title="Item 2", description="Desc 2",
+        feed_id=1, published=item_dt)
     item3 = FeedItem(
-        id=3, url="https://www.subito.it/", title="Item 3", description="Desc 3", feed_id=2,
-        published=item_dt)
+        id=3, guid="https://www.subito.it/", url="https://www.subito.it/", title="Item 3", description="Desc 3",
+        feed_id=2, published=item_dt)
     item4 = FeedItem(
-        id=4, url="https://www.kijiji.it/", title="Item 4", description="Desc 4", feed_id=2, published=item_dt)
+        id=4, guid="https://www.kijiji.it/", url="https://www.kijiji.it/", title="Item 4", description="Desc 4",
+        feed_id=2, published=item_dt)
 
     # --------------------------------------------- Read/Unread tables ------------------------------------------------
     unread1 = Unread(username=user1.username, item_id=1, feed_id=1)
@@ -48,3 +54,73 @@ def generate_setup() -> list:
     # --------------------------------------------- End of tables population ------------------------------------------
     return [user1, user2, user3, feed1, feed2, follows1, follows2, item1, item2,
             item3, item4, unread1, unread2, read1, read2]
+
+
+class FeedServer(ThreadingHTTPServer):
+    """Local HTTP stand-in for the origins of the feeds, serving fixture documents from a background thread
+
+    Each document is a dict with the 'body' to serve and optionally its 'etag', a 'delay' in seconds before the
+    response and the 'status' to answer with instead of 200, the body is gzipped for the clients accepting it. The
+    server keeps the headers of the requests it received and the highest number of concurrent requests.
+    """
+
+    def __init__(self, documents: dict):
+        super().__init__(("127.0.0.1", 0), FeedRequestHandler)
+        self.documents = documents
+        self.received_headers = list()
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    # Keeping the connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.received_headers.append(dict(self.headers))
+            self.server.active_requests += 1
+            self.server.max_active_requests = max(self.server.max_active_requests, self.server.active_requests)
+        try:
+            document = self.server.documents.get(self.path)
+            if document is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            time.sleep(document.get("delay", 0))
+            etag = document.get("etag")
+            if etag and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = document["body"]
+            self.send_response(document.get("status", 200))
+            if etag:
+                self.send_header("ETag", etag)
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.server.lock:
+                self.server.active_requests -= 1
+
+    def log_message(self, *args):
+        pass